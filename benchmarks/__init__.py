@@ -0,0 +1,101 @@
+"""
+Benchmarks for the hot paths of netaxept.
+
+Run them all (the results are printed as JSON) with:
+
+    python -m benchmarks [--rows 10000,100000,1000000] [--latency 0.05] [--output results.json]
+
+or a single module, for instance: `python -m benchmarks.terminal_url`
+
+The gateway is never contacted: the suds client is built from a local copy of the wsdl, and the actions run against
+the fake backend (with the simulated latency of `--latency`).
+"""
+import os
+import time
+import timeit
+import tracemalloc
+from contextlib import contextmanager
+from unittest.mock import patch
+
+WSDL = 'file://' + os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'tests', 'wsdl', 'netaxept.wsdl')
+
+
+def setup_django():
+    import django
+    import structlog
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+    django.setup()
+    # Keep the output clean, only the results are printed.
+    structlog.configure(processors=[_drop_event])
+
+
+def _drop_event(logger, method_name, event_dict):
+    import structlog
+    raise structlog.DropEvent
+
+
+@contextmanager
+def test_database():
+    """
+    Run the enclosed benchmarks against a fresh test database.
+    """
+    from django.db import connection
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+@contextmanager
+def fake_backend(**options):
+    from netaxept.backends.fake import FakeBackend
+    with patch('netaxept.gateway._backend', FakeBackend(**options)):
+        yield
+
+
+def measure(name, func, number=1000, repeat=5):
+    """
+    Time `func` and return the best time per call (in microseconds) out of `repeat` runs of `number` calls.
+    """
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    return {'name': name, 'calls': number, 'us_per_call': round(best * 1e6, 3)}
+
+
+def measure_allocations(name, func, number=100):
+    """
+    Return the memory allocated during a call of `func` (the peak, in bytes), and the memory still held by its
+    result, the most out of `number` calls.
+    """
+    func()
+    allocated = retained = 0
+    for _ in range(number):
+        # Tracing from scratch for every call resets the peak (like tracemalloc.reset_peak, that needs python 3.9).
+        tracemalloc.start()
+        try:
+            result = func()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        allocated, retained = max(allocated, peak), max(retained, current)
+        del result
+    return {'name': name, 'calls': number, 'allocated_bytes': allocated, 'retained_bytes': retained}
+
+
+def measure_with_queries(name, func, number=100):
+    """
+    Time `number` calls of `func` (in microseconds per call), and count the queries of a single call.
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as queries:
+        func()
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    elapsed = time.perf_counter() - start
+    return {'name': name, 'calls': number, 'us_per_call': round(elapsed / number * 1e6, 3),
+            'queries': len(queries)}
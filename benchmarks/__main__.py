@@ -0,0 +1,36 @@
+import argparse
+import json
+
+from . import setup_django, test_database
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Run all the benchmarks.')
+    parser.add_argument('--rows', type=lambda value: [int(v) for v in value.split(',')], default=[10000],
+                        help='Comma separated table sizes for the admin and indexes benchmarks,'
+                        ' for instance 10000,100000,1000000')
+    parser.add_argument('--latency', type=float, default=0.0, help='Simulated gateway latency, in seconds')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--output', help='Write the results to this file instead of stdout')
+    options = parser.parse_args()
+
+    setup_django()
+    from . import actions, admin, imports, indexes, lite, settlement, soap, terminal_url
+
+    results = []
+    for module in [imports, terminal_url, soap, lite]:
+        results.extend(module.run(options))
+    for module in [actions, settlement, admin, indexes]:
+        with test_database():
+            results.extend(module.run(options))
+
+    output = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
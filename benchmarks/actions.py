@@ -0,0 +1,35 @@
+"""
+The per-call cost (time and queries) of the actions, against the fake backend.
+"""
+import json
+from itertools import count
+
+from . import fake_backend, measure_with_queries, setup_django, test_database
+
+
+def run(options=None):
+    from netaxept import actions
+    from netaxept.models import Payment
+
+    latency = getattr(options, 'latency', 0.0)
+    with fake_backend(latency=latency):
+        # A new order every time, registering the same order again would only time the idempotency cache.
+        order_numbers = count()
+        # Big enough to be captured again and again.
+        payment = actions.register(order_number='benchmark', amount=10 ** 9, currency_code='NOK',
+                                   redirect_url='http://example.com/', auto_auth=True)
+        results = [
+            measure_with_queries(
+                'actions.register',
+                lambda: actions.register(order_number='benchmark-{}'.format(next(order_numbers)), amount=100,
+                                         currency_code='NOK', redirect_url='http://example.com/')),
+            measure_with_queries('actions.capture', lambda: actions.capture(payment.id, 1)),
+        ]
+    Payment.objects.all().delete()
+    return results
+
+
+if __name__ == '__main__':
+    setup_django()
+    with test_database():
+        print(json.dumps(run(), indent=2))
@@ -0,0 +1,59 @@
+"""
+The cost (time and queries) of rendering the PaymentAdmin changelist, depending on the size of the tables.
+"""
+import json
+
+from . import measure_with_queries, setup_django, test_database
+
+BATCH_SIZE = 10000
+
+
+def run(options=None):
+    from django.contrib import admin
+    from django.contrib.auth.models import User
+    from django.test import RequestFactory
+
+    from netaxept.models import Payment
+
+    rows = getattr(options, 'rows', None) or [10000]
+    user = User.objects.create_superuser('benchmark', 'benchmark@example.com', 'benchmark')
+    payment_admin = admin.site._registry[Payment]
+
+    def changelist():
+        request = RequestFactory().get('/admin/netaxept/payment/')
+        request.user = user
+        payment_admin.changelist_view(request).render()
+
+    results = []
+    for count in sorted(rows):
+        _fill(count)
+        results.append(dict(measure_with_queries('admin.payment_changelist', changelist, number=10), rows=count))
+    return results
+
+
+def _fill(count):
+    """
+    Add payments (each with two operations) until there are `count` of them.
+    """
+    from netaxept.models import Payment, Operation
+
+    existing = Payment.objects.count()
+    while existing < count:
+        size = min(BATCH_SIZE, count - existing)
+        Payment.objects.bulk_create(
+            Payment(transaction_id='b{}'.format(existing + i), order_number=str(existing + i), amount=100,
+                    currency_code='NOK', redirect_url='http://example.com/', success=True, auto_auth=False)
+            for i in range(size))
+        payments = Payment.objects.filter(transaction_id__in=['b{}'.format(existing + i) for i in range(size)])
+        Operation.objects.bulk_create(
+            Operation(payment_id=payment_id, transaction_id=transaction_id, operation=operation, amount=100,
+                      success=True)
+            for payment_id, transaction_id in payments.values_list('id', 'transaction_id')
+            for operation in [Operation.AUTH, Operation.CAPTURE])
+        existing += size
+
+
+if __name__ == '__main__':
+    setup_django()
+    with test_database():
+        print(json.dumps(run(), indent=2))
@@ -0,0 +1,45 @@
+"""
+The import time of netaxept when django starts (the admin and the actions are loaded) and of the example views.
+None of them should load the SOAP stack (suds.client, requests), only the first call to netaxept does.
+
+The imports are timed with `python -X importtime` in a new process, so that nothing is already imported.
+"""
+import json
+import os
+import subprocess
+import sys
+
+# The SOAP stack, loaded by the backend on the first call.
+HEAVY_MODULES = ['suds.client', 'requests', 'urllib3']
+
+SCRIPT = '''
+import json, os, sys, time
+import django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+start = time.perf_counter()
+django.setup()
+import netaxept.actions, netaxept.admin, netaxept.views.example
+print(json.dumps({{'us': round((time.perf_counter() - start) * 1e6),
+                  'heavy_modules_loaded': [name for name in {heavy_modules!r} if name in sys.modules]}}))
+'''
+
+
+def run(options=None):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', SCRIPT.format(heavy_modules=HEAVY_MODULES)],
+        cwd=root, env=dict(os.environ, PYTHONPATH=root), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    setup = json.loads(process.stdout)
+
+    results = [dict(name='import.django_setup', **setup)]
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line[len('import time:'):].split('|')
+        if len(fields) == 3 and fields[2].strip().startswith('netaxept') and fields[1].strip().isdigit():
+            results.append({'name': 'import.{}'.format(fields[2].strip()), 'us': int(fields[1])})
+    return results
+
+
+if __name__ == '__main__':
+    print(json.dumps(run(), indent=2))
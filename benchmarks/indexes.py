@@ -0,0 +1,80 @@
+"""
+The queries served by the indexes of migration 0005, timed with and without those indexes, along with their query
+plans. The indexes are dropped and created again on the tables of the current schema (migrating back to 0004 would
+drop the columns added since, that the models read).
+
+The plans depend on the database: SQLite, unlike PostgreSQL, does not know that failed payments are rare and
+keeps using the index on `created` for them.
+"""
+import json
+from importlib import import_module
+
+from . import measure, setup_django, test_database
+from .admin import _fill
+
+
+def _toggle_indexes(enabled):
+    """
+    Create the indexes of migration 0005 (and drop the index of the foreign key of the operations, that it replaced),
+    or the other way around.
+    """
+    from django.apps import apps
+    from django.db import connection, models
+    from django.db.migrations import AddIndex
+
+    from netaxept.models import Operation
+
+    migration = import_module('netaxept.migrations.0005_indexes').Migration
+    indexes = [(apps.get_model('netaxept', o.model_name), o.index)
+               for o in migration.operations if isinstance(o, AddIndex)]
+    foreign_key_index = models.Index(fields=['payment'], name='netaxept_op_payment_fk')
+    with connection.schema_editor() as editor:
+        for model, index in indexes:
+            (editor.add_index if enabled else editor.remove_index)(model, index)
+        (editor.remove_index if enabled else editor.add_index)(Operation, foreign_key_index)
+
+
+def run(options=None):
+    from django.db import connection
+    from django.db.models import Exists, OuterRef
+    from django.utils import timezone
+
+    from netaxept.models import Payment, Operation
+
+    rows = getattr(options, 'rows', None) or [10000]
+    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def uncaptured():
+        settled = Operation.objects.filter(payment=OuterRef('pk'), success=True, operation=Operation.CAPTURE)
+        return Payment.objects.filter(success=True, created__gte=today) \
+            .annotate(settled=Exists(settled)).filter(settled=False).values('id')[:100]
+
+    queries = {
+        'failed_payments_of_the_day': lambda: Payment.objects.filter(success=False, created__gte=today),
+        'payments_of_an_order': lambda: Payment.objects.filter(order_number='123'),
+        'operations_of_a_transaction': lambda: Operation.objects.filter(transaction_id='b123'),
+        'last_operation_of_a_payment': lambda: Operation.objects.filter(payment_id=123).order_by('-created')[:1],
+        'uncaptured_payments': uncaptured,
+    }
+
+    results = []
+    for count in sorted(rows):
+        _fill(count)
+        # One failed payment out of a hundred.
+        Payment.objects.filter(order_number__endswith='00').update(success=False)
+        for indexes, enabled in [('before', False), ('after', True)]:
+            _toggle_indexes(enabled)
+            # Up to date statistics, as autovacuum would have gathered in production.
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+            for name, query in queries.items():
+                result = measure('indexes.{}'.format(name), lambda: list(query()), number=20, repeat=3)
+                result.update(rows=count, indexes=indexes, plan=query().explain())
+                results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    setup_django()
+    with test_database():
+        print(json.dumps(run(), indent=2))
@@ -0,0 +1,68 @@
+"""
+The cost of a call to netaxept with the soap backend (suds) versus the lite backend: rendering the request and
+parsing the reply. The replies are canned, netaxept is not contacted.
+"""
+import json
+import tempfile
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from . import WSDL, measure, measure_allocations, setup_django
+
+REGISTER_RESPONSE = b"""<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>
+<RegisterResponse xmlns="http://BBS.EPayment"><RegisterResult
+ xmlns:a="http://schemas.datacontract.org/2004/07/BBS.EPayment.ServiceLibrary">
+<a:TransactionId>0123456789abcdef0123456789abcdef</a:TransactionId></RegisterResult></RegisterResponse></s:Body>
+</s:Envelope>"""
+
+PROCESS_RESPONSE = b"""<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>
+<ProcessResponse xmlns="http://BBS.EPayment"><ProcessResult
+ xmlns:a="http://schemas.datacontract.org/2004/07/BBS.EPayment.ServiceLibrary">
+<a:AuthorizationId>123456</a:AuthorizationId><a:BatchNumber>675</a:BatchNumber>
+<a:ExecutionTime>2019-05-01T12:00:00.1234567+02:00</a:ExecutionTime><a:MerchantId>1</a:MerchantId>
+<a:Operation>CAPTURE</a:Operation><a:ResponseCode>OK</a:ResponseCode><a:ResponseSource i:nil="true"
+ xmlns:i="http://www.w3.org/2001/XMLSchema-instance"/><a:TransactionId>0123456789abcdef0123456789abcdef</a:TransactionId>
+</ProcessResult></ProcessResponse></s:Body></s:Envelope>"""
+
+
+class Session:
+    """
+    Answers every request with the same reply.
+    """
+
+    def __init__(self, content):
+        self.response = SimpleNamespace(status_code=200, reason='OK', headers={}, content=content)
+
+    def post(self, url, data, headers, timeout):
+        return self.response
+
+
+def run(options=None):
+    from netaxept.backends.lite import LiteBackend
+    from netaxept.backends.soap import SoapBackend
+
+    results = []
+    calls = [
+        ('register', REGISTER_RESPONSE,
+         ('42', 100, 'NOK', 'An order', 'http://example.com/', False)),
+        ('process', PROCESS_RESPONSE, ('0123456789abcdef0123456789abcdef', 'CAPTURE', 100)),
+    ]
+    with patch('netaxept.gateway.WSDL', WSDL), \
+            patch('netaxept.gateway.WSDL_CACHE_LOCATION', tempfile.mkdtemp(prefix='netaxept-benchmark')):
+        for method, content, args in calls:
+            session = Session(content)
+            with patch('netaxept.backends.soap.get_session', return_value=session), \
+                    patch('netaxept.backends.lite.get_session', return_value=session):
+                backends = [('soap', SoapBackend()),
+                            ('lite', LiteBackend(location='https://example.com/Netaxept.svc'))]
+                for name, backend in backends:
+                    call = getattr(backend, method)
+                    results.append(measure('{}.{}'.format(name, method), lambda: call(*args), number=1000))
+                    results.append(measure_allocations(
+                        '{}.{}.allocations'.format(name, method), lambda: call(*args)))
+    return results
+
+
+if __name__ == '__main__':
+    setup_django()
+    print(json.dumps(run(), indent=2))
@@ -0,0 +1,46 @@
+"""
+The throughput of the bulk capture, against the fake backend.
+"""
+import json
+import time
+
+from . import fake_backend, setup_django, test_database
+
+PAYMENTS = 1000
+
+
+def run(options=None):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    from netaxept import actions
+    from netaxept.models import Payment
+
+    latency = getattr(options, 'latency', 0.0)
+    concurrency = getattr(options, 'concurrency', 10)
+    Payment.objects.bulk_create(
+        Payment(transaction_id='s{}'.format(i), order_number=str(i), amount=100, currency_code='NOK',
+                redirect_url='http://example.com/', success=True, auto_auth=True)
+        for i in range(PAYMENTS))
+
+    with fake_backend(latency=latency), CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        results = actions.bulk_capture(Payment.objects.all(), concurrency=concurrency)
+        elapsed = time.perf_counter() - start
+    Payment.objects.all().delete()
+
+    return [{
+        'name': 'actions.bulk_capture',
+        'calls': len(results),
+        'us_per_call': round(elapsed / len(results) * 1e6, 3),
+        'ops_per_second': round(len(results) / elapsed, 1),
+        'queries': len(queries),
+        'latency': latency,
+        'concurrency': concurrency,
+    }]
+
+
+if __name__ == '__main__':
+    setup_django()
+    with test_database():
+        print(json.dumps(run(), indent=2))
@@ -0,0 +1,58 @@
+"""
+The cost of setting up suds (loading the wsdl, cloning the client), and of rendering the requests:
+with suds (creating the objects from the schema and marshalling them) versus from the templates.
+"""
+import json
+import tempfile
+from unittest.mock import patch
+
+from suds.cache import NoCache
+
+from . import WSDL, measure, measure_allocations, setup_django
+
+
+def run(options=None):
+    from netaxept.backends import soap
+
+    results = []
+    with patch('netaxept.gateway.WSDL', WSDL), \
+            patch('netaxept.gateway.WSDL_CACHE_LOCATION', tempfile.mkdtemp(prefix='netaxept-benchmark')):
+        with patch('netaxept.backends.soap.ObjectCache', lambda **kwargs: NoCache()):
+            results.append(measure('soap.client.parsed', lambda: soap.SoapBackend()._get_client(), number=10))
+        results.append(measure('soap.client.unpickled', lambda: soap.SoapBackend()._get_client(), number=10))
+
+        backend = soap.SoapBackend()
+        results.append(measure('soap.client.warm', backend._get_client, number=10000))
+
+        client = soap._clone(backend._get_shared_client())
+        client.options.nosend = True
+        requests = [
+            ('Register', soap._build_register_request, {
+                'merchant_id': 'merchant', 'token': 'token', 'order_number': '42', 'amount': 100,
+                'currency_code': 'NOK', 'description': 'An order', 'redirect_url': 'http://example.com/',
+                'auto_auth': False}),
+            ('Process', soap._build_process_request, {
+                'merchant_id': 'merchant', 'token': 'token', 'transaction_id': '0123456789abcdef',
+                'operation': 'CAPTURE', 'amount': 100}),
+        ]
+        for operation, build_request, values in requests:
+            template = backend._get_template(operation, build_request, values)
+
+            def with_suds():
+                getattr(client.service, operation)(values['merchant_id'], values['token'],
+                                                   build_request(client, values))
+
+            def with_template():
+                template.render(values)
+
+            name = 'soap.{}_request'.format(operation.lower())
+            results.append(measure(name + '.suds', with_suds, number=1000))
+            results.append(measure(name + '.template', with_template, number=1000))
+            results.append(measure_allocations(name + '.suds.allocations', with_suds))
+            results.append(measure_allocations(name + '.template.allocations', with_template))
+    return results
+
+
+if __name__ == '__main__':
+    setup_django()
+    print(json.dumps(run(), indent=2))
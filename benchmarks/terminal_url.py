@@ -0,0 +1,20 @@
+"""
+The redirect to the terminal page is built locally, it should cost a few microseconds and do no I/O.
+"""
+import json
+from unittest.mock import patch
+
+from . import measure, setup_django
+
+
+def run(options=None):
+    from netaxept.gateway import get_payment_terminal_url
+
+    with patch('requests.Session.send', side_effect=AssertionError('The terminal url must not do any I/O')):
+        return [measure('gateway.get_payment_terminal_url', lambda: get_payment_terminal_url('0123456789abcdef'),
+                        number=10000)]
+
+
+if __name__ == '__main__':
+    setup_django()
+    print(json.dumps(run(), indent=2))
@@ -1,7 +1,22 @@
+import asyncio
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import NamedTuple, Optional
+
 import suds
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models import F, QuerySet
+from django.utils import timezone
 from structlog import get_logger
 
-from .gateway import do_register, do_process
+from . import gateway, signals
+from .gateway import do_register, do_process, do_query, get_executor, GatewayUnavailable
 from .models import Payment, Operation
 
 logger = get_logger()
@@ -28,7 +43,21 @@ class PaymentRegistrationNotCompleted(NetaxeptException):
     msg = 'Payment registration not completed'
 
 
-def register(order_number, amount, currency_code, redirect_url, description=None, auto_auth=False):
+class AmountExceedsRemaining(NetaxeptException):
+    msg = 'Amount larger than what remains on the payment'
+
+
+class PaymentAnnulled(NetaxeptException):
+    msg = 'Payment annulled'
+
+
+# The fields read to build (and check) operations.
+PAYMENT_FIELDS = ['id', 'merchant', 'success', 'transaction_id', 'amount', 'state', 'captured_amount',
+                  'credited_amount']
+
+
+def register(order_number, amount, currency_code, redirect_url, description=None, auto_auth=False,
+             merchant=gateway.DEFAULT_MERCHANT):
     """
     Registering a payment is the first step for netaxept, before taking the user to the netaxept
     terminal hosted page.
@@ -43,19 +72,481 @@ def register(order_number, amount, currency_code, redirect_url, description=None
     :param description: A text (MaxLength: 4000)
     :param auto_auth: If set to True, authorization will be automatically run at after the end of the next phase
             (after the user adds his CC information on the terminal pages).
-    :return: The payment registration (either successful or unsuccesful)
+    :param merchant: The name of the merchant account in NETAXEPT_MERCHANTS, by default the account of
+            NETAXEPT_MERCHANTID. The operations on the payment go thru the same account.
+    :return: The payment registration (either successful or unsuccesful). If the same order (order number, amount
+            and currency) was successfully registered less than NETAXEPT_REGISTER_IDEMPOTENCY_TTL seconds ago,
+            that payment is returned instead.
+    :raises SOAP exceptions
+    """
+    payment = _new_payment(order_number, amount, currency_code, redirect_url, description, auto_auth, merchant)
+    registered_payment = _find_registration(payment.idempotency_key)
+    if registered_payment:
+        return registered_payment
+    try:
+        _register_with_gateway(payment)
+    except GatewayUnavailable:
+        # Never sent to netaxept, there is nothing to record.
+        raise
+    except Exception:
+        _save_registration(payment)
+        raise
+    return _save_registration(payment)
+
+
+def sale(payment_id, deferred=None):
+    """
+    Authorize and capture the whole amount of a payment, in one step.
+
+    :param payment_id: The id of a payment (or the payment itself) where registration was succesfully completed.
+    :param deferred: See `capture`.
+    :return: the operation
+    :raises SOAP exceptions
+    """
+    return _run_operation(payment_id, Operation.SALE, deferred=deferred)
+
+
+def auth(payment_id, deferred=None):
+    """
+    Authorize the whole amount of a payment.
+
+    :param payment_id: The id of a payment (or the payment itself) where registration was succesfully completed.
+    :param deferred: See `capture`.
+    :return: the operation
+    :raises SOAP exceptions
+    """
+    return _run_operation(payment_id, Operation.AUTH, deferred=deferred)
+
+
+def capture(payment_id, amount=None, deferred=None):
+    """
+    Capture the amount for an already authorized Payment.
+
+    Assumes authorization occured previously (we cannot check in the database because sometimes pre-auth was used
+    and only nets knows the status of that, see `query`). The amount however is checked against the amount already
+    captured.
+
+    :param payment_id: The id of a payment (or the payment itself) where registration and authorization
+                       were succesfully completed.
+    :param amount: An optional positive number, must not be larger than what remains on this payment.
+                   If parameter is absent, then the amount remaining on this payment will be captured.
+    :param deferred: If True the operation is enqueued (PENDING) for the netaxept_worker command, and returned
+                     right away. Defaults to NETAXEPT_DEFER_OPERATIONS.
+    :return: the operation
+    :raises AmountAlreadyCaptured, AmountExceedsRemaining, PaymentAnnulled, SOAP exceptions
+    """
+    return _run_operation(payment_id, Operation.CAPTURE, amount, deferred)
+
+
+def credit(payment_id, amount=None, deferred=None):
+    """
+    Credit the amount for a payment that was either authd and captured, or sale'd.
+
+    The amount is checked against the captured amount recorded on the payment, so invalid credits are refused
+    without invoking netaxept.
+
+    :param payment_id: The id of a payment (or the payment itself) where money was already taken.
+    :param amount: An optional positive number, must not be larger than what remains on this payment.
+                   If parameter is absent, then the amount remaining on this payment will be credited.
+    :param deferred: See `capture`.
+    :return: the operation
+    :raises NoAmountCaptured, AmountExceedsRemaining, PaymentAnnulled, SOAP exceptions
+    """
+    return _run_operation(payment_id, Operation.CREDIT, amount, deferred)
+
+
+def annul(payment_id, deferred=None):
+    """
+    Annul (cancel) the authorization of a payment that was not captured yet.
+
+    :param payment_id: The id of a payment (or the payment itself) that was authorized.
+    :param deferred: See `capture`.
+    :return: the operation
     :raises SOAP exceptions
     """
-    logger.info('netaxept-register', order_number=order_number, amount=amount,
-                currency_code=currency_code, redirect_url=redirect_url, description=description, auto_auth=auto_auth)
-    payment = Payment(
+    return _run_operation(payment_id, Operation.ANNUL, deferred=deferred)
+
+
+class TransactionStatus(NamedTuple):
+    """
+    The state of a transaction according to netaxept.
+    """
+    transaction_id: str
+    order_number: Optional[str]
+    amount: int
+    currency_code: Optional[str]
+    authorized: bool
+    authorization_id: Optional[str]
+    captured_amount: int
+    credited_amount: int
+    annulled: bool
+    query_finished: Optional[datetime]
+
+
+def query(payment_id, use_cache=True):
+    """
+    Ask netaxept for the state of a payment, for instance to find out whether a payment registered with
+    `auto_auth` was authorized.
+
+    The status is cached for NETAXEPT_QUERY_CACHE_TTL seconds, or until an operation on the payment is recorded.
+
+    :param payment_id: The id of a payment (or the payment itself) where registration was succesfully completed.
+    :param use_cache: False to always ask netaxept (the new status is cached all the same).
+    :return: A TransactionStatus
+    :raises PaymentRegistrationNotCompleted, SOAP exceptions
+    """
+    payment = _get_payment(payment_id)
+    if not payment.success:
+        logger.error('netaxept-query-payment-registration-not-complete')
+        raise PaymentRegistrationNotCompleted()
+    cache_key = _status_cache_key(payment.transaction_id)
+    if use_cache and gateway.QUERY_CACHE_TTL:
+        status = caches[gateway.CACHE].get(cache_key)
+        if status is not None:
+            return status
+    logger.info('netaxept-query', payment_id=payment.id)
+    status = _parse_query_response(do_query(transaction_id=payment.transaction_id, merchant=payment.merchant))
+    if gateway.QUERY_CACHE_TTL:
+        caches[gateway.CACHE].set(cache_key, status, gateway.QUERY_CACHE_TTL)
+    return status
+
+
+def _parse_query_response(response):
+    order = getattr(response, 'OrderInformation', None)
+    summary = getattr(response, 'Summary', None)
+    return TransactionStatus(
+        transaction_id=response.TransactionId,
+        order_number=getattr(order, 'OrderNumber', None),
+        amount=int(getattr(order, 'Amount', None) or 0),
+        currency_code=getattr(order, 'Currency', None),
+        authorized=bool(getattr(summary, 'Authorized', False)),
+        authorization_id=getattr(summary, 'AuthorizationId', None),
+        captured_amount=int(getattr(summary, 'AmountCaptured', None) or 0),
+        credited_amount=int(getattr(summary, 'AmountCredited', None) or 0),
+        annulled=bool(getattr(summary, 'Annulled', False)),
+        query_finished=getattr(response, 'QueryFinished', None),
+    )
+
+
+def _status_cache_key(transaction_id):
+    return 'netaxept-query:{}'.format(transaction_id)
+
+
+def _forget_statuses(operations):
+    """
+    Once the transaction commits, drop the cached statuses of the transactions of the operations.
+    """
+    if gateway.QUERY_CACHE_TTL:
+        keys = [_status_cache_key(o.transaction_id) for o in operations]
+        transaction.on_commit(lambda: caches[gateway.CACHE].delete_many(keys))
+
+
+class BulkOperationResult(NamedTuple):
+    payment_id: int
+    operation: Optional[Operation]  # The recorded operation, absent if the gateway could not be invoked.
+    error: Optional[Exception]
+    duration: float  # Seconds spent in the gateway call
+
+
+def bulk_capture(payments, amounts=None, concurrency=10, batch_size=500):
+    """
+    Capture many payments, for instance during the end-of-day settlement.
+
+    The payments are read in batches, the gateway is invoked for up to `concurrency` payments at once,
+    and the operations of each batch are inserted together.
+
+    :param payments: A queryset of payments, or an iterable of payment ids.
+    :param amounts: An optional dict of payment id to amount, by default the amount remaining on the payment
+                    is captured.
+    :param concurrency: The maximum number of simultaneous gateway calls.
+    :param batch_size: How many payments are read (and operations written) at once.
+    :return: A list of BulkOperationResult, in the order of the payments. Failures don't interrupt the bulk,
+             they are reported in the results.
+    """
+    return _bulk_operation(Operation.CAPTURE, payments, amounts, concurrency, batch_size)
+
+
+def bulk_credit(payments, amounts=None, concurrency=10, batch_size=500):
+    """
+    Credit many payments, see `bulk_capture`.
+    """
+    return _bulk_operation(Operation.CREDIT, payments, amounts, concurrency, batch_size)
+
+
+def bulk_annul(payments, concurrency=10, batch_size=500):
+    """
+    Annul many payments, see `bulk_capture`.
+    """
+    return _bulk_operation(Operation.ANNUL, payments, None, concurrency, batch_size)
+
+
+def _bulk_operation(operation_type, payments, amounts, concurrency, batch_size):
+    logger.info('netaxept-bulk', operation=operation_type, concurrency=concurrency)
+    amounts = amounts or {}
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='netaxept-bulk') as executor:
+        for payment_ids, payments_by_id in _payment_batches(payments, batch_size):
+            operations = []
+            for payment_id in payment_ids:
+                payment = payments_by_id.get(payment_id)
+                try:
+                    if payment is None:
+                        raise Payment.DoesNotExist('Payment {} does not exist'.format(payment_id))
+                    operations.append(_build_operation(payment, operation_type, amounts.get(payment_id)))
+                except (Payment.DoesNotExist, NetaxeptException) as e:
+                    operations.append(e)
+            batch_results = list(executor.map(_bulk_process, payment_ids, operations))
+            _bulk_record(operation_type, [r.operation for r in batch_results if r.operation is not None])
+            results.extend(batch_results)
+    logger.info('netaxept-bulk-done', operation=operation_type, count=len(results),
+                failures=sum(1 for r in results if r.error))
+    return results
+
+
+def _payment_batches(payments, batch_size):
+    """
+    Yield (payment ids, payments by id) for each batch, only the fields needed to build operations are read.
+    """
+    fields = PAYMENT_FIELDS
+    if isinstance(payments, QuerySet):
+        batch = []
+        for payment in payments.only(*fields).iterator(chunk_size=batch_size):
+            batch.append(payment)
+            if len(batch) == batch_size:
+                yield [p.id for p in batch], {p.id: p for p in batch}
+                batch = []
+        if batch:
+            yield [p.id for p in batch], {p.id: p for p in batch}
+    else:
+        iterator = iter(payments)
+        while True:
+            payment_ids = list(islice(iterator, batch_size))
+            if not payment_ids:
+                return
+            yield payment_ids, Payment.objects.only(*fields).in_bulk(payment_ids)
+
+
+def _bulk_process(payment_id, operation):
+    if isinstance(operation, Exception):
+        return BulkOperationResult(payment_id, None, operation, 0.0)
+    start = time.monotonic()
+    try:
+        _process_with_gateway(operation)
+        error = None
+    except Exception as e:
+        error = e
+    duration = time.monotonic() - start
+    # Like `_handle_operation`, the calls that never left are not recorded.
+    recorded = None if isinstance(error, GatewayUnavailable) else operation
+    return BulkOperationResult(payment_id, recorded, error, duration)
+
+
+def process_pending_operations(limit=100, concurrency=10):
+    """
+    Run the deferred operations, oldest first, this is what the netaxept_worker command does.
+
+    The operations are claimed (PENDING to PROCESSING) in a short transaction where the rows already locked by
+    other workers are skipped, so that several workers can run at once. The payments are checked again, the
+    gateway is invoked for up to `concurrency` payments at once (the operations of a payment one after the other),
+    and the outcome is recorded (DONE). Operations that could not be sent because the circuit breaker is open
+    go back to PENDING.
+
+    :param limit: The maximum number of operations claimed.
+    :return: The claimed operations.
+    """
+    operations = _claim_pending_operations(limit)
+    if not operations:
+        return []
+    logger.info('netaxept-worker', count=len(operations))
+    payments_by_id = Payment.objects.only(*PAYMENT_FIELDS).in_bulk({o.payment_id for o in operations})
+    operations_by_payment = defaultdict(list)
+    for operation in operations:
+        operations_by_payment[operation.payment_id].append(operation)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='netaxept-worker') as executor:
+        for payment_id, payment_operations in operations_by_payment.items():
+            executor.submit(_process_pending_operations, payments_by_id.get(payment_id), payment_operations)
+    for operation in operations:
+        _record(operation)
+    return operations
+
+
+def _claim_pending_operations(limit):
+    with transaction.atomic():
+        ids = list(Operation.objects
+                   .select_for_update(skip_locked=True)
+                   .filter(status=Operation.PENDING)
+                   .order_by('id')
+                   .values_list('id', flat=True)[:limit])
+        Operation.objects.filter(id__in=ids).update(status=Operation.PROCESSING, modified=timezone.now())
+    return list(Operation.objects.filter(id__in=ids).order_by('id'))
+
+
+def _process_pending_operations(payment, operations):
+    for operation in operations:
+        operation.status = Operation.DONE
+        try:
+            if payment is None:
+                raise Payment.DoesNotExist('Payment {} does not exist'.format(operation.payment_id))
+            _check_payment(payment, operation.operation, operation.amount)
+            _process_with_gateway(operation)
+        except GatewayUnavailable:
+            operation.status = Operation.PENDING
+        except (NetaxeptException, Payment.DoesNotExist) as e:
+            # Refused locally, netaxept was not invoked.
+            logger.error('netaxept-worker-error', operation_id=operation.id, exc_info=e)
+            operation.success = False
+            operation.response_text = (getattr(e, 'msg', None) or repr(e))[:255]
+        except Exception as e:
+            # The refusals of netaxept are already recorded on the operation. Without an answer netaxept may have
+            # run the operation, its success stays unknown (the error is in response_text).
+            if not isinstance(e, suds.WebFault):
+                logger.error('netaxept-worker-error', operation_id=operation.id, exc_info=e)
+
+
+# Async versions of the actions, for ASGI views and other coroutines.
+# The gateway calls run on a bounded thread pool (see gateway.get_executor) so that many of them can be in flight
+# at once, the database reads and writes go thru sync_to_async.
+
+
+async def aregister(order_number, amount, currency_code, redirect_url, description=None, auto_auth=False,
+                    merchant=gateway.DEFAULT_MERCHANT):
+    """
+    Same as `register`, but does not block the event loop.
+    """
+    payment = _new_payment(order_number, amount, currency_code, redirect_url, description, auto_auth, merchant)
+    registered_payment = await sync_to_async(_find_registration, thread_sensitive=True)(payment.idempotency_key)
+    if registered_payment:
+        return registered_payment
+    try:
+        await _run_in_gateway_executor(_register_with_gateway, payment)
+    except GatewayUnavailable:
+        raise
+    except Exception:
+        await sync_to_async(_save_registration, thread_sensitive=True)(payment)
+        raise
+    return await sync_to_async(_save_registration, thread_sensitive=True)(payment)
+
+
+async def asale(payment_id, deferred=None):
+    return await _arun_operation(payment_id, Operation.SALE, deferred=deferred)
+
+
+async def aauth(payment_id, deferred=None):
+    return await _arun_operation(payment_id, Operation.AUTH, deferred=deferred)
+
+
+async def acapture(payment_id, amount=None, deferred=None):
+    """
+    Same as `capture`, but does not block the event loop.
+    """
+    return await _arun_operation(payment_id, Operation.CAPTURE, amount, deferred)
+
+
+async def acredit(payment_id, amount=None, deferred=None):
+    """
+    Same as `credit`, but does not block the event loop.
+    """
+    return await _arun_operation(payment_id, Operation.CREDIT, amount, deferred)
+
+
+async def aannul(payment_id, deferred=None):
+    return await _arun_operation(payment_id, Operation.ANNUL, deferred=deferred)
+
+
+async def _arun_operation(payment_id, operation_type, amount=None, deferred=None):
+    _log_operation(payment_id, operation_type, amount)
+    payment = await sync_to_async(_get_payment, thread_sensitive=True)(payment_id)
+    operation = _build_operation(payment, operation_type, amount)
+    if gateway.DEFER_OPERATIONS if deferred is None else deferred:
+        operation.status = Operation.PENDING
+        await sync_to_async(_save, thread_sensitive=True)(operation)
+        return operation
+    # Like `_handle_operation`, the calls that never left are not recorded.
+    try:
+        await _run_in_gateway_executor(_process_with_gateway, operation)
+    except GatewayUnavailable:
+        raise
+    except BaseException:
+        await sync_to_async(_record, thread_sensitive=True)(operation)
+        raise
+    await sync_to_async(_record, thread_sensitive=True)(operation)
+    return operation
+
+
+def _run_in_gateway_executor(func, *args):
+    return asyncio.get_event_loop().run_in_executor(get_executor(), func, *args)
+
+
+def _new_payment(order_number, amount, currency_code, redirect_url, description, auto_auth, merchant):
+    logger.info('netaxept-register', order_number=order_number, amount=amount, currency_code=currency_code,
+                redirect_url=redirect_url, description=description, auto_auth=auto_auth, merchant=merchant)
+    return Payment(
+        merchant=merchant,
         amount=amount,
         currency_code=currency_code,
         order_number=order_number,
         description=description,
         redirect_url=redirect_url,
-        auto_auth=auto_auth
+        auto_auth=auto_auth,
+        idempotency_key='{}:{}:{}:{}'.format(merchant, order_number, amount, currency_code)
+        if gateway.REGISTER_IDEMPOTENCY_TTL else None,
     )
+
+
+def _find_registration(idempotency_key):
+    """
+    :return: The successful registration of the same order, if it is recent enough. It is taken from the cache
+             when possible, as it was when registered.
+    """
+    if not idempotency_key:
+        return None
+    payment = caches[gateway.CACHE].get(_registration_cache_key(idempotency_key))
+    if payment is None:
+        payment = Payment.objects \
+            .filter(idempotency_key=idempotency_key,
+                    created__gte=timezone.now() - timedelta(seconds=gateway.REGISTER_IDEMPOTENCY_TTL)) \
+            .first()
+    if payment:
+        logger.info('netaxept-register-deduplicated', payment_id=payment.id, idempotency_key=idempotency_key)
+    return payment
+
+
+def _save_registration(payment):
+    """
+    Save the payment. Only the first of concurrent registrations of the same order is kept, it is returned
+    to the others (their transactions are left unused at netaxept).
+    """
+    if not payment.success:
+        payment.idempotency_key = None
+    if not payment.idempotency_key:
+        _save(payment)
+        return payment
+    try:
+        with transaction.atomic():
+            # An expired registration of the same order gives up its key.
+            Payment.objects \
+                .filter(idempotency_key=payment.idempotency_key,
+                        created__lt=timezone.now() - timedelta(seconds=gateway.REGISTER_IDEMPOTENCY_TTL)) \
+                .update(idempotency_key=None)
+            _save(payment)
+    except IntegrityError:
+        first_payment = Payment.objects.filter(idempotency_key=payment.idempotency_key).first()
+        if first_payment is None:
+            raise
+        logger.info('netaxept-register-concurrent', payment_id=first_payment.id,
+                    idempotency_key=payment.idempotency_key, transaction_id=payment.transaction_id)
+        return first_payment
+    caches[gateway.CACHE].set(_registration_cache_key(payment.idempotency_key), payment,
+                              gateway.REGISTER_IDEMPOTENCY_TTL)
+    return payment
+
+
+def _registration_cache_key(idempotency_key):
+    return 'netaxept-register:{}'.format(idempotency_key)
+
+
+def _register_with_gateway(payment):
+    start = time.perf_counter()
     try:
         response = do_register(
             order_number=payment.order_number,
@@ -63,116 +554,229 @@ def register(order_number, amount, currency_code, redirect_url, description=None
             currency_code=payment.currency_code,
             description=payment.description,
             redirect_url=payment.redirect_url,
-            auto_auth=payment.auto_auth)
-        payment.transaction_id = response.TransactionId
+            auto_auth=payment.auto_auth,
+            merchant=payment.merchant)
+        payment.transaction_id = _text(response.TransactionId)
         payment.success = True
     except suds.WebFault as e:
         logger.error('netaxept-register', exc_info=e)
         _handle_response_exception(e, payment)
+    except GatewayUnavailable:
+        raise
+    except Exception as e:
+        # Without an answer the registration failed, its transaction (if netaxept created one) is left unused.
+        logger.error('netaxept-register', exc_info=e)
+        payment.success = False
+        payment.response_text = _text(repr(e), 255)
+        raise
     finally:
-        payment.save()
-    return payment
+        payment.gateway_duration = time.perf_counter() - start
 
 
-def sale(payment_id):
-    logger.info('netaxept-sale', payment_id=payment_id)
-    payment = Payment.objects.get(id=payment_id)
-    if not payment.success:
-        logger.error('netaxept-sale-payment-registration-not-complete')
-        raise PaymentRegistrationNotCompleted()
-    operation = Operation(
-        payment_id=payment_id,
-        transaction_id=payment.transaction_id,
-        operation=Operation.SALE,
-    )
-    _handle_operation(operation)
+def _run_operation(payment_id, operation_type, amount=None, deferred=None):
+    """
+    The pipeline shared by all operations: one narrow read of the payment (none if we're given the payment),
+    the gateway call, and the insert of the operation. Deferred operations are inserted without the gateway call.
+    """
+    _log_operation(payment_id, operation_type, amount)
+    operation = _build_operation(_get_payment(payment_id), operation_type, amount)
+    if gateway.DEFER_OPERATIONS if deferred is None else deferred:
+        operation.status = Operation.PENDING
+        _save(operation)
+    else:
+        _handle_operation(operation)
     return operation
 
 
-def auth(payment_id):
-    logger.info('netaxept-auth', payment_id=payment_id)
-    payment = Payment.objects.get(id=payment_id)
-    if not payment.success:
-        logger.error('netaxept-auth-payment-registration-not-complete')
-        raise PaymentRegistrationNotCompleted()
-    operation = Operation(
-        payment_id=payment_id,
-        transaction_id=payment.transaction_id,
-        operation=Operation.AUTH,
-    )
-    _handle_operation(operation)
-    return operation
+def _log_operation(payment_id, operation_type, amount):
+    logger.info('netaxept-{}'.format(operation_type.lower()),
+                payment_id=payment_id.pk if isinstance(payment_id, Payment) else payment_id, amount=amount)
 
 
-def capture(payment_id, amount=None):
+def _get_payment(payment_id):
     """
-    Capture the amount for an already authorized Payment.
+    :param payment_id: A payment id, or the payment itself.
+    :return: The payment, with at least the fields needed to build operations.
+    """
+    if isinstance(payment_id, Payment):
+        return payment_id
+    return Payment.objects.only(*PAYMENT_FIELDS).get(id=payment_id)
 
-    Assumes authorization occured previously (we cannot check in the database because sometimes pre-auth was used
-    and only nets knows the status of that).
 
-    :param payment_id: The id of a payment where registration and authorization were succesfully completed.
-    :param amount: An optional positive number, must not be larger than what remains on this payment.
-                   If parameter is absent, then the amount remaining on this payment will be captured.
-    :return: the operation
-    :raises SOAP exceptions
-    """
-    logger.info('netaxept-capture', payment_id=payment_id, amount=amount)
-    payment = Payment.objects.get(id=payment_id)
-    if not payment.success:
-        logger.error('netaxept-capture-payment-registration-not-complete')
-        raise PaymentRegistrationNotCompleted()
-    operation = Operation(
-        payment_id=payment_id,
+def _build_operation(payment, operation_type, amount=None):
+    _check_payment(payment, operation_type, amount)
+    return Operation(
+        payment_id=payment.id,
+        merchant=payment.merchant,
         transaction_id=payment.transaction_id,
-        operation=Operation.CAPTURE,
+        operation=operation_type,
         amount=amount,
     )
-    _handle_operation(operation)
-    return operation
 
 
-def credit(payment_id, amount=None):
-    """
-    Credit the amount for a payment that was either authd and captured, or sale'd.
+def _check_payment(payment, operation_type, amount):
+    if not payment.success:
+        logger.error('netaxept-{}-payment-registration-not-complete'.format(operation_type.lower()))
+        raise PaymentRegistrationNotCompleted()
+    _check_balance(payment, operation_type, amount)
 
-    Assumes capture or sale occured previously.
-    XXX: It is in fact possible to see those operations in the db, analyse if it's a good idea to pre-check.
 
-    :param payment_id: The id of a payment where money was already taken.
-    :param amount: An optional positive number, must not be larger than what remains on this payment.
-                   If parameter is absent, then the amount remaining on this payment will be credited.
-    :return: the operation
-    :raises SOAP exceptions
+def _check_balance(payment, operation_type, amount):
     """
-    logger.info('netaxept-credit', payment_id=payment_id, amount=amount)
-    payment = Payment.objects.get(id=payment_id)
-    if not payment.success:
-        logger.error('netaxept-credit-payment-registration-not-complete')
-        raise PaymentRegistrationNotCompleted()
-    operation = Operation(
-        payment_id=payment_id,
-        transaction_id=payment.transaction_id,
-        operation=Operation.CREDIT,
-        amount=amount,
-    )
-    _handle_operation(operation)
-    return operation
+    Refuse locally the operations that netaxept would refuse, according to the running totals of the payment.
+    """
+    error = None
+    if payment.state == Payment.ANNULLED:
+        error = PaymentAnnulled()
+    elif operation_type == Operation.CAPTURE:
+        if payment.capturable_amount <= 0:
+            error = AmountAlreadyCaptured()
+        elif amount and amount > payment.capturable_amount:
+            error = AmountExceedsRemaining()
+    elif operation_type == Operation.CREDIT:
+        if payment.creditable_amount <= 0:
+            error = NoAmountCaptured()
+        elif amount and amount > payment.creditable_amount:
+            error = AmountExceedsRemaining()
+    elif operation_type in (Operation.SALE, Operation.ANNUL) and payment.captured_amount:
+        error = AmountAlreadyCaptured()
+    if error:
+        logger.error('netaxept-{}-refused'.format(operation_type.lower()), payment_id=payment.id, amount=amount,
+                     error=error.msg)
+        raise error
 
 
 def _handle_operation(operation):
+    """
+    Invoke the gateway and record the operation, also when netaxept refused it or did not answer (it may have run
+    it anyway). The calls that never left (the circuit breaker is open, or the rate limit is reached) are not
+    recorded.
+    """
     try:
-        # XXX: Should read the response and not only rely on the REST exception.
-        do_process(
+        _process_with_gateway(operation)
+    except GatewayUnavailable:
+        raise
+    except BaseException:
+        _record(operation)
+        raise
+    _record(operation)
+
+
+def _process_with_gateway(operation):
+    start = time.perf_counter()
+    try:
+        response = do_process(
             transaction_id=operation.transaction_id,
             operation=operation.operation,
             amount=getattr(operation, 'amount', None),
+            merchant=operation.merchant,
         )
+        _read_process_response(response, operation)
         operation.success = True
     except suds.WebFault as e:
         _handle_response_exception(e, operation)
+    except GatewayUnavailable:
+        raise
+    except Exception as e:
+        # Without an answer the outcome is unknown, success stays None.
+        operation.response_text = _text(repr(e), 255)
+        raise
     finally:
-        operation.save()
+        operation.gateway_duration = time.perf_counter() - start
+
+
+def _read_process_response(response, operation):
+    """
+    Copy the values of the response to the operation, as plain strings and datetimes: nothing keeps a reference
+    to the suds objects.
+    """
+    operation.response_code = _text(getattr(response, 'ResponseCode', None), 3)
+    operation.response_source = _text(getattr(response, 'ResponseSource', None), 20)
+    operation.response_text = _text(getattr(response, 'ResponseText', None), 255)
+    operation.authorization_id = _text(getattr(response, 'AuthorizationId', None), 32)
+    operation.batch_number = _text(getattr(response, 'BatchNumber', None), 32)
+    operation.execution_time = _datetime(getattr(response, 'ExecutionTime', None))
+
+
+def _text(value, max_length=None):
+    return None if value is None else str(value)[:max_length]
+
+
+def _datetime(value):
+    if not isinstance(value, datetime):
+        return None
+    if settings.USE_TZ and timezone.is_naive(value):
+        return timezone.make_aware(value)
+    if not settings.USE_TZ and timezone.is_aware(value):
+        return timezone.make_naive(value)
+    return value
+
+
+def _record(operation):
+    with transaction.atomic(savepoint=False):
+        _save(operation)
+        _update_balances([operation])
+        _forget_statuses([operation])
+
+
+def _bulk_record(operation_type, operations):
+    with transaction.atomic(savepoint=False):
+        _bulk_save(operation_type, operations)
+        _update_balances(operations)
+        _forget_statuses(operations)
+
+
+def _update_balances(operations):
+    """
+    Add the successful operations to the running totals of their payments, with one update per kind of operation
+    and amount.
+    """
+    # The amounts of the operations of a kind on the same payment add up (a bulk can list a payment twice).
+    # Without an amount, what remains is taken whatever the other amounts are.
+    totals = {}  # type: dict
+    for operation in operations:
+        if operation.success:
+            key = (operation.operation, operation.payment_id)
+            if key not in totals:
+                totals[key] = operation.amount
+            elif totals[key] and operation.amount:
+                totals[key] += operation.amount
+            else:
+                totals[key] = None
+    payment_ids = defaultdict(list)
+    for (operation_type, payment_id), amount in totals.items():
+        payment_ids[(operation_type, amount)].append(payment_id)
+    for (operation_type, amount), ids in payment_ids.items():
+        Payment.objects.filter(pk__in=ids).update(**_balance_changes(operation_type, amount))
+
+
+def _balance_changes(operation_type, amount):
+    if operation_type == Operation.AUTH:
+        return dict(state=Payment.AUTHORIZED, authorized_amount=F('amount'))
+    elif operation_type == Operation.SALE:
+        return dict(state=Payment.CAPTURED, authorized_amount=F('amount'), captured_amount=F('amount'))
+    elif operation_type == Operation.CAPTURE:
+        # Without an amount, what remains is captured.
+        return dict(state=Payment.CAPTURED, captured_amount=F('captured_amount') + amount if amount else F('amount'))
+    elif operation_type == Operation.CREDIT:
+        return dict(state=Payment.CREDITED,
+                    credited_amount=F('credited_amount') + amount if amount else F('captured_amount'))
+    else:
+        return dict(state=Payment.ANNULLED)
+
+
+def _save(obj):
+    start = time.perf_counter()
+    obj.save()
+    signals.db_write.send(sender=type(obj), operation=getattr(obj, 'operation', 'REGISTER'),
+                          duration=time.perf_counter() - start, count=1)
+
+
+def _bulk_save(operation_type, operations):
+    start = time.perf_counter()
+    Operation.objects.bulk_create(operations)
+    signals.db_write.send(sender=Operation, operation=operation_type, duration=time.perf_counter() - start,
+                          count=len(operations))
 
 
 def _handle_response_exception(exception, obj):
@@ -181,10 +785,10 @@ def _handle_response_exception(exception, obj):
     bbsexception = getattr(exception.fault.detail, 'BBSException', None)
     if bbsexception:
         result = bbsexception.Result
-        obj.response_code = str(result.ResponseCode)
-        obj.response_source = result.ResponseSource
-        obj.response_text = result.ResponseText
-        obj.message = bbsexception.Message  # XXX: I think we're currently not saving this to the db.
+        obj.response_code = _text(result.ResponseCode, 3)
+        obj.response_source = _text(result.ResponseSource, 20)
+        obj.response_text = _text(result.ResponseText, 255)
+        obj.response_message = _text(bbsexception.Message, 255)
     else:
-        obj.response_text = exception.fault.detail[0].Message
+        obj.response_text = _text(exception.fault.detail[0].Message, 255)
     raise exception
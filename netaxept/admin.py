@@ -1,14 +1,19 @@
 from django.conf.urls import url
 from django.contrib import admin
-from django.db.models import Prefetch
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.forms import forms, IntegerField
 from django.http import HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
+from django.utils.functional import cached_property
 from django.utils.html import format_html
 
 from . import actions
-from .models import Payment, Operation
+from .models import Payment, Operation, ArchivedPayment, ArchivedOperation
 
 
 def link_to_payment(obj):
@@ -26,10 +31,11 @@ link_to_payment.short_description = 'Payment'  # type: ignore
 @admin.register(Operation)
 class OperationAdmin(admin.ModelAdmin):
     date_hierarchy = 'created'
-    list_display = ['created', 'success', 'operation', 'amount', 'response_code', 'response_source', 'response_text',
-                    link_to_payment]
+    list_display = ['created', 'status', 'success', 'operation', 'amount', 'response_code', 'response_source',
+                    'response_text', link_to_payment]
     search_fields = ['transaction_id', 'amount']
-    list_filter = ['success', 'operation']
+    list_filter = ['status', 'success', 'operation']
+    list_select_related = ['payment']
 
     readonly_fields = ['created', 'modified', link_to_payment]
 
@@ -37,15 +43,84 @@ class OperationAdmin(admin.ModelAdmin):
 class OperationInline(admin.TabularInline):
     model = Operation
     ordering = ['-created']
-    fields = readonly_fields = ['created', 'success', 'operation', 'amount', 'response_code', 'response_source',
-                                'response_text']
+    fields = readonly_fields = ['created', 'status', 'success', 'operation', 'amount', 'response_code',
+                                'response_source', 'response_text']
     show_change_link = True
     can_delete = False
     extra = 0
 
 
 def operation_count(payment):
-    return payment.operations.count()
+    return payment.operation_count
+
+
+operation_count.short_description = 'Operation count'  # type: ignore
+
+
+def last_operation(payment):
+    return payment.last_operation or '-'
+
+
+last_operation.short_description = 'Last operation'  # type: ignore
+
+
+def last_operation_success(payment):
+    return payment.last_operation_success
+
+
+last_operation_success.boolean = True  # type: ignore
+last_operation_success.short_description = 'Last operation success'  # type: ignore
+
+
+def annotate_operations(payments):
+    operations = Operation.objects.filter(payment=OuterRef('pk')).order_by()
+    last_operations = operations.order_by('-created', '-id')
+    return payments.annotate(
+        operation_count=Coalesce(Subquery(
+            operations.values('payment').annotate(count=Count('*')).values('count')), 0),
+        last_operation=Subquery(last_operations.values('operation')[:1]),
+        last_operation_success=Subquery(last_operations.values('success')[:1]))
+
+
+class PaymentChangeList(ChangeList):
+    """
+    The operations are summarized for the payments of the page only, so that counting the payments
+    (or computing the date hierarchy) does not touch the operations.
+    """
+
+    def get_results(self, request):
+        super().get_results(request)
+        self.result_list = annotate_operations(self.result_list)
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Counting all the rows of a big table is slow on PostgreSQL. When the changelist is not filtered the count
+    is taken from the table statistics instead, as long as they say the table is big.
+    """
+    estimate_threshold = 100000
+
+    @cached_property
+    def count(self):
+        estimated_count = self._estimated_count()
+        if estimated_count is None:
+            return super().count
+        return estimated_count
+
+    def _estimated_count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is None or query.where:
+            return None
+        connection = connections[self.object_list.db]
+        if connection.vendor != 'postgresql':
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                           [self.object_list.model._meta.db_table])
+            row = cursor.fetchone()
+        if row is None or row[0] < self.estimate_threshold:
+            return None
+        return int(row[0])
 
 
 class AuthPaymentForm(forms.Form):
@@ -57,8 +132,7 @@ def auth_payment_form(request, payment_id):
     if request.method == 'POST':
         form = AuthPaymentForm(request.POST)
         if form.is_valid():
-            result = actions.auth(
-                payment_id=payment_id)
+            result = actions.auth(payment)
             # As confirmation we take the user to the edit page of the auth operation.
             return HttpResponseRedirect(reverse('admin:netaxept_operation_change', args=[result.id]))
     else:
@@ -86,7 +160,7 @@ def capture_payment_form(request, payment_id):
         form = CapturePaymentForm(request.POST)
         if form.is_valid():
             result = actions.capture(
-                payment_id=payment_id,
+                payment,
                 amount=form.cleaned_data['amount'])
             # As confirmation we take the user to the edit page of the capture operation.
             return HttpResponseRedirect(reverse('admin:netaxept_operation_change', args=[result.id]))
@@ -115,7 +189,7 @@ def credit_payment_form(request, payment_id):
         form = CreditPaymentForm(request.POST)
         if form.is_valid():
             result = actions.credit(
-                payment_id=payment_id,
+                payment,
                 amount=form.cleaned_data['amount'])
             # As confirmation we take the user to the edit page of the credit operation.
             return HttpResponseRedirect(reverse('admin:netaxept_operation_change', args=[result.id]))
@@ -136,17 +210,21 @@ def credit_payment_form(request, payment_id):
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
     date_hierarchy = 'created'
-    list_display = ['created', 'success', 'amount', 'currency_code', 'order_number', 'description', 'redirect_url',
-                    'transaction_id', operation_count]
+    list_display = ['created', 'merchant', 'success', 'state', 'amount', 'currency_code', 'order_number',
+                    'description', 'redirect_url', 'transaction_id', operation_count, last_operation,
+                    last_operation_success]
     search_fields = ['transaction_id', 'order_number', 'amount', 'description']
-    list_filter = ['success', 'currency_code']
+    list_filter = ['success', 'state', 'currency_code']
 
-    readonly_fields = ['created', 'modified', 'auth_button', 'capture_button', 'credit_button']
+    readonly_fields = ['created', 'modified', 'state', 'authorized_amount', 'captured_amount', 'credited_amount',
+                       'auth_button', 'capture_button', 'credit_button']
     inlines = [OperationInline]
 
-    def get_queryset(self, request):
-        return super().get_queryset(request) \
-            .prefetch_related(Prefetch('operations'))
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return PaymentChangeList
 
     def get_urls(self):
         urls = super().get_urls()
@@ -195,3 +273,35 @@ class PaymentAdmin(admin.ModelAdmin):
             return '-'
 
     credit_button.short_description = 'Credit'  # type: ignore
+
+
+class ReadOnlyMixin:
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class ArchivedOperationInline(ReadOnlyMixin, admin.TabularInline):
+    model = ArchivedOperation
+    ordering = ['-created']
+    fields = readonly_fields = ['created', 'success', 'operation', 'amount', 'response_code', 'response_source',
+                                'response_text']
+    extra = 0
+
+
+@admin.register(ArchivedPayment)
+class ArchivedPaymentAdmin(ReadOnlyMixin, admin.ModelAdmin):
+    date_hierarchy = 'created'
+    list_display = ['created', 'merchant', 'success', 'state', 'amount', 'currency_code', 'order_number',
+                    'description', 'transaction_id', 'archived']
+    search_fields = ['transaction_id', 'order_number', 'amount', 'description']
+    list_filter = ['success', 'state', 'currency_code']
+    inlines = [ArchivedOperationInline]
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class NetaxeptConfig(AppConfig):
     name = 'netaxept'
     verbose_name = 'Netaxept'
+
+    def ready(self):
+        if getattr(settings, 'NETAXEPT_METRICS', False):
+            from . import metrics
+            metrics.connect()
+        from . import gateway
+        if gateway.WARM_UP:
+            gateway.warm_up()
@@ -0,0 +1,30 @@
+"""
+Gateway backends.
+
+A backend is a class with three methods, mirroring the netaxept operations:
+
+- `register(order_number, amount, currency_code, description, redirect_url, auto_auth)`
+  returns an object with a `TransactionId` attribute.
+- `process(transaction_id, operation, amount=None)` returns the process response.
+- `query(transaction_id)` returns the query response (a PaymentInfo, with its `OrderInformation` and `Summary`).
+
+They raise `suds.WebFault` when netaxept refuses the request. The backend is chosen with the `NETAXEPT_BACKEND`
+setting, and is instantiated with the keyword arguments of the `NETAXEPT_BACKEND_OPTIONS` setting. The merchants of
+`NETAXEPT_MERCHANTS` each get their own backend, instantiated with the `merchant` keyword argument as well
+(a `gateway.Merchant`).
+
+A backend can also have a `warm_up()` method, called when the app is ready if `NETAXEPT_WARM_UP` is set, to do its
+expensive setup before the first call.
+"""
+from types import SimpleNamespace
+
+import suds
+
+
+def bbs_exception(response_code, response_text, message=None, response_source='Netaxept'):
+    """
+    Return a fault shaped like the BBSException that netaxept raises when it refuses a request.
+    """
+    result = SimpleNamespace(ResponseCode=response_code, ResponseSource=response_source, ResponseText=response_text)
+    detail = SimpleNamespace(BBSException=SimpleNamespace(Message=message, Result=result))
+    return suds.WebFault(SimpleNamespace(faultcode='s:Client', faultstring=message, detail=detail), None)
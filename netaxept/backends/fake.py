@@ -0,0 +1,125 @@
+"""
+An in-process stand-in for netaxept, for tests and offline load tests.
+
+Enable it with:
+
+    NETAXEPT_BACKEND = 'netaxept.backends.fake.FakeBackend'
+    NETAXEPT_BACKEND_OPTIONS = {'latency': 0.2, 'error_rate': 0.01}
+
+It keeps the state of the transactions it registered, and refuses operations that netaxept would refuse
+(like capturing more than what was authorized). Operations on transactions it does not know are accepted as-is,
+but they cannot be queried.
+"""
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+
+from . import bbs_exception
+
+
+class FakeBackend:
+    """
+    :param latency: The average time (in seconds) that every call takes.
+    :param latency_jitter: Calls take a random time between latency - jitter and latency + jitter.
+    :param error_rate: The probability (between 0 and 1) that a call is refused with a BBSException.
+    :param seed: To make the random latencies and errors reproducible.
+    :param merchant: The `gateway.Merchant` of the calls (the transactions of each merchant are kept apart).
+    """
+
+    def __init__(self, latency=0.0, latency_jitter=0.0, error_rate=0.0, seed=None, merchant=None):
+        self.merchant = merchant
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._transactions = {}  # type: dict
+
+    def register(self, order_number, amount, currency_code, description, redirect_url, auto_auth):
+        self._simulate_call()
+        transaction_id = uuid.uuid4().hex
+        with self._lock:
+            # We pretend the user immediately completes the terminal pages.
+            self._transactions[transaction_id] = SimpleNamespace(
+                order_number=order_number, amount=amount, currency_code=currency_code, authorized=auto_auth,
+                captured=0, credited=0, annulled=False)
+        return SimpleNamespace(TransactionId=transaction_id)
+
+    def process(self, transaction_id, operation, amount=None):
+        self._simulate_call()
+        with self._lock:
+            transaction = self._transactions.get(transaction_id)
+            if transaction is not None:
+                _apply(transaction, operation, amount)
+        return SimpleNamespace(
+            Operation=operation,
+            ResponseCode='OK',
+            ResponseSource=None,
+            ResponseText=None,
+            TransactionId=transaction_id,
+            AuthorizationId='123456' if operation in ('AUTH', 'SALE') else None,
+            BatchNumber=None,
+            ExecutionTime=datetime.now(),
+            MerchantId=None)
+
+    def query(self, transaction_id):
+        self._simulate_call()
+        with self._lock:
+            transaction = self._transactions.get(transaction_id)
+            if transaction is None:
+                raise bbs_exception('25', 'Transaction not found', 'Unable to find transaction')
+            transaction = SimpleNamespace(**vars(transaction))
+        return SimpleNamespace(
+            MerchantId=None,
+            QueryFinished=datetime.now(),
+            TransactionId=transaction_id,
+            OrderInformation=SimpleNamespace(
+                Amount=str(transaction.amount),
+                Currency=transaction.currency_code,
+                OrderNumber=transaction.order_number),
+            Summary=SimpleNamespace(
+                AmountCaptured=str(transaction.captured),
+                AmountCredited=str(transaction.credited),
+                Annulled=transaction.annulled,
+                AuthorizationId='123456' if transaction.authorized else None,
+                Authorized=transaction.authorized))
+
+    def _simulate_call(self):
+        with self._lock:
+            latency = self.latency + self._random.uniform(-self.latency_jitter, self.latency_jitter)
+            refused = self._random.random() < self.error_rate
+        if latency > 0:
+            time.sleep(latency)
+        if refused:
+            raise bbs_exception('99', 'Auth Reg Comp Failure (Simulated)', 'Simulated error')
+
+
+def _apply(transaction, operation, amount):
+    if transaction.annulled:
+        raise bbs_exception('98', 'Transaction already processed', 'Transaction is annulled')
+    if operation == 'AUTH':
+        transaction.authorized = True
+    elif operation == 'SALE':
+        transaction.authorized = True
+        transaction.captured = transaction.amount
+    elif operation == 'CAPTURE':
+        remaining = transaction.amount - transaction.captured
+        if not transaction.authorized:
+            raise bbs_exception('99', 'Transaction not authorized', 'Unable to capture')
+        if remaining <= 0:
+            raise bbs_exception('98', 'Transaction already processed', 'Nothing left to capture')
+        if amount and amount > remaining:
+            raise bbs_exception('99', 'Amount exceeds remaining amount', 'Unable to capture')
+        transaction.captured += amount or remaining
+    elif operation == 'CREDIT':
+        remaining = transaction.captured - transaction.credited
+        if remaining <= 0 or (amount and amount > remaining):
+            raise bbs_exception('99', 'Amount exceeds captured amount', 'Unable to credit')
+        transaction.credited += amount or remaining
+    elif operation == 'ANNUL':
+        if transaction.captured:
+            raise bbs_exception('98', 'Transaction already processed', 'Unable to annul')
+        transaction.annulled = True
@@ -0,0 +1,248 @@
+"""
+The real backend, it talks to netaxept thru suds.
+
+suds is only used to render every kind of request once (see `RequestTemplate`) and to parse the replies,
+the requests themselves are filled in from the templates.
+"""
+import copy
+import re
+import threading
+import time
+from xml.sax.saxutils import escape
+
+from suds import tostr
+from suds.cache import ObjectCache
+from suds.client import Client, ServiceSelector, _SoapClient
+from suds.options import Options
+from suds.properties import Unskin
+from suds.transport import Request, TransportError
+
+from .. import gateway, signals
+from ..transport import RequestsTransport, get_session
+
+
+class SoapBackend:
+    """
+    :param merchant: The `gateway.Merchant` of the calls, by default the account of the NETAXEPT_MERCHANTID setting.
+    """
+
+    def __init__(self, merchant=None):
+        self.merchant = merchant
+        self._shared_client = None
+        self._shared_client_lock = threading.Lock()
+        self._thread_local = threading.local()
+        self._templates = {}
+
+    def register(self, order_number, amount, currency_code, description, redirect_url, auto_auth):
+        merchant = self._get_merchant()
+        return self._invoke('Register', _build_register_request, {
+            'merchant_id': merchant.merchant_id, 'token': merchant.token, 'order_number': order_number,
+            'amount': amount, 'currency_code': currency_code, 'description': description,
+            'redirect_url': redirect_url, 'auto_auth': auto_auth})
+
+    def process(self, transaction_id, operation, amount=None):
+        merchant = self._get_merchant()
+        return self._invoke('Process', _build_process_request, {
+            'merchant_id': merchant.merchant_id, 'token': merchant.token, 'transaction_id': transaction_id,
+            'operation': operation, 'amount': amount or None})
+
+    def query(self, transaction_id):
+        merchant = self._get_merchant()
+        return self._invoke('Query', _build_query_request, {
+            'merchant_id': merchant.merchant_id, 'token': merchant.token, 'transaction_id': transaction_id})
+
+    def _invoke(self, operation, build_request, values):
+        client = self._get_client()
+        template = self._get_template(operation, build_request, values)
+        return _send(client, template.method, template.render(values))
+
+    def _get_template(self, operation, build_request, values):
+        """
+        Return the template of the request, there is one per operation and per set of fields left empty
+        (suds leaves the empty fields out of the requests).
+        """
+        key = (operation, frozenset(name for name, value in values.items() if value is None))
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = RequestTemplate.render_with_suds(
+                self._get_shared_client(), operation, build_request, values)
+        return template
+
+    def warm_up(self):
+        self._get_shared_client()
+
+    def _get_merchant(self):
+        return self.merchant or gateway.get_merchant()
+
+    def _get_client(self):
+        """
+        Return the client of the current thread.
+
+        The wsdl is parsed only once per process, each thread then gets a cheap clone that shares the parsed wsdl
+        but has its own options (suds clients are not thread safe).
+        """
+        shared_client = self._get_shared_client()
+        if getattr(self._thread_local, 'shared_client', None) is not shared_client:
+            self._thread_local.client = _clone(shared_client)
+            self._thread_local.shared_client = shared_client
+        return self._thread_local.client
+
+    def _get_shared_client(self):
+        shared_client = self._shared_client
+        if shared_client is None:
+            with self._shared_client_lock:
+                if self._shared_client is None:
+                    start = time.perf_counter()
+                    merchant = self._get_merchant()
+                    self._shared_client = Client(
+                        merchant.wsdl,
+                        faults=True,
+                        cache=ObjectCache(location=gateway.WSDL_CACHE_LOCATION, days=gateway.WSDL_CACHE_DAYS),
+                        transport=_get_transport(merchant.name))
+                    signals.wsdl_loaded.send(sender=type(self), duration=time.perf_counter() - start)
+                shared_client = self._shared_client
+        return shared_client
+
+
+class RequestTemplate:
+    """
+    A request rendered once by suds, with placeholders in place of the values of the fields.
+
+    Rendering a request then only escapes and joins the values, instead of creating the suds objects from the
+    schema and marshalling them.
+    """
+    placeholder = '__netaxept_{}__'
+    placeholder_re = re.compile(rb'__netaxept_(\w+?)__')
+
+    def __init__(self, method, envelope):
+        self.method = method
+        parts = self.placeholder_re.split(envelope)
+        # The literal parts are at the even positions, the names of the fields at the odd ones.
+        self.parts = [(literal, field.decode('ascii') if field else None)
+                      for literal, field in zip(parts[::2], parts[1::2] + [None])]
+
+    @classmethod
+    def render_with_suds(cls, client, operation, build_request, values):
+        client = _clone(client)
+        client.options.nosend = True
+        placeholders = {name: None if value is None else cls.placeholder.format(name)
+                        for name, value in values.items()}
+        request = build_request(client, placeholders)
+        service_method = getattr(client.service, operation)
+        context = service_method(placeholders['merchant_id'], placeholders['token'], request)
+        return cls(service_method.method, context.envelope)
+
+    def render(self, values):
+        chunks = []
+        for literal, field in self.parts:
+            chunks.append(literal)
+            if field is not None:
+                chunks.append(_xml_text(values[field]))
+        return b''.join(chunks)
+
+
+def _xml_text(value):
+    return escape(str(value), {'"': '&quot;', "'": '&apos;'}).encode('utf-8')
+
+
+def _send(client, method, envelope):
+    """
+    Send a rendered request the way suds does, and let suds parse the reply.
+    """
+    soap_client = _SoapClient(client, method)
+    request = Request(Unskin(client.options).get('location', method.location), envelope)
+    request.headers = {'Content-Type': 'text/xml; charset=utf-8', 'SOAPAction': method.soap.action.encode('utf-8')}
+    request.headers.update(client.options.headers)
+    try:
+        reply = client.options.transport.send(request)
+    except TransportError as e:
+        # Faults come with a 500, the other errors (like a 503 when netaxept is unavailable) are raised as they are,
+        # suds would turn them into a bare Exception that gateway.is_retryable cannot recognize.
+        if e.httpcode != 500:
+            raise
+        content = e.fp and e.fp.read() or ''
+        return soap_client.process_reply(content, e.httpcode, tostr(e))
+    return soap_client.process_reply(reply.message, None, None)
+
+
+def _clone(client):
+    """
+    Like Client.clone, but the options are copied shallowly (the cache and the connection pool are shared).
+    Client.clone deep-copies the options, which overflows the recursion limit on recent pythons.
+    """
+    clone = copy.copy(client)
+    clone.options = Options()
+    options = dict(Unskin(client.options).defined)
+    options['transport'] = client.options.transport.clone()
+    Unskin(clone.options).update(options)
+    clone.service = ServiceSelector(clone, client.wsdl.services)
+    return clone
+
+
+def _get_transport(merchant=gateway.DEFAULT_MERCHANT):
+    return RequestsTransport(
+        session=get_session(pool_maxsize=gateway.HTTP_POOL_MAXSIZE, name=merchant),
+        timeout=(gateway.CONNECT_TIMEOUT, gateway.READ_TIMEOUT),
+        operation_timeouts=gateway.OPERATION_TIMEOUTS)
+
+
+def _get_netaxept_object(client, obj):
+    return client.factory.create('ns1:%s' % obj)
+
+
+def _get_basic_register_request(client, redirecturl, language, auto_auth):
+    """
+    Return a basic register request without order
+    """
+    environment = _get_netaxept_object(client, 'Environment')
+    environment.Language = None
+    environment.OS = None
+    environment.WebServicePlatform = 'SUDS'
+
+    terminal = _get_netaxept_object(client, 'Terminal')
+    terminal.AutoAuth = auto_auth
+    terminal.Language = language
+    terminal.OrderDescription = None
+    terminal.RedirectOnError = None
+    terminal.RedirectUrl = redirecturl
+
+    request = _get_netaxept_object(client, 'RegisterRequest')
+    request.AvtaleGiro = None
+    request.CardInfo = None
+    request.Customer = None
+    request.DnBNorDirectPayment = None
+    request.Environment = environment
+    request.ServiceType = None
+    request.Terminal = terminal
+    request.Recurring = None
+
+    return request
+
+
+def _build_register_request(client, values):
+    request = _get_basic_register_request(
+        client, values['redirect_url'], language=None, auto_auth=values['auto_auth'])
+
+    order = _get_netaxept_object(client, 'Order')
+    order.OrderNumber = values['order_number']
+    order.Amount = values['amount']
+    order.CurrencyCode = values['currency_code']
+    order.UpdateStoredPaymentInfo = None
+
+    request.Order = order
+    request.Description = values['description']
+    return request
+
+
+def _build_process_request(client, values):
+    request = _get_netaxept_object(client, 'ProcessRequest')
+    request.Operation = values['operation']
+    request.TransactionId = values['transaction_id']
+    request.TransactionAmount = values['amount']
+    return request
+
+
+def _build_query_request(client, values):
+    request = _get_netaxept_object(client, 'QueryRequest')
+    request.TransactionId = values['transaction_id']
+    return request
@@ -1,6 +1,25 @@
-import requests
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import NamedTuple
+from urllib.parse import urlencode, urlsplit
+
 from django.conf import settings
-from suds.client import Client
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from structlog import get_logger
+
+from . import signals
+
+logger = get_logger()
+
+# See netaxept.backends
+BACKEND = getattr(settings, 'NETAXEPT_BACKEND', 'netaxept.backends.soap.SoapBackend')
+BACKEND_OPTIONS = getattr(settings, 'NETAXEPT_BACKEND_OPTIONS', {})
+# The backend (and the SOAP stack) is loaded on the first call to netaxept, or when the app is ready if WARM_UP.
+WARM_UP = getattr(settings, 'NETAXEPT_WARM_UP', False)
 
 MERCHANTID = getattr(settings, 'NETAXEPT_MERCHANTID', '')
 TOKEN = getattr(settings, 'NETAXEPT_TOKEN', '')
@@ -8,71 +27,471 @@ TOKEN = getattr(settings, 'NETAXEPT_TOKEN', '')
 WSDL = getattr(settings, 'NETAXEPT_WSDL', 'https://epayment-test.bbs.no/netaxept.svc?wsdl')
 TERMINAL = getattr(settings, 'NETAXEPT_TERMINAL', 'https://epayment-test.bbs.no/Terminal/default.aspx')
 
+# The other merchant accounts, by name, for instance {'shop-b': {'MERCHANTID': '...', 'TOKEN': '...'}} (WSDL and
+# TERMINAL default to the settings above). The account of MERCHANTID and TOKEN has no name.
+MERCHANTS = getattr(settings, 'NETAXEPT_MERCHANTS', {})
+# The dotted path of a function that returns the settings of the merchants that are not in MERCHANTS (in the same
+# form), for instance from a model of the project, or None when there is no such merchant.
+MERCHANT_LOADER = getattr(settings, 'NETAXEPT_MERCHANT_LOADER', None)
+
+# The parsed wsdl is pickled to disk, so that new processes don't have to download and parse it again.
+WSDL_CACHE_LOCATION = getattr(settings, 'NETAXEPT_WSDL_CACHE_LOCATION', None)
+WSDL_CACHE_DAYS = getattr(settings, 'NETAXEPT_WSDL_CACHE_DAYS', 1)
+
+# Connections to netaxept are kept alive and reused, at most HTTP_POOL_MAXSIZE of them at once.
+HTTP_POOL_MAXSIZE = getattr(settings, 'NETAXEPT_HTTP_POOL_MAXSIZE', 10)
+# In seconds. OPERATION_TIMEOUTS overrides the timeouts per SOAP operation, for instance {'Process': (5, 60)}
+CONNECT_TIMEOUT = getattr(settings, 'NETAXEPT_CONNECT_TIMEOUT', 5)
+READ_TIMEOUT = getattr(settings, 'NETAXEPT_READ_TIMEOUT', 30)
+OPERATION_TIMEOUTS = getattr(settings, 'NETAXEPT_OPERATION_TIMEOUTS', {})
+
+# The async actions run at most this many gateway calls at once.
+ASYNC_MAX_WORKERS = getattr(settings, 'NETAXEPT_ASYNC_MAX_WORKERS', HTTP_POOL_MAXSIZE)
+
+# Operations are enqueued instead of run right away, for the netaxept_worker command to run them
+# (unless the actions are told otherwise with their `deferred` argument).
+DEFER_OPERATIONS = getattr(settings, 'NETAXEPT_DEFER_OPERATIONS', False)
+
+# The alias, in django's CACHES, of a cache shared by all the processes.
+CACHE = getattr(settings, 'NETAXEPT_CACHE', 'default')
+
+# Registering the same order (order number, amount and currency) again within this many seconds returns the
+# payment of the first registration, netaxept is not invoked again. 0 turns it off.
+REGISTER_IDEMPOTENCY_TTL = getattr(settings, 'NETAXEPT_REGISTER_IDEMPOTENCY_TTL', 600)
+
+# The status of a transaction queried from netaxept is cached for this many seconds (or until an operation on it
+# is recorded). 0 turns it off.
+QUERY_CACHE_TTL = getattr(settings, 'NETAXEPT_QUERY_CACHE_TTL', 30)
+
+# Failed calls are attempted again, at most RETRY_ATTEMPTS times in all, after a random delay of up to
+# RETRY_BACKOFF, then twice that, and so on. There are no more attempts once RETRY_DEADLINE seconds have passed.
+RETRY_ATTEMPTS = getattr(settings, 'NETAXEPT_RETRY_ATTEMPTS', 3)
+RETRY_BACKOFF = getattr(settings, 'NETAXEPT_RETRY_BACKOFF', 0.1)
+RETRY_DEADLINE = getattr(settings, 'NETAXEPT_RETRY_DEADLINE', 10)
+
+# After BREAKER_FAILURES failed calls in a row (with no successful call in between, over all the processes) within
+# BREAKER_RESET_TIMEOUT seconds, the calls fail immediately for BREAKER_RESET_TIMEOUT seconds, then a single call is
+# let thru to find out whether netaxept recovered.
+BREAKER_FAILURES = getattr(settings, 'NETAXEPT_BREAKER_FAILURES', 5)
+BREAKER_RESET_TIMEOUT = getattr(settings, 'NETAXEPT_BREAKER_RESET_TIMEOUT', 30)
+
+# The priorities of the calls to netaxept: the interactive ones are on the checkout path, the batch ones are run
+# by the settlement, the reconciliation and the workers.
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+
+# At most RATE_LIMIT calls to netaxept per second, counted over all the processes sharing the CACHE. None turns it
+# off. Batch calls leave RATE_LIMIT_INTERACTIVE_RESERVE (a share of RATE_LIMIT) to the interactive calls, and use
+# what is left. The calls wait at most RATE_LIMIT_MAX_WAIT seconds (per priority) before failing with RateLimited.
+RATE_LIMIT = getattr(settings, 'NETAXEPT_RATE_LIMIT', None)
+RATE_LIMIT_INTERACTIVE_RESERVE = getattr(settings, 'NETAXEPT_RATE_LIMIT_INTERACTIVE_RESERVE', 0.2)
+RATE_LIMIT_MAX_WAIT = getattr(settings, 'NETAXEPT_RATE_LIMIT_MAX_WAIT', {INTERACTIVE: 1, BATCH: 60})
+# The priority of each operation, the operations that are not listed are interactive.
+RATE_LIMIT_PRIORITIES = getattr(settings, 'NETAXEPT_RATE_LIMIT_PRIORITIES', {
+    'REGISTER': INTERACTIVE, 'SALE': INTERACTIVE, 'AUTH': INTERACTIVE,
+    'CAPTURE': BATCH, 'CREDIT': BATCH, 'ANNUL': BATCH, 'QUERY': BATCH,
+})
+
+DEFAULT_MERCHANT = ''
+
+_backend = None
+_backend_lock = threading.Lock()
+# The backends, the rate limiters and the settings of the named merchants.
+_merchant_backends = {}  # type: dict
+_merchant_rate_limiters = {}  # type: dict
+_merchants = {}  # type: dict
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class Merchant(NamedTuple):
+    name: str
+    merchant_id: str
+    token: str
+    wsdl: str
+    terminal: str
+
+
+class UnknownMerchant(Exception):
+    """
+    Raised for a merchant that is neither in NETAXEPT_MERCHANTS, nor found by NETAXEPT_MERCHANT_LOADER.
+    """
+
+
+def get_merchant(name=DEFAULT_MERCHANT):
+    """
+    Return the merchant account named `name`, by default the account of the MERCHANTID and TOKEN settings.
+    """
+    if not name:
+        return Merchant(DEFAULT_MERCHANT, MERCHANTID, TOKEN, WSDL, TERMINAL)
+    merchant = _merchants.get(name)
+    if merchant is None:
+        config = MERCHANTS.get(name)
+        if config is None and MERCHANT_LOADER:
+            config = import_string(MERCHANT_LOADER)(name)
+        if config is None:
+            raise UnknownMerchant('Unknown netaxept merchant: {}'.format(name))
+        merchant = _merchants[name] = Merchant(
+            name, config['MERCHANTID'], config['TOKEN'], config.get('WSDL', WSDL), config.get('TERMINAL', TERMINAL))
+    return merchant
+
+
+class GatewayUnavailable(Exception):
+    """
+    Raised instead of calling netaxept, while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops the calls to netaxept while it is failing, so that requests don't pile up waiting for it.
+
+    The state is kept in the django cache, to be shared by all the processes: the number of recent failures,
+    the time when the breaker opened, and whether a process is probing netaxept (the breaker is half-open).
+    Only errors where netaxept did not answer count as failures, not the refusals of netaxept, and a successful call
+    starts the count again: scattered failures among successful calls don't open the breaker.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold, reset_timeout, cache_alias):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.cache_alias = cache_alias
+        self._failures_key = 'netaxept-breaker:{}:failures'.format(name)
+        self._opened_key = 'netaxept-breaker:{}:opened'.format(name)
+        self._probe_key = 'netaxept-breaker:{}:probe'.format(name)
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def state(self):
+        opened = self.cache.get(self._opened_key)
+        if opened is None:
+            return self.CLOSED
+        if time.time() - opened < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def before_call(self):
+        """
+        :return: True if the call is the one probing netaxept while the breaker is half-open.
+        :raises GatewayUnavailable: While the breaker is open, or when another process is probing netaxept.
+        """
+        state = self.state()
+        if state == self.CLOSED:
+            return False
+        if state == self.HALF_OPEN and self.cache.add(self._probe_key, True, self.reset_timeout):
+            return True
+        raise GatewayUnavailable('Netaxept is unavailable, the circuit breaker is {}'.format(state))
+
+    def record_success(self, probe):
+        if probe:
+            self.cache.delete_many([self._opened_key, self._probe_key, self._failures_key])
+            self._changed(self.CLOSED)
+        else:
+            self.cache.delete(self._failures_key)
+
+    def record_failure(self, probe):
+        """
+        :return: True if the breaker is open.
+        """
+        if probe:
+            self.cache.set(self._opened_key, time.time(), None)
+            self.cache.delete(self._probe_key)
+            self._changed(self.OPEN)
+            return True
+        self.cache.add(self._failures_key, 0, self.reset_timeout)
+        try:
+            failures = self.cache.incr(self._failures_key)
+        except ValueError:  # Expired in the meantime
+            failures = 1
+        if failures < self.failure_threshold:
+            return False
+        if self.cache.add(self._opened_key, time.time(), None):
+            self.cache.delete(self._failures_key)
+            self._changed(self.OPEN)
+        return True
+
+    def _changed(self, state):
+        logger.warning('netaxept-circuit-breaker', state=state)
+        signals.circuit_breaker.send(sender=type(self), state=state)
+
+
+breaker = CircuitBreaker('gateway', BREAKER_FAILURES, BREAKER_RESET_TIMEOUT, CACHE)
 
-def do_register(order_number, amount, currency_code, description, redirect_url, auto_auth):
-    client = _get_client()
-    request = _get_basic_register_request(client, redirect_url, language=None, auto_auth=auto_auth)
 
-    order = _get_netaxept_object(client, 'Order')
-    order.OrderNumber = order_number
-    order.Amount = amount
-    order.CurrencyCode = currency_code
-    order.UpdateStoredPaymentInfo = None
+class RateLimited(GatewayUnavailable):
+    """
+    Raised instead of calling netaxept, when the rate limit left no capacity for the call in time.
+    """
+
+
+class SharedRateLimiter:
+    """
+    Limits the calls to netaxept to `rate` per second, counted over all the processes sharing the django cache.
+
+    Every second has a bucket of `rate` tokens, one per call, with a counter per priority in the cache: the cache
+    can only increment counters atomically, so the buckets are refilled in full at the start of every second
+    rather than continuously. Interactive calls can take all the tokens, batch calls leave `interactive_reserve`
+    (a share of the tokens) to the interactive calls. A call that finds no token waits for the next second.
+    """
+
+    def __init__(self, name, rate, interactive_reserve, max_wait, cache_alias):
+        self.name = name
+        self.rate = rate
+        self.interactive_reserve = interactive_reserve
+        self.max_wait = max_wait
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def acquire(self, priority):
+        """
+        Take a token for a call, waiting for one if needed.
+
+        :raises RateLimited: When no token was available within the max wait of the priority.
+        """
+        if not self.rate:
+            return
+        limit = self.rate if priority == INTERACTIVE else self.rate * (1 - self.interactive_reserve)
+        start = time.monotonic()
+        deadline = start + self.max_wait.get(priority, 0)
+        while True:
+            now = time.time()
+            if self._take(priority, int(now), limit):
+                waited = time.monotonic() - start
+                if waited:
+                    signals.rate_limit_wait.send(sender=type(self), priority=priority, duration=waited)
+                return
+            # Wait for the next second, spread a little so that the waiting calls don't all come back at once.
+            delay = int(now) + 1 - now + random.uniform(0, 0.05)
+            if time.monotonic() + delay > deadline:
+                logger.warning('netaxept-rate-limited', priority=priority)
+                signals.rate_limit_wait.send(sender=type(self), priority=priority, duration=time.monotonic() - start)
+                raise RateLimited('The rate limit of {} calls per second to netaxept is reached'.format(self.rate))
+            time.sleep(delay)
+
+    def usage(self):
+        """
+        Return the number of tokens taken during the current second, per priority.
+        """
+        second = int(time.time())
+        counts = self.cache.get_many([self._key(priority, second) for priority in [INTERACTIVE, BATCH]])
+        return {priority: counts.get(self._key(priority, second), 0) for priority in [INTERACTIVE, BATCH]}
+
+    def _take(self, priority, second, limit):
+        key = self._key(priority, second)
+        # The counters outlive their second a little, for the calls that read them late.
+        self.cache.add(key, 0, 5)
+        try:
+            self.cache.incr(key)
+        except ValueError:  # Expired in the meantime
+            return False
+        if sum(self.cache.get_many([self._key(p, second) for p in [INTERACTIVE, BATCH]]).values()) <= limit:
+            return True
+        # Give the token back, the counters must only count the calls that were made.
+        try:
+            self.cache.decr(key)
+        except ValueError:
+            pass
+        return False
+
+    def _key(self, priority, second):
+        return 'netaxept-rate:{}:{}:{}'.format(self.name, priority, second)
+
+
+rate_limiter = SharedRateLimiter('gateway', RATE_LIMIT, RATE_LIMIT_INTERACTIVE_RESERVE, RATE_LIMIT_MAX_WAIT, CACHE)
+
+
+def get_rate_limiter(merchant=DEFAULT_MERCHANT):
+    """
+    Return the rate limiter of a merchant account, netaxept limits the calls of each merchant.
+    """
+    if not merchant:
+        return rate_limiter
+    limiter = _merchant_rate_limiters.get(merchant)
+    if limiter is None:
+        limiter = _merchant_rate_limiters[merchant] = SharedRateLimiter(
+            'merchant:{}'.format(merchant), RATE_LIMIT, RATE_LIMIT_INTERACTIVE_RESERVE, RATE_LIMIT_MAX_WAIT, CACHE)
+    return limiter
+
+
+def do_register(order_number, amount, currency_code, description, redirect_url, auto_auth, merchant=DEFAULT_MERCHANT):
+    backend = get_backend(merchant)
+    return _call(backend, 'REGISTER', lambda: backend.register(
+        order_number=order_number,
+        amount=amount,
+        currency_code=currency_code,
+        description=description,
+        redirect_url=redirect_url,
+        auto_auth=auto_auth), merchant)
+
 
-    request.Order = order
-    request.Description = description
-    return client.service.Register(MERCHANTID, TOKEN, request)
+def do_process(transaction_id, operation, amount=None, merchant=DEFAULT_MERCHANT):
+    backend = get_backend(merchant)
+    return _call(backend, operation, lambda: backend.process(
+        transaction_id=transaction_id, operation=operation, amount=amount), merchant)
 
 
-def do_process(transaction_id, operation, amount=None):
-    client = _get_client()
-    request = _get_netaxept_object(client, 'ProcessRequest')
-    request.Operation = operation
-    request.TransactionId = transaction_id
-    if amount:
-        request.TransactionAmount = amount
-    return client.service.Process(MERCHANTID, TOKEN, request)
+def do_query(transaction_id, merchant=DEFAULT_MERCHANT):
+    backend = get_backend(merchant)
+    return _call(backend, 'QUERY', lambda: backend.query(transaction_id=transaction_id), merchant)
 
 
-def get_payment_terminal_url(transaction_id):
-    request = requests.get(
-        TERMINAL,
-        params={'merchantId': MERCHANTID, 'transactionId': transaction_id})
-    return request.url
+def get_payment_terminal_url(transaction_id, merchant=DEFAULT_MERCHANT):
+    """
+    Return the url of the terminal page where the user enters his payment information.
+
+    The url is built locally, netaxept is not contacted.
+    """
+    merchant = get_merchant(merchant)
+    query = urlencode({'merchantId': merchant.merchant_id, 'transactionId': transaction_id})
+    separator = '&' if urlsplit(merchant.terminal).query else '?'
+    return merchant.terminal + separator + query
 
 
-def _get_client():
-    return Client(WSDL, faults=True)
+def get_executor():
+    """
+    Return the thread pool on which the async actions run their (blocking) gateway calls.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=ASYNC_MAX_WORKERS, thread_name_prefix='netaxept')
+    return _executor
 
 
-def _get_netaxept_object(client, obj):
-    return client.factory.create('ns1:%s' % obj)
+def get_backend(merchant=DEFAULT_MERCHANT):
+    """
+    Return the backend of a merchant account. Each merchant has its own backend, with its own clients and
+    connections, created with the `merchant` keyword argument (a `Merchant`). The backend of the account of
+    MERCHANTID reads the settings when it is called.
+    """
+    if merchant:
+        backend = _merchant_backends.get(merchant)
+        if backend is None:
+            with _backend_lock:
+                backend = _merchant_backends.get(merchant)
+                if backend is None:
+                    backend = _merchant_backends[merchant] = import_string(BACKEND)(
+                        merchant=get_merchant(merchant), **BACKEND_OPTIONS)
+        return backend
+    global _backend
+    backend = _backend
+    if backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = import_string(BACKEND)(**BACKEND_OPTIONS)
+            backend = _backend
+    return backend
 
 
-def _get_basic_register_request(client, redirecturl, language, auto_auth):
+def warm_up():
     """
-    Return a basic register request without order
+    Load the backends (of the account of MERCHANTID and of the MERCHANTS), and let them prepare for the first call
+    (the soap backend loads the wsdl).
     """
-    environment = _get_netaxept_object(client, 'Environment')
-    environment.Language = None
-    environment.OS = None
-    environment.WebServicePlatform = 'SUDS'
+    for merchant in [DEFAULT_MERCHANT] + list(MERCHANTS):
+        backend = get_backend(merchant)
+        if hasattr(backend, 'warm_up'):
+            start = time.perf_counter()
+            backend.warm_up()
+            logger.info('netaxept-warm-up', backend=BACKEND, merchant=merchant, duration=time.perf_counter() - start)
+
 
-    terminal = _get_netaxept_object(client, 'Terminal')
-    terminal.AutoAuth = auto_auth
-    terminal.Language = language
-    terminal.OrderDescription = None
-    terminal.RedirectOnError = None
-    terminal.RedirectUrl = redirecturl
+def reset_backend():
+    """
+    Forget the backends (and everything they cache, like the parsed wsdl) and the settings of the merchants,
+    the next gateway calls create new ones.
+    """
+    global _backend
+    with _backend_lock:
+        _backend = None
+        _merchant_backends.clear()
+        _merchants.clear()
 
-    request = _get_netaxept_object(client, 'RegisterRequest')
-    request.AvtaleGiro = None
-    request.CardInfo = None
-    request.Customer = None
-    request.DnBNorDirectPayment = None
-    request.Environment = environment
-    request.ServiceType = None
-    request.Terminal = terminal
-    request.Recurring = None
 
-    return request
+def _call(backend, operation, func, merchant=DEFAULT_MERCHANT):
+    """
+    Call the backend thru the rate limiter of the merchant and the circuit breaker (netaxept is down for all the
+    merchants at once), and attempt again the calls that can safely be retried.
+    """
+    priority = RATE_LIMIT_PRIORITIES.get(operation, INTERACTIVE)
+    limiter = get_rate_limiter(merchant)
+    limiter.acquire(priority)
+    probe = breaker.before_call()
+    deadline = time.monotonic() + RETRY_DEADLINE
+    attempt = 1
+    while True:
+        try:
+            with _instrumented(backend, operation):
+                result = func()
+        except Exception as e:
+            if response_code_of(e) != 'ERROR':  # Netaxept answered
+                breaker.record_success(probe)
+                raise
+            opened = breaker.record_failure(probe)
+            delay = random.uniform(0, RETRY_BACKOFF * 2 ** (attempt - 1))
+            if opened or attempt >= RETRY_ATTEMPTS or time.monotonic() + delay > deadline \
+                    or not is_retryable(e, operation):
+                raise
+            logger.warning('netaxept-retry', operation=operation, attempt=attempt, delay=delay, error=repr(e))
+            time.sleep(delay)
+            limiter.acquire(priority)
+            attempt += 1
+        else:
+            breaker.record_success(probe)
+            return result
+
+
+def is_retryable(exception, operation):
+    """
+    Operations are only attempted again when netaxept surely did not receive them: the connection could not be
+    established, or netaxept answered that it is unavailable. Registrations and queries move no money, they are
+    also attempted again after the other network errors (an unused transaction expires).
+    """
+    # Imported here, requests is slow to import and only needed once a call failed.
+    import requests
+    from urllib3.exceptions import ConnectTimeoutError
+
+    if getattr(exception, 'httpcode', None) == 503:
+        return True
+    if operation in ('REGISTER', 'QUERY'):
+        return isinstance(exception, (requests.ConnectionError, requests.Timeout))
+    if isinstance(exception, requests.ConnectTimeout):
+        return True
+    reason = getattr(exception.args[0], 'reason', None) if exception.args else None
+    # NewConnectionError, when the connection was refused, is a ConnectTimeoutError.
+    return isinstance(exception, requests.ConnectionError) and isinstance(reason, ConnectTimeoutError)
+
+
+@contextmanager
+def _instrumented(backend, operation):
+    response_code = 'OK'
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        response_code = response_code_of(e)
+        raise
+    finally:
+        signals.gateway_call.send(sender=type(backend), operation=operation, duration=time.perf_counter() - start,
+                                  response_code=response_code)
+
+
+def response_code_of(exception):
+    """
+    Return the netaxept response code of a failed gateway call, or ERROR when netaxept did not answer with one.
+    """
+    fault = getattr(exception, 'fault', None)
+    bbsexception = getattr(getattr(fault, 'detail', None), 'BBSException', None)
+    if bbsexception is not None:
+        return str(bbsexception.Result.ResponseCode)
+    return 'ERROR'
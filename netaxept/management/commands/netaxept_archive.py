@@ -0,0 +1,109 @@
+import gzip
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F, Q
+
+from netaxept.management.utils import parse_date_or_datetime
+from netaxept.models import Payment, Operation, ArchivedPayment, ArchivedOperation
+
+# Nothing more can be done with these payments: they failed, were annulled, or were credited in full.
+FINISHED = Q(success=False) | Q(state=Payment.ANNULLED) | \
+    Q(state__in=[Payment.CAPTURED, Payment.CREDITED], credited_amount__gte=F('captured_amount'))
+# These can still be credited, they are only archived on request: archived payments cannot be credited anymore.
+CREDITABLE = Q(state__in=[Payment.CAPTURED, Payment.CREDITED])
+
+# The fields that are kept.
+PAYMENT_FIELDS = [f.attname for f in ArchivedPayment._meta.concrete_fields if f.name != 'archived']
+OPERATION_FIELDS = [f.attname for f in ArchivedOperation._meta.concrete_fields]
+
+
+class Command(BaseCommand):
+    help = 'Move the finished payments (failed, annulled or credited in full) created before a date, with their ' \
+           'operations, to the archive tables (or to a compressed JSON lines file).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--created-before', type=parse_date_or_datetime, required=True,
+                            help='Date or datetime (exclusive)')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='The number of payments moved by each transaction')
+        parser.add_argument('--export', metavar='FILE',
+                            help='Append the payments to this gzipped JSON lines file instead of the archive tables')
+        parser.add_argument('--pause', type=float, default=0.0,
+                            help='Seconds to wait between chunks, to leave room for the other queries')
+        parser.add_argument('--include-creditable', action='store_true',
+                            help='Also archive the captured payments that could still be credited, they cannot be '
+                                 'credited anymore once archived')
+
+    def handle(self, *args, **options):
+        payments = _archivable_payments(options['created_before'], options['include_creditable'])
+        export = gzip.open(options['export'], 'at', encoding='utf-8') if options['export'] else None
+        archived = 0
+        last_payment_id = 0
+        start = time.monotonic()
+        try:
+            while True:
+                payment_ids = list(payments
+                                   .filter(id__gt=last_payment_id)
+                                   .order_by('id')
+                                   .values_list('id', flat=True)[:options['chunk_size']])
+                if not payment_ids:
+                    break
+                archived += _archive_chunk(payments, payment_ids, export)
+                last_payment_id = payment_ids[-1]
+                self.stdout.write('{} payments archived'.format(archived))
+                if options['pause']:
+                    time.sleep(options['pause'])
+        finally:
+            if export:
+                export.close()
+        self.stdout.write(self.style.SUCCESS(
+            '{} payments archived in {:.1f}s'.format(archived, time.monotonic() - start)))
+
+
+def _archivable_payments(created_before, include_creditable=False):
+    return Payment.objects \
+        .filter(created__lt=created_before) \
+        .filter((FINISHED | CREDITABLE) if include_creditable else FINISHED) \
+        .exclude(operations__status__in=[Operation.PENDING, Operation.PROCESSING])
+
+
+def _archive_chunk(payments, payment_ids, export):
+    """
+    Copy then delete a chunk of payments in one short transaction, so that only the rows of the chunk are locked.
+    The payments are read again under lock in case they changed since they were selected.
+    With an export file, a crash between the write and the commit leaves the chunk both in the file and in the
+    live tables, it is written again by the next run.
+    """
+    with transaction.atomic():
+        payment_rows = list(payments
+                            .select_for_update()
+                            .filter(id__in=payment_ids)
+                            .order_by('id')
+                            .values(*PAYMENT_FIELDS))
+        payment_ids = [row['id'] for row in payment_rows]
+        operation_rows = list(Operation.objects
+                              .filter(payment_id__in=payment_ids)
+                              .order_by('id')
+                              .values(*OPERATION_FIELDS))
+        if export:
+            _export(export, payment_rows, operation_rows)
+        else:
+            ArchivedPayment.objects.bulk_create(ArchivedPayment(**row) for row in payment_rows)
+            ArchivedOperation.objects.bulk_create(ArchivedOperation(**row) for row in operation_rows)
+        Operation.objects.filter(payment_id__in=payment_ids).delete()
+        Payment.objects.filter(id__in=payment_ids).delete()
+    return len(payment_ids)
+
+
+def _export(f, payment_rows, operation_rows):
+    operations_by_payment = {}  # type: dict
+    for row in operation_rows:
+        operations_by_payment.setdefault(row['payment_id'], []).append(row)
+    for row in payment_rows:
+        f.write(json.dumps(dict(row, operations=operations_by_payment.get(row['id'], [])), cls=DjangoJSONEncoder))
+        f.write('\n')
+    f.flush()
@@ -0,0 +1,148 @@
+import csv
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from netaxept import actions, gateway
+from netaxept.management.utils import chunks, parse_date_or_datetime
+from netaxept.models import Payment
+
+# Read from the payments: to query them, and to compare them.
+PAYMENT_FIELDS = ['id', 'merchant', 'success', 'transaction_id', 'amount', 'state', 'authorized_amount',
+                  'captured_amount', 'credited_amount']
+
+REPORT_FIELDS = ['payment_id', 'transaction_id', 'field', 'local', 'netaxept']
+
+
+class Command(BaseCommand):
+    help = 'Compare the payments of a period with their state according to netaxept, and report (or fix) ' \
+           'the differences.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--created-after', type=parse_date_or_datetime, help='Date or datetime (inclusive)')
+        parser.add_argument('--created-before', type=parse_date_or_datetime, help='Date or datetime (exclusive)')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--rate', type=float, default=0,
+                            help='The maximum number of queries per second of this run, on top of NETAXEPT_RATE_LIMIT '
+                                 '(by default there is no other limit)')
+        parser.add_argument('--report', metavar='FILE', help='Write the differences to this CSV file')
+        parser.add_argument('--fix', action='store_true',
+                            help='Update the totals and the state of the payments to match netaxept')
+
+    def handle(self, *args, **options):
+        payments = Payment.objects.filter(success=True).only(*PAYMENT_FIELDS).order_by('id')
+        if options['created_after']:
+            payments = payments.filter(created__gte=options['created_after'])
+        if options['created_before']:
+            payments = payments.filter(created__lt=options['created_before'])
+
+        report = open(options['report'], 'w', newline='') if options['report'] else None
+        writer = csv.writer(report) if report else None
+        if writer:
+            writer.writerow(REPORT_FIELDS)
+        # The queries are batch calls for the rate limit of the gateway (NETAXEPT_RATE_LIMIT), shared by all the
+        # processes, they leave its reserve to the checkout. --rate also caps this run alone, for instance to spread
+        # it over the night, or when there is no NETAXEPT_RATE_LIMIT.
+        if not options['rate'] and not gateway.RATE_LIMIT:
+            self.stderr.write('Neither --rate nor NETAXEPT_RATE_LIMIT is set, the queries are not limited.')
+        rate_limiter = RateLimiter(options['rate'])
+
+        def query(payment):
+            rate_limiter.wait()
+            try:
+                return actions.query(payment, use_cache=False)
+            except Exception as e:
+                return e
+
+        checked = errors = differences = fixed = 0
+        start = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=options['concurrency'],
+                                    thread_name_prefix='netaxept-reconcile') as executor:
+                for chunk in chunks(payments.iterator(chunk_size=options['chunk_size']), options['chunk_size']):
+                    to_fix = []
+                    for payment, status in zip(chunk, executor.map(query, chunk)):
+                        checked += 1
+                        if isinstance(status, Exception):
+                            errors += 1
+                            rows = [('error', '', repr(status))]
+                        else:
+                            rows = compare(payment, status)
+                            if rows and options['fix']:
+                                to_fix.append(_fixed(payment, status))
+                        differences += sum(1 for field, _, _ in rows if field != 'error')
+                        if writer:
+                            writer.writerows([payment.id, payment.transaction_id] + list(row) for row in rows)
+                    if to_fix:
+                        Payment.objects.bulk_update(to_fix, ['state', 'authorized_amount', 'captured_amount',
+                                                             'credited_amount'])
+                        fixed += len(to_fix)
+                    self.stdout.write('{} payments checked, {} differences, {} errors'.format(
+                        checked, differences, errors))
+        finally:
+            if report:
+                report.close()
+
+        elapsed = time.monotonic() - start
+        self.stdout.write(self.style.SUCCESS(
+            '{checked} payments checked in {elapsed:.1f}s ({throughput:.1f}/s), {differences} differences, '
+            '{errors} errors, {fixed} payments fixed'.format(
+                checked=checked, elapsed=elapsed, throughput=checked / elapsed if elapsed else 0,
+                differences=differences, errors=errors, fixed=fixed)))
+
+
+class RateLimiter:
+    """
+    Spaces the calls of all the threads evenly, at most `rate` per second (no limit if the rate is 0).
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def compare(payment, status):
+    """
+    :return: The (field, local value, netaxept value) that differ.
+    """
+    local = dict(
+        annulled=payment.state == Payment.ANNULLED,
+        captured_amount=payment.captured_amount,
+        credited_amount=payment.credited_amount,
+    )
+    # Payments authorized on the terminal pages (auto_auth) are only known locally once captured.
+    if not status.annulled:
+        local['authorized'] = payment.authorized_amount > 0 or payment.state != Payment.REGISTERED
+    return [(field, value, getattr(status, field))
+            for field, value in local.items() if value != getattr(status, field)]
+
+
+def _fixed(payment, status):
+    payment.authorized_amount = payment.amount if status.authorized else 0
+    payment.captured_amount = status.captured_amount
+    payment.credited_amount = status.credited_amount
+    if status.annulled:
+        payment.state = Payment.ANNULLED
+    elif status.credited_amount:
+        payment.state = Payment.CREDITED
+    elif status.captured_amount:
+        payment.state = Payment.CAPTURED
+    elif status.authorized:
+        payment.state = Payment.AUTHORIZED
+    else:
+        payment.state = Payment.REGISTERED
+    return payment
@@ -0,0 +1,128 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, F, OuterRef, Q
+
+from netaxept import actions
+from netaxept.management.utils import chunks, parse_date_or_datetime
+from netaxept.models import Payment, Operation
+
+BULK_ACTIONS = {
+    'capture': actions.bulk_capture,
+    'credit': actions.bulk_credit,
+}
+
+# A payment is no longer eligible once one of these operations succeeded on it.
+SETTLED_BY = {
+    'capture': [Operation.CAPTURE, Operation.SALE, Operation.ANNUL],
+    'credit': [Operation.CREDIT, Operation.ANNUL],
+}
+
+# And only while its running totals leave something to do (see Payment.capturable_amount and creditable_amount),
+# so that the payments that the actions would refuse locally are not counted as failures.
+ELIGIBLE = {
+    'capture': Q(amount__gt=F('captured_amount')) & ~Q(state=Payment.ANNULLED),
+    'credit': Q(captured_amount__gt=F('credited_amount')) & ~Q(state=Payment.ANNULLED),
+}
+
+
+class Command(BaseCommand):
+    help = 'Capture (or credit) all eligible payments, in chunks, with resumable checkpoints.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--operation', choices=sorted(BULK_ACTIONS), default='capture')
+        parser.add_argument('--created-after', type=parse_date_or_datetime, help='Date or datetime (inclusive)')
+        parser.add_argument('--created-before', type=parse_date_or_datetime, help='Date or datetime (exclusive)')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--checkpoint', help='A file where progress is recorded, a crashed run that is started '
+                                                 'again with the same file resumes where it left off.')
+
+    def handle(self, *args, **options):
+        operation = options['operation']
+        checkpoint = options['checkpoint']
+        last_payment_id = _read_checkpoint(checkpoint, operation)
+        if last_payment_id:
+            self.stdout.write('Resuming after payment {}'.format(last_payment_id))
+
+        payment_ids = _eligible_payments(operation, options['created_after'], options['created_before']) \
+            .filter(id__gt=last_payment_id) \
+            .order_by('id') \
+            .values_list('id', flat=True) \
+            .iterator(chunk_size=options['chunk_size'])
+
+        durations = []
+        failures = 0
+        start = time.monotonic()
+        for chunk in chunks(payment_ids, options['chunk_size']):
+            results = BULK_ACTIONS[operation](chunk, concurrency=options['concurrency'],
+                                              batch_size=options['chunk_size'])
+            durations.extend(r.duration for r in results)
+            failures += sum(1 for r in results if r.error)
+            _write_checkpoint(checkpoint, operation, chunk[-1])
+            self.stdout.write('{} payments processed, {} failures'.format(len(durations), failures))
+        elapsed = time.monotonic() - start
+        _remove_checkpoint(checkpoint)
+
+        durations.sort()
+        self.stdout.write(self.style.SUCCESS(
+            '{operation}: {count} payments in {elapsed:.1f}s ({throughput:.1f} ops/s), {failures} failures, '
+            'latency p50={p50:.3f}s p90={p90:.3f}s p99={p99:.3f}s'.format(
+                operation=operation,
+                count=len(durations),
+                elapsed=elapsed,
+                throughput=len(durations) / elapsed if elapsed else 0,
+                failures=failures,
+                p50=_percentile(durations, 50),
+                p90=_percentile(durations, 90),
+                p99=_percentile(durations, 99))))
+
+
+def _eligible_payments(operation, created_after, created_before):
+    settled = Operation.objects.filter(payment=OuterRef('pk'), success=True, operation__in=SETTLED_BY[operation])
+    payments = Payment.objects \
+        .filter(ELIGIBLE[operation], success=True) \
+        .annotate(settled=Exists(settled)) \
+        .filter(settled=False)
+    if created_after:
+        payments = payments.filter(created__gte=created_after)
+    if created_before:
+        payments = payments.filter(created__lt=created_before)
+    return payments
+
+
+def _percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of already sorted values.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(0, -(-len(sorted_values) * p // 100) - 1)
+    return sorted_values[int(rank)]
+
+
+def _read_checkpoint(path, operation):
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint['operation'] != operation:
+        raise ValueError('Checkpoint {} was recorded for {}'.format(path, checkpoint['operation']))
+    return checkpoint['last_payment_id']
+
+
+def _write_checkpoint(path, operation, last_payment_id):
+    if not path:
+        return
+    # Write then rename, so that a crash never leaves a truncated checkpoint behind.
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'operation': operation, 'last_payment_id': last_payment_id}, f)
+    os.replace(tmp_path, path)
+
+
+def _remove_checkpoint(path):
+    if path and os.path.exists(path):
+        os.remove(path)
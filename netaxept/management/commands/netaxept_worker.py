@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from netaxept import actions
+
+
+class Command(BaseCommand):
+    help = 'Run the deferred operations, as they are enqueued.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=10,
+                            help='The maximum number of simultaneous gateway calls')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='The maximum number of operations claimed at once')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait when there is nothing to do')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once there are no more pending operations, instead of waiting for more')
+
+    def handle(self, *args, **options):
+        processed = 0
+        failures = 0
+        while True:
+            # Like at the end of a request, drop the connection if it failed or is too old.
+            close_old_connections()
+            operations = actions.process_pending_operations(options['batch_size'], options['concurrency'])
+            done = [o for o in operations if o.status == o.DONE]
+            processed += len(done)
+            failures += sum(1 for o in done if not o.success)
+            if done:
+                self.stdout.write('{} operations processed, {} failures'.format(processed, failures))
+                continue
+            # Nothing to do, or netaxept is unavailable.
+            if options['once']:
+                break
+            time.sleep(options['poll_interval'])
+        self.stdout.write(self.style.SUCCESS('{} operations processed, {} failures'.format(processed, failures)))
@@ -0,0 +1,28 @@
+"""
+Helpers shared by the management commands.
+"""
+from django.utils.dateparse import parse_date, parse_datetime
+
+
+def chunks(iterable, size):
+    """
+    Yield the items of `iterable` in lists of `size` items (the last one can be shorter).
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_date_or_datetime(value):
+    """
+    The type of the date arguments, like `--created-before 2019-06-01` or `--created-before '2019-06-01 12:00'`.
+    """
+    parsed = parse_datetime(value) or parse_date(value)
+    if parsed is None:
+        raise ValueError('Invalid date: {}'.format(value))
+    return parsed
@@ -0,0 +1,106 @@
+"""
+In-process histograms of the durations reported by netaxept.signals, in the Prometheus text format.
+
+Enable them with `NETAXEPT_METRICS = True` and expose them with the `netaxept.views.metrics.metrics` view.
+The histograms are kept per process: with several workers, each one exposes its own.
+The state of the circuit breaker, shared by all the processes, is exposed along with them.
+"""
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, labelnames, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}  # type: dict
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # One counter per bucket, then the sum and the count.
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+        for key, values in series:
+            labels = ['{}="{}"'.format(name, value) for name, value in zip(self.labelnames, key)]
+            for bound, count in zip(self.buckets, values):
+                lines.append('{}_bucket{{{}}} {}'.format(
+                    self.name, ','.join(labels + ['le="{}"'.format(bound)]), count))
+            lines.append('{}_bucket{{{}}} {}'.format(self.name, ','.join(labels + ['le="+Inf"']), values[-1]))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, ','.join(labels), values[-2]))
+            lines.append('{}_count{{{}}} {}'.format(self.name, ','.join(labels), values[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+gateway_call_duration = Histogram(
+    'netaxept_gateway_call_duration_seconds', 'Duration of the calls to netaxept.', ['operation', 'response_code'])
+db_write_duration = Histogram(
+    'netaxept_db_write_duration_seconds', 'Duration of the writes of payments and operations.', ['operation'])
+wsdl_load_duration = Histogram(
+    'netaxept_wsdl_load_duration_seconds', 'Duration of the loading of the wsdl.', [])
+rate_limit_wait_duration = Histogram(
+    'netaxept_rate_limit_wait_seconds', 'Time waited by the calls to netaxept for the rate limit.', ['priority'])
+
+HISTOGRAMS = [gateway_call_duration, db_write_duration, wsdl_load_duration, rate_limit_wait_duration]
+
+
+def connect():
+    """
+    Start collecting the durations reported by the signals.
+    """
+    from . import signals
+    signals.gateway_call.connect(_on_gateway_call, dispatch_uid='netaxept-metrics')
+    signals.db_write.connect(_on_db_write, dispatch_uid='netaxept-metrics')
+    signals.wsdl_loaded.connect(_on_wsdl_loaded, dispatch_uid='netaxept-metrics')
+    signals.rate_limit_wait.connect(_on_rate_limit_wait, dispatch_uid='netaxept-metrics')
+
+
+def render():
+    return ''.join(histogram.render() for histogram in HISTOGRAMS) + render_breaker_state()
+
+
+def render_breaker_state():
+    from .gateway import breaker, CircuitBreaker
+    name = 'netaxept_circuit_breaker_state'
+    lines = ['# HELP {} State of the circuit breaker around the calls to netaxept, 1 for the current state.'.format(
+        name), '# TYPE {} gauge'.format(name)]
+    current_state = breaker.state()
+    for state in [CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN]:
+        lines.append('{}{{state="{}"}} {}'.format(name, state, int(state == current_state)))
+    return '\n'.join(lines) + '\n'
+
+
+def _on_gateway_call(sender, operation, duration, response_code, **kwargs):
+    gateway_call_duration.observe(duration, operation=operation, response_code=response_code)
+
+
+def _on_db_write(sender, operation, duration, **kwargs):
+    db_write_duration.observe(duration, operation=operation)
+
+
+def _on_wsdl_loaded(sender, duration, **kwargs):
+    wsdl_load_duration.observe(duration)
+
+
+def _on_rate_limit_wait(sender, priority, duration, **kwargs):
+    rate_limit_wait_duration.observe(duration, priority=priority)
@@ -0,0 +1,68 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:47
+
+from django.db import migrations, models
+
+
+def compute_balances(apps, schema_editor):
+    """
+    Replay the successful operations of every payment to compute its running totals.
+    """
+    Payment = apps.get_model('netaxept', 'Payment')
+    Operation = apps.get_model('netaxept', 'Operation')
+    operations = Operation.objects \
+        .filter(success=True) \
+        .order_by('payment_id', 'created', 'id') \
+        .values_list('payment_id', 'payment__amount', 'operation', 'amount')
+    current_payment_id = None
+    balance = None
+    for payment_id, payment_amount, operation, amount in operations.iterator():
+        if payment_id != current_payment_id:
+            if balance:
+                Payment.objects.filter(pk=current_payment_id).update(**balance)
+            current_payment_id = payment_id
+            balance = dict(state='REGISTERED', authorized_amount=0, captured_amount=0, credited_amount=0)
+        if operation == 'AUTH':
+            balance.update(state='AUTHORIZED', authorized_amount=payment_amount)
+        elif operation == 'SALE':
+            balance.update(state='CAPTURED', authorized_amount=payment_amount, captured_amount=payment_amount)
+        elif operation == 'CAPTURE':
+            captured = balance['captured_amount'] + (amount or payment_amount - balance['captured_amount'])
+            balance.update(state='CAPTURED', captured_amount=captured)
+        elif operation == 'CREDIT':
+            credited = balance['credited_amount'] + (amount or balance['captured_amount'] - balance['credited_amount'])
+            balance.update(state='CREDITED', credited_amount=credited)
+        elif operation == 'ANNUL':
+            balance.update(state='ANNULLED')
+    if balance:
+        Payment.objects.filter(pk=current_payment_id).update(**balance)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netaxept', '0003_payment_authoauth_and_redirecturl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='authorized_amount',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='captured_amount',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='credited_amount',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='state',
+            field=models.CharField(choices=[('REGISTERED', 'REGISTERED'), ('AUTHORIZED', 'AUTHORIZED'), ('CAPTURED', 'CAPTURED'), ('CREDITED', 'CREDITED'), ('ANNULLED', 'ANNULLED')], default='REGISTERED', max_length=10),
+        ),
+        migrations.RunPython(compute_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netaxept', '0004_payment_balance'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='operation',
+            index=models.Index(fields=['payment', 'created'], name='netaxept_op_payment_created'),
+        ),
+        migrations.AddIndex(
+            model_name='operation',
+            index=models.Index(condition=models.Q(('success', True)), fields=['payment', 'operation'], name='netaxept_op_payment_success'),
+        ),
+        migrations.AddIndex(
+            model_name='operation',
+            index=models.Index(fields=['transaction_id'], name='netaxept_op_transaction_id'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['success', 'created'], name='netaxept_pa_success_created'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['state', 'created'], name='netaxept_pa_state_created'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['currency_code', 'created'], name='netaxept_pa_currency_created'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['order_number'], name='netaxept_pa_order_number'),
+        ),
+        # Dropped only once its replacement (payment, created) exists.
+        migrations.AlterField(
+            model_name='operation',
+            name='payment',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='operations', to='netaxept.payment'),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netaxept', '0005_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedOperation',
+            fields=[
+                ('success', models.BooleanField()),
+                ('response_source', models.CharField(blank=True, max_length=20, null=True)),
+                ('response_code', models.CharField(blank=True, max_length=3, null=True)),
+                ('response_text', models.CharField(blank=True, max_length=255, null=True)),
+                ('transaction_id', models.CharField(max_length=32)),
+                ('operation', models.CharField(choices=[('AUTH', 'AUTH'), ('SALE', 'SALE'), ('CAPTURE', 'CAPTURE'), ('CREDIT', 'CREDIT'), ('ANNUL', 'ANNUL')], max_length=7)),
+                ('amount', models.PositiveIntegerField(blank=True, null=True)),
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('created', models.DateTimeField(db_index=True)),
+                ('modified', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedPayment',
+            fields=[
+                ('success', models.BooleanField()),
+                ('response_source', models.CharField(blank=True, max_length=20, null=True)),
+                ('response_code', models.CharField(blank=True, max_length=3, null=True)),
+                ('response_text', models.CharField(blank=True, max_length=255, null=True)),
+                ('transaction_id', models.CharField(blank=True, max_length=32, null=True, unique=True)),
+                ('order_number', models.CharField(max_length=32)),
+                ('amount', models.PositiveIntegerField()),
+                ('currency_code', models.CharField(max_length=3)),
+                ('description', models.CharField(blank=True, max_length=255, null=True)),
+                ('redirect_url', models.CharField(max_length=255)),
+                ('auto_auth', models.BooleanField()),
+                ('state', models.CharField(choices=[('REGISTERED', 'REGISTERED'), ('AUTHORIZED', 'AUTHORIZED'), ('CAPTURED', 'CAPTURED'), ('CREDITED', 'CREDITED'), ('ANNULLED', 'ANNULLED')], default='REGISTERED', max_length=10)),
+                ('authorized_amount', models.PositiveIntegerField(default=0)),
+                ('captured_amount', models.PositiveIntegerField(default=0)),
+                ('credited_amount', models.PositiveIntegerField(default=0)),
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('created', models.DateTimeField(db_index=True)),
+                ('modified', models.DateTimeField()),
+                ('archived', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedpayment',
+            index=models.Index(fields=['order_number'], name='netaxept_ap_order_number'),
+        ),
+        migrations.AddField(
+            model_name='archivedoperation',
+            name='payment',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='operations', to='netaxept.archivedpayment'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedoperation',
+            index=models.Index(fields=['transaction_id'], name='netaxept_ao_transaction_id'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netaxept', '0007_payment_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedoperation',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'PENDING'), ('PROCESSING', 'PROCESSING'), ('DONE', 'DONE')], default='DONE', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='operation',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'PENDING'), ('PROCESSING', 'PROCESSING'), ('DONE', 'DONE')], default='DONE', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='archivedoperation',
+            name='success',
+            field=models.BooleanField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='operation',
+            name='success',
+            field=models.BooleanField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='operation',
+            index=models.Index(condition=models.Q(('status', 'PENDING')), fields=['id'], name='netaxept_op_pending'),
+        ),
+    ]
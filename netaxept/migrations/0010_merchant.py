@@ -0,0 +1,42 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netaxept', '0009_response_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedoperation',
+            name='merchant',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='archivedpayment',
+            name='merchant',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='operation',
+            name='merchant',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='merchant',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='idempotency_key',
+            field=models.CharField(blank=True, editable=False, max_length=100, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['merchant', 'created'], name='netaxept_pa_merchant_created'),
+        ),
+    ]
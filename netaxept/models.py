@@ -1,20 +1,39 @@
 from django.db import models
-from django.db.models import CASCADE
+from django.db.models import CASCADE, Q
 
 
 class TransactionBase(models.Model):
+    # The name of the merchant account in NETAXEPT_MERCHANTS, empty for the account of NETAXEPT_MERCHANTID.
+    merchant = models.CharField(max_length=32, blank=True, default='')
     created = models.DateTimeField(auto_now_add=True, db_index=True)
     modified = models.DateTimeField(auto_now=True)
     success = models.BooleanField()
     response_source = models.CharField(max_length=20, null=True, blank=True)
     response_code = models.CharField(max_length=3, null=True, blank=True)
     response_text = models.CharField(max_length=255, null=True, blank=True)
+    response_message = models.CharField(max_length=255, null=True, blank=True)
+    # Seconds spent waiting for netaxept.
+    gateway_duration = models.FloatField(null=True, blank=True)
 
     class Meta:
         abstract = True
 
 
-class Payment(TransactionBase):
+class PaymentBase(TransactionBase):
+    REGISTERED = 'REGISTERED'
+    AUTHORIZED = 'AUTHORIZED'
+    CAPTURED = 'CAPTURED'
+    CREDITED = 'CREDITED'
+    ANNULLED = 'ANNULLED'
+
+    STATE_CHOICES = (
+        (REGISTERED, 'REGISTERED'),
+        (AUTHORIZED, 'AUTHORIZED'),
+        (CAPTURED, 'CAPTURED'),
+        (CREDITED, 'CREDITED'),
+        (ANNULLED, 'ANNULLED'),
+    )
+
     # Failed payments will sometimes have a null transaction id, we want to allow more
     # than one of those in the database, so we allow null in transaction_id
     transaction_id = models.CharField(max_length=32, unique=True, null=True, blank=True)
@@ -25,11 +44,56 @@ class Payment(TransactionBase):
     redirect_url = models.CharField(max_length=255)
     auto_auth = models.BooleanField()
 
+    # Running totals of the successful operations, maintained along with the operations (see actions).
+    # A payment authorized thru the terminal pages (auto_auth) stays REGISTERED, only netaxept knows about it.
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default=REGISTERED)
+    authorized_amount = models.PositiveIntegerField(default=0)
+    captured_amount = models.PositiveIntegerField(default=0)
+    credited_amount = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
     def __str__(self):
         return '{} {} - {}'.format(self.amount, self.currency_code, self.transaction_id)
 
+    @property
+    def capturable_amount(self):
+        return self.amount - self.captured_amount
+
+    @property
+    def creditable_amount(self):
+        return self.captured_amount - self.credited_amount
+
+
+class Payment(PaymentBase):
+    # Set on successful registrations, so that the same order is not registered twice (see actions.register).
+    idempotency_key = models.CharField(max_length=100, unique=True, null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # The admin changelist filtered by success, state or currency, within a date hierarchy period.
+            # The settlement scans the successful payments of a period in the same way.
+            models.Index(fields=['success', 'created'], name='netaxept_pa_success_created'),
+            models.Index(fields=['state', 'created'], name='netaxept_pa_state_created'),
+            models.Index(fields=['currency_code', 'created'], name='netaxept_pa_currency_created'),
+            models.Index(fields=['merchant', 'created'], name='netaxept_pa_merchant_created'),
+            # Looking up the payments of an order (admin search, reconciliation with the shop).
+            models.Index(fields=['order_number'], name='netaxept_pa_order_number'),
+        ]
+
+
+class OperationBase(TransactionBase):
+    PENDING = 'PENDING'
+    PROCESSING = 'PROCESSING'
+    DONE = 'DONE'
+
+    STATUS_CHOICES = (
+        (PENDING, 'PENDING'),
+        (PROCESSING, 'PROCESSING'),
+        (DONE, 'DONE'),
+    )
 
-class Operation(TransactionBase):
     AUTH = 'AUTH'
     SALE = 'SALE'
     CAPTURE = 'CAPTURE'
@@ -45,9 +109,64 @@ class Operation(TransactionBase):
     )
 
     transaction_id = models.CharField(max_length=32)
-    payment = models.ForeignKey(Payment, related_name='operations', on_delete=CASCADE)
     operation = models.CharField(max_length=7, choices=OPERATION_CHOICES)
     amount = models.PositiveIntegerField(null=True, blank=True)
+    # Deferred operations are enqueued as PENDING, claimed by a worker (PROCESSING), and their success is
+    # unknown until they're DONE.
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=DONE)
+    success = models.BooleanField(null=True)
+    # From the response of netaxept.
+    authorization_id = models.CharField(max_length=32, null=True, blank=True)
+    batch_number = models.CharField(max_length=32, null=True, blank=True)
+    execution_time = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        abstract = True
 
     def __str__(self):
         return '{} {} - {}'.format(self.operation, self.amount or '', self.transaction_id)
+
+
+class Operation(OperationBase):
+    # Indexed by the first index below.
+    payment = models.ForeignKey(Payment, related_name='operations', on_delete=CASCADE, db_index=False)
+
+    class Meta:
+        indexes = [
+            # The operations of a payment, newest first (change view inline, last operation in the changelist).
+            models.Index(fields=['payment', 'created'], name='netaxept_op_payment_created'),
+            # Has the payment been captured or credited (settlement), only successful operations count.
+            models.Index(fields=['payment', 'operation'], name='netaxept_op_payment_success',
+                         condition=Q(success=True)),
+            # Looking up the operations of a netaxept transaction (admin search, callbacks).
+            models.Index(fields=['transaction_id'], name='netaxept_op_transaction_id'),
+            # The queue of the worker.
+            models.Index(fields=['id'], name='netaxept_op_pending', condition=Q(status='PENDING')),
+        ]
+
+
+# Settled payments (and their operations) are moved to these tables by the netaxept_archive command.
+# They keep the ids, and the creation and modification dates, of the live rows.
+
+class ArchivedPayment(PaymentBase):
+    id = models.IntegerField(primary_key=True)
+    created = models.DateTimeField(db_index=True)
+    modified = models.DateTimeField()
+    archived = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['order_number'], name='netaxept_ap_order_number'),
+        ]
+
+
+class ArchivedOperation(OperationBase):
+    id = models.IntegerField(primary_key=True)
+    created = models.DateTimeField(db_index=True)
+    modified = models.DateTimeField()
+    payment = models.ForeignKey(ArchivedPayment, related_name='operations', on_delete=CASCADE)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['transaction_id'], name='netaxept_ao_transaction_id'),
+        ]
@@ -0,0 +1,24 @@
+"""
+Signals sent around the expensive steps of the payment hot path, to find out where the time goes.
+"""
+from django.dispatch import Signal
+
+# Sent after every call to netaxept (also when it fails).
+# Arguments: operation (REGISTER, AUTH, CAPTURE, ...), duration (in seconds), response_code ('OK' when successful).
+gateway_call = Signal()
+
+# Sent after every write of payments and operations.
+# Arguments: operation (REGISTER, AUTH, CAPTURE, ...), duration (in seconds), count (the number of rows written).
+db_write = Signal()
+
+# Sent when the backend loads the wsdl.
+# Arguments: duration (in seconds).
+wsdl_loaded = Signal()
+
+# Sent when the circuit breaker around the calls to netaxept opens or closes.
+# Arguments: state ('open' or 'closed').
+circuit_breaker = Signal()
+
+# Sent when a call to netaxept had to wait for the rate limit (also when it gave up waiting).
+# Arguments: priority ('interactive' or 'batch'), duration (in seconds).
+rate_limit_wait = Signal()
@@ -0,0 +1,97 @@
+"""
+A suds transport built on a shared requests session.
+
+Compared to the default urllib transport of suds, connections to netaxept are kept alive and reused
+(from a bounded pool), and every request has explicit connect and read timeouts.
+"""
+import io
+import threading
+import urllib.request
+
+import requests
+from requests.adapters import HTTPAdapter
+from suds.transport import Reply, Transport, TransportError
+
+_sessions = {}  # type: dict
+_session_lock = threading.Lock()
+
+
+def get_session(pool_maxsize, name=''):
+    """
+    Return the requests session shared by all netaxept calls of this process, there is one per merchant `name`
+    so that the calls of a merchant cannot take all the connections.
+    """
+    session = _sessions.get(name)
+    if session is None:
+        with _session_lock:
+            session = _sessions.get(name)
+            if session is None:
+                session = _sessions[name] = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=True)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+    return session
+
+
+def close_session():
+    """
+    Close the sessions of all the merchants.
+    """
+    with _session_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+class RequestsTransport(Transport):
+    """
+    :param session: The requests session to send the requests with.
+    :param timeout: The default (connect timeout, read timeout) in seconds.
+    :param operation_timeouts: Timeouts for specific SOAP operations, for instance {'Process': (3.05, 60)}
+    """
+
+    def __init__(self, session, timeout, operation_timeouts=None):
+        super().__init__()
+        self.session = session
+        self.timeout = timeout
+        self.operation_timeouts = operation_timeouts or {}
+
+    def open(self, request):
+        if request.url.startswith('file:'):
+            # A local copy of the wsdl.
+            return urllib.request.urlopen(request.url)
+        response = self.session.get(request.url, timeout=self.timeout)
+        if response.status_code != 200:
+            raise TransportError(response.reason, response.status_code, io.BytesIO(response.content))
+        return io.BytesIO(response.content)
+
+    def send(self, request):
+        timeout = self.operation_timeouts.get(soap_operation(request.headers), self.timeout)
+        response = self.session.post(request.url, data=request.message, headers=request.headers, timeout=timeout)
+        if response.status_code in (202, 204):
+            return None
+        if response.status_code != 200:
+            # suds reads the soap fault from the body of the error.
+            raise TransportError(response.reason, response.status_code, io.BytesIO(response.content))
+        return Reply(response.status_code, response.headers, response.content)
+
+    def clone(self):
+        """
+        Return a new transport that shares the session (and thus the connection pool) of this one.
+        """
+        return RequestsTransport(self.session, self.timeout, self.operation_timeouts)
+
+    def __deepcopy__(self, memo):
+        # Used by Client.clone, the clones must share the connection pool.
+        return self.clone()
+
+
+def soap_operation(headers):
+    """
+    Return the name of the operation from the SOAPAction header, for instance 'Register'.
+    """
+    soap_action = headers.get('SOAPAction', '')
+    if isinstance(soap_action, bytes):  # That's how suds sets it.
+        soap_action = soap_action.decode('ascii')
+    soap_action = soap_action.strip('"')
+    return soap_action.rsplit('/', 1)[-1]
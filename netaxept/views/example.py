@@ -33,7 +33,7 @@ def pay(request: HttpRequest) -> HttpResponse:
                 redirect_url=form.cleaned_data['redirect_url'],
                 auto_auth=form.cleaned_data['auto_auth'],
             )
-            return redirect(get_payment_terminal_url(registration.transaction_id))
+            return redirect(get_payment_terminal_url(registration.transaction_id, registration.merchant))
     else:
         form = PayForm()
 
@@ -0,0 +1,12 @@
+"""
+Exposes the netaxept metrics to Prometheus (see netaxept.metrics).
+
+You should restrict access to this view if you choose to add it to your urlconf.
+"""
+from django.http import HttpRequest, HttpResponse
+
+from .. import metrics as netaxept_metrics
+
+
+def metrics(request: HttpRequest) -> HttpResponse:
+    return HttpResponse(netaxept_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -12,14 +12,19 @@ setup(
     author_email='nwolff@gmail.com',
     url=netaxept.__URL__,
     download_url='https://pypi.python.org/pypi/django-datatrans-gateway',
+    python_requires='>=3.6',
     install_requires=[
-        'Django>=2.0',
+        'Django>=2.2',
         'structlog',
         'suds2',
         'requests',
+        'asgiref>=3.2',
     ],
     packages=[
         'netaxept',
+        'netaxept.backends',
+        'netaxept.management',
+        'netaxept.management.commands',
         'netaxept.migrations',
         'netaxept.views',
     ],
@@ -32,11 +37,16 @@ setup(
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
         'Framework :: Django',
+        'Framework :: Django :: 2.2',
+        'Framework :: Django :: 3.2',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
     ],
 )
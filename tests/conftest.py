@@ -1,8 +1,16 @@
 import os
 
 import django
+import pytest
 
 
 def pytest_configure(config):
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
     django.setup()
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    from django.core.cache import caches
+    for cache in caches.all():
+        cache.clear()
@@ -0,0 +1,12 @@
+from netaxept.models import Payment
+
+
+def create_payment(transaction_id='1234567890', success=True, **kwargs):
+    return Payment.objects.create(
+        transaction_id=transaction_id,
+        order_number='an-order-number',
+        amount=100,
+        currency_code='NOK',
+        success=success,
+        auto_auth=False,
+        **kwargs)
@@ -32,6 +32,7 @@ MIDDLEWARE = [
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
                 'django.contrib.auth.context_processors.auth',
@@ -44,3 +45,5 @@ TEMPLATES = [
 STATIC_URL = '/static/'
 
 ROOT_URLCONF = 'tests.urls'
+
+NETAXEPT_BACKEND = 'netaxept.backends.fake.FakeBackend'
@@ -1,14 +1,25 @@
+import asyncio
+import threading
+from datetime import timedelta
+from unittest.mock import Mock, patch
+
+import requests
+import suds
+from asgiref.sync import async_to_sync
+from django.core.cache import caches
 from django.test import TestCase
-from pytest import raises, mark
+from pytest import raises
 
-from netaxept import actions
+from netaxept import actions, gateway
 from netaxept.actions import PaymentRegistrationNotCompleted
-from netaxept.models import Payment
+from netaxept.backends import bbs_exception
+from netaxept.gateway import CircuitBreaker, GatewayUnavailable, RateLimited, SharedRateLimiter, do_query
+from netaxept.models import Payment, Operation
+from .factories import create_payment
 
 
 class PaymentTest(TestCase):
 
-    @mark.skip('because it tries to invoke the real netaxept gateway')
     def test_a_successful_payment_can_go_on_thru_sale(self):
         payment = Payment.objects.create(
             transaction_id='1234567890',
@@ -17,7 +28,21 @@ class PaymentTest(TestCase):
             currency_code='NOK',
             success=True,
             auto_auth=False)
-        actions.sale(payment.id)
+        operation = actions.sale(payment.id)
+        assert operation.success
+
+    def test_a_payment_can_be_registered_authorized_and_captured(self):
+        payment = actions.register(
+            order_number='an-order-number',
+            amount=100,
+            currency_code='NOK',
+            redirect_url='http://example.com/')
+        assert payment.success
+        assert actions.auth(payment.id).success
+        assert actions.capture(payment.id, 100).success
+        with raises(actions.AmountAlreadyCaptured):
+            actions.capture(payment.id, 1)
+        assert [o.success for o in payment.operations.order_by('id')] == [True, True]
 
     def test_an_unsuccesful_payment_cannot_go_on_thru_sale(self):
         payment = Payment.objects.create(
@@ -29,3 +54,462 @@ class PaymentTest(TestCase):
             auto_auth=False)
         with raises(PaymentRegistrationNotCompleted):
             actions.sale(payment.id)
+
+
+class ResponseTest(TestCase):
+
+    def setUp(self):
+        self.payment = actions.register(order_number='an-order-number', amount=100, currency_code='NOK',
+                                        redirect_url='http://example.com/')
+
+    def test_the_response_is_recorded(self):
+        assert self.payment.gateway_duration >= 0
+        operation = Operation.objects.get(pk=actions.auth(self.payment.id).pk)
+        assert operation.response_code == 'OK'
+        assert operation.authorization_id == '123456'
+        assert operation.execution_time is not None
+        assert operation.gateway_duration >= 0
+
+    def test_the_message_of_refusals_is_recorded(self):
+        with patch('netaxept.actions.do_process', side_effect=bbs_exception('99', 'Refused', 'Refused by issuer')), \
+                raises(suds.WebFault):
+            actions.auth(self.payment.id)
+        operation = Operation.objects.get()
+        assert (operation.response_code, operation.response_text, operation.response_message) == (
+            '99', 'Refused', 'Refused by issuer')
+
+
+class RegisterIdempotencyTest(TestCase):
+
+    def register(self, amount=100):
+        return actions.register(order_number='an-order-number', amount=amount, currency_code='NOK',
+                                redirect_url='http://example.com/')
+
+    def test_registering_the_same_order_again_returns_the_first_payment(self):
+        transaction_ids = iter(['abc', 'def'])
+        with patch('netaxept.actions.do_register',
+                   side_effect=lambda **kwargs: Mock(TransactionId=next(transaction_ids))) as do_register:
+            first = self.register()
+            with self.assertNumQueries(0):
+                second = self.register()
+            third = self.register(amount=200)
+        assert second.id == first.id
+        assert third.id != first.id
+        assert do_register.call_count == 2
+        assert Payment.objects.count() == 2
+
+    def test_the_database_is_used_when_the_cache_forgot(self):
+        first = self.register()
+        caches['default'].clear()
+        with self.assertNumQueries(1):
+            assert self.register().id == first.id
+
+    def test_expired_registrations_are_not_reused(self):
+        first = self.register()
+        caches['default'].clear()
+        Payment.objects.filter(pk=first.pk).update(created=first.created - timedelta(hours=1))
+        second = self.register()
+        assert second.id != first.id
+        assert Payment.objects.get(pk=first.pk).idempotency_key is None
+
+    def test_failed_registrations_are_retried(self):
+        with patch('netaxept.actions.do_register', side_effect=bbs_exception('99', 'Refused', 'Refused by issuer')):
+            with raises(suds.WebFault):
+                self.register()
+        assert Payment.objects.get().idempotency_key is None
+        assert self.register().success
+        assert Payment.objects.count() == 2
+
+    def test_concurrent_registrations_keep_the_first_payment(self):
+        first = self.register()
+        caches['default'].clear()
+        # Another process registered the same order while this one was waiting for netaxept.
+        with patch('netaxept.actions._find_registration', return_value=None):
+            second = self.register()
+        assert second.id == first.id
+        assert Payment.objects.count() == 1
+
+    def test_it_can_be_turned_off(self):
+        with patch('netaxept.gateway.REGISTER_IDEMPOTENCY_TTL', 0):
+            first = self.register()
+            second = self.register()
+        assert second.id != first.id
+
+
+class RegisterErrorsTest(TestCase):
+
+    def register(self):
+        return actions.register(order_number='an-order-number', amount=100, currency_code='NOK',
+                                redirect_url='http://example.com/')
+
+    def test_registrations_without_answer_are_recorded_as_failed(self):
+        with patch('netaxept.actions.do_register', side_effect=ConnectionError()), raises(ConnectionError):
+            self.register()
+        payment = Payment.objects.get()
+        assert (payment.success, payment.response_text) == (False, 'ConnectionError()')
+        assert payment.idempotency_key is None
+
+    def test_registrations_are_not_recorded_while_the_circuit_breaker_is_open(self):
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=30, cache_alias='default')
+        breaker.record_failure(probe=True)
+        with patch('netaxept.gateway.breaker', breaker), raises(GatewayUnavailable):
+            self.register()
+        assert not Payment.objects.exists()
+
+    def test_registrations_are_not_recorded_when_the_rate_limit_is_reached(self):
+        rate_limiter = SharedRateLimiter('test', rate=0.5, interactive_reserve=0, max_wait={},
+                                         cache_alias='default')
+        with patch('netaxept.gateway.rate_limiter', rate_limiter), raises(RateLimited):
+            self.register()
+        with patch('netaxept.gateway.rate_limiter', rate_limiter), raises(RateLimited):
+            async_to_sync(actions.aregister)(order_number='an-order-number', amount=100, currency_code='NOK',
+                                             redirect_url='http://example.com/')
+        assert not Payment.objects.exists()
+
+    def test_async_operations_are_not_recorded_when_the_rate_limit_is_reached(self):
+        payment = create_payment(state=Payment.AUTHORIZED, authorized_amount=100)
+        rate_limiter = SharedRateLimiter('test', rate=0.5, interactive_reserve=0, max_wait={},
+                                         cache_alias='default')
+        with patch('netaxept.gateway.rate_limiter', rate_limiter), raises(RateLimited):
+            async_to_sync(actions.acapture)(payment.id, 10)
+        assert not Operation.objects.exists()
+
+    def test_async_operations_without_answer_are_recorded(self):
+        payment = create_payment(state=Payment.AUTHORIZED, authorized_amount=100)
+        with patch('netaxept.actions.do_process', side_effect=ConnectionError()), raises(ConnectionError):
+            async_to_sync(actions.acapture)(payment.id, 10)
+        assert list(Operation.objects.values_list('success', 'status')) == [(None, Operation.DONE)]
+
+
+class MerchantTest(TestCase):
+
+    def setUp(self):
+        gateway.reset_backend()
+        self.addCleanup(gateway.reset_backend)
+        merchants = {name: {'MERCHANTID': name, 'TOKEN': 'a-token'} for name in ['shop-b', 'shop-c']}
+        patcher = patch('netaxept.gateway.MERCHANTS', merchants)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def register(self, merchant):
+        return actions.register(order_number='an-order-number', amount=100, currency_code='NOK',
+                                redirect_url='http://example.com/', auto_auth=True, merchant=merchant)
+
+    def test_the_merchant_is_recorded(self):
+        with patch('netaxept.actions.do_register', wraps=gateway.do_register) as do_register:
+            payment = self.register('shop-b')
+        assert do_register.call_args[1]['merchant'] == 'shop-b'
+        assert Payment.objects.get(pk=payment.pk).merchant == 'shop-b'
+        assert self.register('').merchant == ''
+
+    def test_the_same_order_can_be_registered_with_each_merchant(self):
+        payment = self.register('shop-b')
+        assert self.register('shop-c').id != payment.id
+        assert self.register('shop-b').id == payment.id
+
+    def test_the_operations_go_thru_the_merchant_of_the_payment(self):
+        payment = self.register('shop-b')
+        with patch('netaxept.actions.do_process', wraps=gateway.do_process) as do_process:
+            operation = actions.capture(payment.id, 100)
+        assert do_process.call_args[1]['merchant'] == 'shop-b'
+        assert operation.success and operation.merchant == 'shop-b'
+        with patch('netaxept.actions.do_query', wraps=do_query) as query:
+            assert actions.query(payment.id).captured_amount == 100
+        assert query.call_args[1]['merchant'] == 'shop-b'
+        # The transaction is only known to the backend of the merchant.
+        with raises(suds.WebFault):
+            gateway.do_query(payment.transaction_id)
+
+
+class QueryTest(TestCase):
+
+    def setUp(self):
+        self.payment = actions.register(order_number='an-order-number', amount=100, currency_code='NOK',
+                                        redirect_url='http://example.com/', auto_auth=True)
+
+    def test_it_returns_the_status_known_to_netaxept(self):
+        status = actions.query(self.payment.id)
+        assert status.transaction_id == self.payment.transaction_id
+        assert (status.amount, status.currency_code, status.order_number) == (100, 'NOK', 'an-order-number')
+        assert status.authorized and status.captured_amount == 0
+
+    def test_the_status_is_cached(self):
+        with patch('netaxept.actions.do_query', wraps=do_query) as query:
+            actions.query(self.payment.id)
+            with self.assertNumQueries(0):
+                actions.query(self.payment)
+            actions.query(self.payment, use_cache=False)
+        assert query.call_count == 2
+
+    def test_recorded_operations_invalidate_the_cached_status(self):
+        assert actions.query(self.payment).captured_amount == 0
+        with self.captureOnCommitCallbacks(execute=True):
+            actions.capture(self.payment.id, 60)
+        assert actions.query(self.payment).captured_amount == 60
+
+    def test_unregistered_payments_cannot_be_queried(self):
+        Payment.objects.filter(pk=self.payment.pk).update(success=False)
+        with raises(PaymentRegistrationNotCompleted):
+            actions.query(self.payment.id)
+
+
+class BalanceTest(TestCase):
+
+    def setUp(self):
+        self.payment = actions.register(
+            order_number='an-order-number',
+            amount=100,
+            currency_code='NOK',
+            redirect_url='http://example.com/')
+
+    def balance(self):
+        return Payment.objects.values_list('state', 'authorized_amount', 'captured_amount', 'credited_amount') \
+            .get(pk=self.payment.pk)
+
+    def test_successful_operations_update_the_balance(self):
+        assert self.balance() == (Payment.REGISTERED, 0, 0, 0)
+        actions.auth(self.payment.id)
+        assert self.balance() == (Payment.AUTHORIZED, 100, 0, 0)
+        actions.capture(self.payment.id, 30)
+        assert self.balance() == (Payment.CAPTURED, 100, 30, 0)
+        actions.capture(self.payment.id)
+        assert self.balance() == (Payment.CAPTURED, 100, 100, 0)
+        actions.credit(self.payment.id, 40)
+        assert self.balance() == (Payment.CREDITED, 100, 100, 40)
+        actions.credit(self.payment.id)
+        assert self.balance() == (Payment.CREDITED, 100, 100, 100)
+
+    def test_failed_operations_dont_update_the_balance(self):
+        with raises(suds.WebFault):
+            actions.capture(self.payment.id)  # Not authorized
+        assert self.balance() == (Payment.REGISTERED, 0, 0, 0)
+
+    def test_invalid_operations_are_refused_without_invoking_netaxept(self):
+        Payment.objects.filter(pk=self.payment.pk).update(captured_amount=60)
+        with patch('netaxept.actions.do_process') as do_process:
+            with raises(actions.AmountExceedsRemaining):
+                actions.capture(self.payment.id, 41)
+            with raises(actions.AmountExceedsRemaining):
+                actions.credit(self.payment.id, 61)
+            with raises(actions.AmountAlreadyCaptured):
+                actions.annul(self.payment.id)
+            Payment.objects.filter(pk=self.payment.pk).update(captured_amount=100)
+            with raises(actions.AmountAlreadyCaptured):
+                actions.capture(self.payment.id)
+            Payment.objects.filter(pk=self.payment.pk).update(captured_amount=0)
+            with raises(actions.NoAmountCaptured):
+                actions.credit(self.payment.id)
+            Payment.objects.filter(pk=self.payment.pk).update(state=Payment.ANNULLED)
+            with raises(actions.PaymentAnnulled):
+                actions.auth(self.payment.id)
+        do_process.assert_not_called()
+        assert not Operation.objects.exists()
+
+
+class QueriesTest(TestCase):
+
+    def setUp(self):
+        self.payment = Payment.objects.create(
+            transaction_id='1234567890',
+            order_number='an-order-number',
+            amount=100,
+            currency_code='NOK',
+            success=True,
+            auto_auth=True)
+
+    def test_an_operation_costs_one_narrow_read_one_insert_and_one_balance_update(self):
+        with self.assertNumQueries(3) as context:
+            actions.capture(self.payment.id, 50)
+        read = context.captured_queries[0]['sql']
+        assert 'success' in read and 'transaction_id' in read and 'order_number' not in read
+
+    def test_an_operation_on_a_payment_instance_costs_no_read(self):
+        with self.assertNumQueries(2):
+            operation = actions.capture(self.payment, 50)
+        assert operation.payment_id == self.payment.id
+
+    def test_async_operations_accept_a_payment_instance(self):
+        with self.assertNumQueries(2):
+            operation = async_to_sync(actions.acapture)(self.payment, 50)
+        assert operation.success
+
+
+class AsyncActionsTest(TestCase):
+
+    def test_aregister(self):
+        with patch('netaxept.actions.do_register', return_value=Mock(TransactionId='abc')):
+            payment = async_to_sync(actions.aregister)(
+                order_number='an-order-number',
+                amount=100,
+                currency_code='NOK',
+                redirect_url='http://example.com/')
+        assert payment.success
+        assert Payment.objects.get(pk=payment.pk).transaction_id == 'abc'
+
+    def test_operations_are_in_flight_at_the_same_time(self):
+        payments = [create_payment(str(i)) for i in range(3)]
+        # Every call waits for the others, so this only completes if the gateway calls run concurrently.
+        barrier = threading.Barrier(len(payments), timeout=5)
+
+        async def capture_all():
+            return await asyncio.gather(*[actions.acapture(payment.id, amount=50) for payment in payments])
+
+        with patch('netaxept.actions.do_process', side_effect=lambda **kwargs: barrier.wait()):
+            operations = async_to_sync(capture_all)()
+
+        assert [o.success for o in operations] == [True, True, True]
+        assert Operation.objects.filter(operation=Operation.CAPTURE, amount=50).count() == 3
+
+    def test_an_unsuccesful_payment_cannot_go_on_thru_asale(self):
+        payment = create_payment()
+        Payment.objects.filter(pk=payment.pk).update(success=False)
+        with raises(PaymentRegistrationNotCompleted):
+            async_to_sync(actions.asale)(payment.id)
+
+
+class DeferredOperationsTest(TestCase):
+
+    def setUp(self):
+        self.payment = Payment.objects.create(transaction_id='abc', order_number='an-order-number', amount=100,
+                                              currency_code='NOK', success=True, auto_auth=False,
+                                              state=Payment.AUTHORIZED, authorized_amount=100)
+
+    def test_deferred_operations_are_enqueued(self):
+        with patch('netaxept.actions.do_process') as do_process:
+            operation = actions.capture(self.payment.id, 60, deferred=True)
+        do_process.assert_not_called()
+        assert operation.status == Operation.PENDING
+        assert operation.success is None
+        assert Payment.objects.get().captured_amount == 0
+
+    def test_operations_can_be_deferred_by_default(self):
+        with patch('netaxept.gateway.DEFER_OPERATIONS', True):
+            assert actions.capture(self.payment.id).status == Operation.PENDING
+            assert actions.auth(self.payment, deferred=False).status == Operation.DONE
+
+    def test_async_operations_can_be_deferred(self):
+        with patch('netaxept.actions.do_process') as do_process:
+            operation = async_to_sync(actions.acapture)(self.payment.id, 60, deferred=True)
+            with patch('netaxept.gateway.DEFER_OPERATIONS', True):
+                assert async_to_sync(actions.aannul)(self.payment).status == Operation.PENDING
+        do_process.assert_not_called()
+        assert Operation.objects.get(pk=operation.pk).status == Operation.PENDING
+
+    def test_pending_operations_are_processed(self):
+        first = actions.capture(self.payment.id, 60, deferred=True)
+        second = actions.capture(self.payment.id, 40, deferred=True)
+        with patch('netaxept.actions.do_process') as do_process:
+            operations = actions.process_pending_operations()
+        assert [o.id for o in operations] == [first.id, second.id]
+        assert do_process.call_count == 2
+        assert [(o.status, o.success) for o in Operation.objects.order_by('id')] == [
+            (Operation.DONE, True), (Operation.DONE, True)]
+        assert Payment.objects.get().captured_amount == 100
+        assert actions.process_pending_operations() == []
+
+    def test_failures_are_recorded(self):
+        refused = actions.capture(self.payment.id, deferred=True)
+        with patch('netaxept.actions.do_process', side_effect=bbs_exception('99', 'Refused', 'Refused by issuer')):
+            actions.process_pending_operations()
+        refused.refresh_from_db()
+        assert (refused.status, refused.success, refused.response_code) == (Operation.DONE, False, '99')
+
+        # Refused locally, the payment was annulled in the meantime.
+        annulled = actions.capture(self.payment.id, deferred=True)
+        actions.annul(self.payment.id)
+        actions.process_pending_operations()
+        annulled.refresh_from_db()
+        assert (annulled.status, annulled.success, annulled.response_text) == (
+            Operation.DONE, False, actions.PaymentAnnulled.msg)
+
+    def test_calls_without_answer_are_recorded(self):
+        with patch('netaxept.actions.do_process', side_effect=ConnectionError()):
+            with raises(ConnectionError):
+                actions.capture(self.payment.id, 60)
+        operation = Operation.objects.get()
+        assert (operation.status, operation.success) == (Operation.DONE, None)
+        assert Payment.objects.get().captured_amount == 0
+
+    def test_calls_that_never_left_are_not_recorded(self):
+        with patch('netaxept.actions.do_process', side_effect=GatewayUnavailable()):
+            with raises(GatewayUnavailable):
+                actions.capture(self.payment.id, 60)
+        assert not Operation.objects.exists()
+
+    def test_operations_without_answer_are_recorded_with_an_unknown_success(self):
+        operation = actions.capture(self.payment.id, deferred=True)
+        with patch('netaxept.actions.do_process', side_effect=requests.ReadTimeout()):
+            actions.process_pending_operations()
+        operation.refresh_from_db()
+        assert (operation.status, operation.success, operation.response_text) == (
+            Operation.DONE, None, 'ReadTimeout()')
+        assert Payment.objects.get().captured_amount == 0
+
+    def test_operations_go_back_to_the_queue_while_netaxept_is_unavailable(self):
+        operation = actions.capture(self.payment.id, deferred=True)
+        with patch('netaxept.actions.do_process', side_effect=GatewayUnavailable()):
+            actions.process_pending_operations()
+        operation.refresh_from_db()
+        assert (operation.status, operation.success) == (Operation.PENDING, None)
+
+
+class BulkActionsTest(TestCase):
+
+    def test_bulk_capture_reports_every_payment(self):
+        ok = create_payment('ok')
+        refused = create_payment('refused')
+        unregistered = create_payment('unregistered', success=False)
+        missing_id = unregistered.id + 1000
+
+        def process(transaction_id, operation, amount, merchant):
+            if transaction_id == 'refused':
+                raise bbs_exception('99', 'Refused', 'Refused by issuer')
+
+        with patch('netaxept.actions.do_process', side_effect=process) as do_process:
+            results = actions.bulk_capture([ok.id, refused.id, unregistered.id, missing_id],
+                                           amounts={ok.id: 40}, concurrency=2, batch_size=3)
+
+        assert do_process.call_count == 2
+        assert [r.payment_id for r in results] == [ok.id, refused.id, unregistered.id, missing_id]
+        assert results[0].operation.success and results[0].error is None
+        assert not results[1].operation.success and isinstance(results[1].error, suds.WebFault)
+        assert isinstance(results[2].error, PaymentRegistrationNotCompleted)
+        assert isinstance(results[3].error, Payment.DoesNotExist)
+
+        assert Operation.objects.get(payment=ok).amount == 40
+        assert Operation.objects.get(payment=refused).response_code == '99'
+        assert Operation.objects.count() == 2
+
+    def test_a_payment_listed_twice_is_counted_twice(self):
+        payment = create_payment('1')
+        with patch('netaxept.actions.do_process'):
+            results = actions.bulk_capture([payment.id, payment.id], amounts={payment.id: 40})
+        assert [r.operation.success for r in results] == [True, True]
+        assert Payment.objects.get().captured_amount == 80
+
+    def test_bulk_credit_accepts_a_queryset(self):
+        for i in range(5):
+            create_payment(str(i))
+        Payment.objects.update(state=Payment.CAPTURED, captured_amount=100)
+        with patch('netaxept.actions.do_process'):
+            results = actions.bulk_credit(Payment.objects.all(), batch_size=2)
+        assert len(results) == 5
+        assert Operation.objects.filter(operation=Operation.CREDIT, success=True).count() == 5
+        assert list(Payment.objects.values_list('state', 'credited_amount').distinct()) == [(Payment.CREDITED, 100)]
+
+    def test_calls_without_answer_are_recorded(self):
+        payment = create_payment('1')
+        with patch('netaxept.actions.do_process', side_effect=ConnectionError()):
+            [result] = actions.bulk_annul([payment.id])
+        assert isinstance(result.error, ConnectionError)
+        operation = Operation.objects.get()
+        assert result.operation.transaction_id == operation.transaction_id
+        assert operation.success is None and operation.response_text == 'ConnectionError()'
+
+    def test_calls_that_never_left_are_not_recorded(self):
+        payment = create_payment('1')
+        with patch('netaxept.actions.do_process', side_effect=GatewayUnavailable()):
+            [result] = actions.bulk_annul([payment.id])
+        assert result.operation is None
+        assert isinstance(result.error, GatewayUnavailable)
+        assert not Operation.objects.exists()
@@ -0,0 +1,85 @@
+from datetime import datetime
+
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.test import RequestFactory, TestCase
+
+from netaxept.admin import EstimatedCountPaginator, annotate_operations
+from netaxept.models import Payment, Operation, ArchivedPayment
+
+
+def create_payment(index, operations=()):
+    payment = Payment.objects.create(
+        transaction_id='t{}'.format(index), order_number=str(index), amount=100, currency_code='NOK',
+        redirect_url='http://example.com/', success=True, auto_auth=False)
+    for operation in operations:
+        Operation.objects.create(payment=payment, transaction_id=payment.transaction_id, operation=operation,
+                                 amount=100, success=operation != Operation.CREDIT)
+    return payment
+
+
+class PaymentAdminTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.payment_admin = admin.site._registry[Payment]
+
+    def changelist(self):
+        request = RequestFactory().get('/admin/netaxept/payment/')
+        request.user = self.user
+        return self.payment_admin.changelist_view(request).render()
+
+    def test_the_operations_are_annotated(self):
+        create_payment(1, [Operation.AUTH, Operation.CAPTURE, Operation.CREDIT])
+        create_payment(2)
+        payments = {p.order_number: p for p in annotate_operations(Payment.objects.all())}
+        assert payments['1'].operation_count == 3
+        assert payments['1'].last_operation == Operation.CREDIT
+        assert payments['1'].last_operation_success is False
+        assert payments['2'].operation_count == 0
+        assert payments['2'].last_operation is None
+
+    def test_the_number_of_queries_does_not_depend_on_the_number_of_rows(self):
+        create_payment(0, [Operation.AUTH])
+        with self.assertNumQueries(5) as context:
+            self.changelist()
+        # The operations are looked at by the query of the page only.
+        assert ['netaxept_operation' in query['sql'] for query in context.captured_queries].count(True) == 1
+        for index in range(1, 10):
+            create_payment(index, [Operation.AUTH, Operation.CAPTURE])
+        with self.assertNumQueries(5):
+            response = self.changelist()
+        assert b'10 payments' in response.content
+
+
+class EstimatedCountPaginatorTest(TestCase):
+
+    def test_it_counts_when_there_are_no_statistics(self):
+        create_payment(1)
+        create_payment(2)
+        paginator = EstimatedCountPaginator(Payment.objects.order_by('pk'), 100)
+        assert paginator.count == 2
+
+    def test_filtered_lists_are_counted(self):
+        create_payment(1)
+        paginator = EstimatedCountPaginator(Payment.objects.filter(success=False).order_by('pk'), 100)
+        assert paginator._estimated_count() is None
+        assert paginator.count == 0
+
+
+class ArchivedPaymentAdminTest(TestCase):
+
+    def test_the_archive_can_be_searched_but_not_changed(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        ArchivedPayment.objects.create(
+            id=1, created=datetime(2019, 1, 1), modified=datetime(2019, 1, 1), transaction_id='t1',
+            order_number='an-order', amount=100, currency_code='NOK', redirect_url='http://example.com/',
+            success=True, auto_auth=False, state=Payment.CAPTURED)
+        archived_payment_admin = admin.site._registry[ArchivedPayment]
+        request = RequestFactory().get('/admin/netaxept/archivedpayment/', {'q': 'an-order'})
+        request.user = user
+
+        response = archived_payment_admin.changelist_view(request).render()
+
+        assert b'1 archived payment' in response.content
+        assert not archived_payment_admin.has_change_permission(request)
@@ -0,0 +1,53 @@
+import suds
+from django.test import SimpleTestCase
+from pytest import raises
+
+from netaxept.backends.fake import FakeBackend
+
+
+class FakeBackendTest(SimpleTestCase):
+
+    def register(self, backend, auto_auth=False):
+        return backend.register(order_number='an-order-number', amount=100, currency_code='NOK', description=None,
+                                redirect_url='http://example.com/', auto_auth=auto_auth).TransactionId
+
+    def test_it_follows_the_payment_lifecycle(self):
+        backend = FakeBackend()
+        transaction_id = self.register(backend)
+        backend.process(transaction_id, 'AUTH')
+        backend.process(transaction_id, 'CAPTURE', 60)
+        backend.process(transaction_id, 'CAPTURE')
+        response = backend.process(transaction_id, 'CREDIT', 100)
+        assert response.ResponseCode == 'OK'
+
+    def test_it_refuses_what_netaxept_refuses(self):
+        backend = FakeBackend()
+        transaction_id = self.register(backend)
+        with raises(suds.WebFault) as excinfo:
+            backend.process(transaction_id, 'CAPTURE')
+        assert excinfo.value.fault.detail.BBSException.Result.ResponseText == 'Transaction not authorized'
+
+        transaction_id = self.register(backend, auto_auth=True)
+        with raises(suds.WebFault):
+            backend.process(transaction_id, 'CAPTURE', 101)
+
+    def test_it_can_be_queried(self):
+        backend = FakeBackend()
+        transaction_id = self.register(backend)
+        backend.process(transaction_id, 'AUTH')
+        backend.process(transaction_id, 'CAPTURE', 60)
+        response = backend.query(transaction_id)
+        assert response.OrderInformation.Amount == '100'
+        assert response.Summary.Authorized
+        assert response.Summary.AmountCaptured == '60'
+        with raises(suds.WebFault):
+            backend.query('unknown')
+
+    def test_it_accepts_unknown_transactions(self):
+        FakeBackend().process('unknown', 'CAPTURE', 100)
+
+    def test_it_simulates_errors(self):
+        backend = FakeBackend(error_rate=1)
+        with raises(suds.WebFault) as excinfo:
+            self.register(backend)
+        assert excinfo.value.fault.detail.BBSException.Result.ResponseCode == '99'
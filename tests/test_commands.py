@@ -0,0 +1,205 @@
+import csv
+import gzip
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from pytest import raises
+
+from netaxept import actions, gateway
+from netaxept.management.commands.netaxept_reconcile import RateLimiter
+from netaxept.models import Payment, Operation, ArchivedPayment, ArchivedOperation
+from .factories import create_payment
+
+
+class SettleTest(TestCase):
+
+    def setUp(self):
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+
+    def settle(self, **options):
+        out = StringIO()
+        call_command('netaxept_settle', stdout=out, checkpoint=self.checkpoint, **options)
+        return out.getvalue()
+
+    def test_it_captures_eligible_payments(self):
+        eligible = create_payment('1')
+        create_payment('2', success=False)
+        already_captured = create_payment('3')
+        Operation.objects.create(payment=already_captured, transaction_id='3', operation=Operation.CAPTURE,
+                                 success=True)
+
+        with patch('netaxept.actions.do_process') as do_process:
+            out = self.settle(chunk_size=2)
+
+        do_process.assert_called_once_with(transaction_id='1', operation=Operation.CAPTURE, amount=None,
+                                           merchant='')
+        assert Operation.objects.filter(payment=eligible, operation=Operation.CAPTURE, success=True).exists()
+        assert 'capture: 1 payments' in out
+        assert 'ops/s' in out and 'p99=' in out
+        assert not os.path.exists(self.checkpoint)
+
+    def test_it_skips_the_payments_with_nothing_to_do(self):
+        create_payment('1', state=Payment.ANNULLED)
+        create_payment('2', state=Payment.AUTHORIZED, authorized_amount=100)
+        create_payment('3', state=Payment.CAPTURED, captured_amount=100)
+        create_payment('4', state=Payment.CREDITED, captured_amount=100, credited_amount=100)
+
+        with patch('netaxept.actions.do_process') as do_process:
+            self.settle()
+            assert [c[1]['transaction_id'] for c in do_process.call_args_list] == ['2']
+            do_process.reset_mock()
+            out = self.settle(operation='credit')
+        # '2' was captured by the first run.
+        assert [c[1]['transaction_id'] for c in do_process.call_args_list] == ['2', '3']
+        assert 'credit: 2 payments' in out and '0 failures' in out
+
+    def test_a_crashed_run_resumes_after_the_checkpoint(self):
+        payments = [create_payment(str(i)) for i in range(5)]
+
+        def crash_on_the_fourth(transaction_id, operation, amount, merchant):
+            if transaction_id == '3':
+                raise KeyboardInterrupt()
+
+        with patch('netaxept.actions.do_process', side_effect=crash_on_the_fourth):
+            with raises(KeyboardInterrupt):
+                self.settle(chunk_size=2, concurrency=1)
+        with open(self.checkpoint) as f:
+            assert json.load(f)['last_payment_id'] == payments[1].id
+
+        with patch('netaxept.actions.do_process') as do_process:
+            self.settle(chunk_size=2)
+        assert sorted(c[1]['transaction_id'] for c in do_process.call_args_list) == ['2', '3', '4']
+
+
+class ArchiveTest(TestCase):
+
+    def setUp(self):
+        self.settled = create_payment('1', state=Payment.CREDITED, captured_amount=100, credited_amount=100)
+        Operation.objects.create(payment=self.settled, transaction_id='1', operation=Operation.SALE, amount=100,
+                                 success=True)
+        self.failed = create_payment('2', success=False)
+        self.authorized = create_payment('3', state=Payment.AUTHORIZED)
+        self.recent = create_payment('4', state=Payment.CAPTURED)
+        self.creditable = create_payment('5', state=Payment.CAPTURED, captured_amount=100)
+        Payment.objects.exclude(pk=self.recent.pk).update(created=datetime(2019, 1, 1))
+
+    def archive(self, **options):
+        out = StringIO()
+        call_command('netaxept_archive', stdout=out, created_before='2019-06-01', chunk_size=1, **options)
+        return out.getvalue()
+
+    def test_it_moves_the_old_settled_payments_to_the_archive(self):
+        out = self.archive()
+
+        assert '2 payments archived' in out
+        assert set(Payment.objects.values_list('transaction_id', flat=True)) == {'3', '4', '5'}
+        assert not Operation.objects.exists()
+        archived = ArchivedPayment.objects.get(transaction_id='1')
+        assert archived.id == self.settled.id
+        assert archived.created.year == 2019
+        assert archived.credited_amount == 100
+        assert ArchivedOperation.objects.get().payment == archived
+        assert ArchivedPayment.objects.filter(transaction_id='2', success=False).exists()
+
+    def test_it_exports_to_a_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'archive.jsonl.gz')
+
+        self.archive(export=path)
+
+        with gzip.open(path, 'rt') as f:
+            lines = [json.loads(line) for line in f]
+        assert [line['transaction_id'] for line in lines] == ['1', '2']
+        assert [operation['operation'] for operation in lines[0]['operations']] == [Operation.SALE]
+        assert not ArchivedPayment.objects.exists()
+        assert Payment.objects.count() == 3
+
+    def test_the_payments_that_can_still_be_credited_are_kept_unless_asked(self):
+        self.archive()
+        assert Payment.objects.filter(pk=self.creditable.pk).exists()
+        self.archive(include_creditable=True)
+        assert ArchivedPayment.objects.filter(pk=self.creditable.pk).exists()
+        assert set(Payment.objects.values_list('transaction_id', flat=True)) == {'3', '4'}
+
+
+class WorkerTest(TestCase):
+
+    def test_it_processes_the_pending_operations_and_exits(self):
+        payment = create_payment('1', state=Payment.AUTHORIZED)
+        Operation.objects.create(payment=payment, transaction_id='1', operation=Operation.CAPTURE,
+                                 status=Operation.PENDING)
+        out = StringIO()
+
+        with patch('netaxept.actions.do_process') as do_process:
+            call_command('netaxept_worker', stdout=out, once=True, batch_size=1)
+
+        do_process.assert_called_once_with(transaction_id='1', operation=Operation.CAPTURE, amount=None,
+                                           merchant='')
+        assert Operation.objects.get().status == Operation.DONE
+        assert '1 operations processed, 0 failures' in out.getvalue()
+
+
+class ReconcileTest(TestCase):
+
+    def setUp(self):
+        self.report = os.path.join(tempfile.mkdtemp(), 'report.csv')
+        # Authorized on the terminal pages, and captured without us knowing.
+        self.drifted = actions.register(order_number='1', amount=100, currency_code='NOK',
+                                        redirect_url='http://example.com/', auto_auth=True)
+        gateway.do_process(self.drifted.transaction_id, Operation.CAPTURE, 60)
+        self.in_sync = actions.register(order_number='2', amount=100, currency_code='NOK',
+                                        redirect_url='http://example.com/')
+        self.unknown = create_payment('unknown-to-netaxept')
+
+    def reconcile(self, **options):
+        out = StringIO()
+        call_command('netaxept_reconcile', stdout=out, stderr=StringIO(), report=self.report, chunk_size=2,
+                     **options)
+        return out.getvalue()
+
+    def test_it_reports_the_differences(self):
+        out = self.reconcile()
+
+        assert '3 payments checked' in out and '2 differences, 1 errors, 0 payments fixed' in out
+        with open(self.report) as f:
+            rows = list(csv.DictReader(f))
+        assert [(r['payment_id'], r['field'], r['local'], r['netaxept']) for r in rows[:2]] == [
+            (str(self.drifted.id), 'captured_amount', '0', '60'),
+            (str(self.drifted.id), 'authorized', 'False', 'True'),
+        ]
+        assert rows[2]['payment_id'] == str(self.unknown.id) and rows[2]['field'] == 'error'
+        assert Payment.objects.get(pk=self.drifted.pk).captured_amount == 0
+
+    def test_it_fixes_the_payments(self):
+        out = self.reconcile(fix=True)
+
+        assert '1 payments fixed' in out
+        payment = Payment.objects.get(pk=self.drifted.pk)
+        assert (payment.state, payment.authorized_amount, payment.captured_amount) == (Payment.CAPTURED, 100, 60)
+        assert Payment.objects.get(pk=self.in_sync.pk).state == Payment.REGISTERED
+
+    def test_it_warns_when_the_queries_are_not_limited(self):
+        err = StringIO()
+        call_command('netaxept_reconcile', stdout=StringIO(), stderr=err)
+        assert 'not limited' in err.getvalue()
+        for options, rate_limit in [({'rate': 50}, None), ({}, 50)]:
+            err = StringIO()
+            with patch('netaxept.gateway.RATE_LIMIT', rate_limit):
+                call_command('netaxept_reconcile', stdout=StringIO(), stderr=err, **options)
+            assert err.getvalue() == ''
+
+
+class RateLimiterTest(SimpleTestCase):
+
+    def test_the_calls_are_spaced(self):
+        rate_limiter = RateLimiter(rate=100)
+        start = time.monotonic()
+        for _ in range(5):
+            rate_limiter.wait()
+        assert time.monotonic() - start >= 0.04
@@ -0,0 +1,588 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from unittest.mock import Mock, patch
+from xml.etree.ElementTree import canonicalize
+
+import requests
+import suds
+from django.apps import apps
+from django.test import TestCase
+from pytest import raises
+from suds.options import Options
+
+from netaxept import gateway, signals
+from netaxept.actions import TransactionStatus, _handle_response_exception, _parse_query_response, \
+    _read_process_response
+from netaxept.backends import bbs_exception
+from netaxept.backends.fake import FakeBackend
+from netaxept.backends.lite import LiteBackend
+from netaxept.backends.soap import SoapBackend, _build_register_request, _clone, _get_transport
+from netaxept.gateway import BATCH, INTERACTIVE, CircuitBreaker, GatewayUnavailable, RateLimited, \
+    SharedRateLimiter
+from netaxept.models import Operation, Payment
+
+WSDL = 'file://' + os.path.join(os.path.dirname(__file__), 'wsdl', 'netaxept.wsdl')
+
+PROCESS_RESPONSE = b"""<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>
+<ProcessResponse xmlns="http://BBS.EPayment"><ProcessResult
+ xmlns:a="http://schemas.datacontract.org/2004/07/BBS.EPayment.ServiceLibrary">
+<a:Operation>CAPTURE</a:Operation><a:ResponseCode>OK</a:ResponseCode><a:TransactionId>abc</a:TransactionId>
+</ProcessResult></ProcessResponse></s:Body></s:Envelope>"""
+
+REGISTER_RESPONSE = b"""<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>
+<RegisterResponse xmlns="http://BBS.EPayment"><RegisterResult
+ xmlns:a="http://schemas.datacontract.org/2004/07/BBS.EPayment.ServiceLibrary">
+<a:TransactionId>abc</a:TransactionId></RegisterResult></RegisterResponse></s:Body></s:Envelope>"""
+
+FAULT_RESPONSE = b"""<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body><s:Fault>
+<faultcode>s:Client</faultcode><faultstring>Unable to find transaction</faultstring></s:Fault></s:Body></s:Envelope>"""
+
+BBS_FAULT_RESPONSE = b"""<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body><s:Fault>
+<faultcode>s:Client</faultcode><faultstring>Refused</faultstring><detail><BBSException xmlns="http://BBS.EPayment"
+ xmlns:i="http://www.w3.org/2001/XMLSchema-instance"><Message>Refused</Message><Result><IssuerId i:nil="true"/>
+<ResponseCode>99</ResponseCode><ResponseSource>Netaxept</ResponseSource>
+<ResponseText>Auth Reg Comp Failure</ResponseText></Result></BBSException></detail></s:Fault></s:Body></s:Envelope>"""
+
+QUERY_RESPONSE = b"""<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>
+<QueryResponse xmlns="http://BBS.EPayment"><QueryResult
+ xmlns:a="http://schemas.datacontract.org/2004/07/BBS.EPayment.ServiceLibrary">
+<a:MerchantId>1</a:MerchantId><a:QueryFinished>2019-05-01T12:00:00</a:QueryFinished><a:TransactionId>abc</a:TransactionId>
+<a:OrderInformation><a:Amount>100</a:Amount><a:Currency>NOK</a:Currency><a:OrderNumber>42</a:OrderNumber>
+</a:OrderInformation><a:Summary><a:AmountCaptured>60</a:AmountCaptured><a:AmountCredited>0</a:AmountCredited>
+<a:Annulled>false</a:Annulled><a:AuthorizationId>123456</a:AuthorizationId><a:Authorized>true</a:Authorized>
+</a:Summary></QueryResult></QueryResponse></s:Body></s:Envelope>"""
+
+
+class SoapClientTest(TestCase):
+
+    def setUp(self):
+        self.backend = SoapBackend()
+        patcher = patch('netaxept.backends.soap.Client')
+        self.Client = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.Client.side_effect = lambda *args, **kwargs: Mock(
+            options=Options(transport=_get_transport()), wsdl=Mock(services=[]))
+
+    def test_the_wsdl_is_loaded_only_once(self):
+        first = self.backend._get_client()
+        second = self.backend._get_client()
+        assert first is second
+        assert self.Client.call_count == 1
+
+    def test_each_thread_gets_its_own_clone(self):
+        clients = []
+
+        def get_client():
+            clients.append(self.backend._get_client())
+
+        threads = [threading.Thread(target=get_client) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(set(map(id, clients))) == 3
+        assert self.Client.call_count == 1
+
+
+class SoapBackendTest(TestCase):
+
+    def setUp(self):
+        self.session = Mock()
+        patchers = [
+            patch('netaxept.gateway.WSDL', WSDL),
+            patch('netaxept.gateway.OPERATION_TIMEOUTS', {'Process': (5, 60)}),
+            patch('netaxept.backends.soap.get_session', return_value=self.session),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.backend = SoapBackend()
+
+    def test_warm_up_loads_the_wsdl(self):
+        self.backend.warm_up()
+        assert self.backend._shared_client is not None
+
+    def test_clones_share_the_wsdl_and_the_session(self):
+        client = self.backend._get_client()
+        shared_client = self.backend._get_shared_client()
+        assert client is not shared_client
+        assert client.wsdl is shared_client.wsdl
+        assert client.options.transport.session is self.session
+
+    def test_register(self):
+        self.session.post.return_value = Mock(status_code=200, headers={}, content=REGISTER_RESPONSE)
+        response = self.backend.register('42', 100, 'NOK', 'A & B', 'http://example.com/?a=1&b=2', False)
+        assert response.TransactionId == 'abc'
+        call = self.session.post.call_args
+        assert call[1]['headers']['SOAPAction'] == b'"http://BBS.EPayment/INetaxept/Register"'
+        assert b'Description>A &amp; B</' in call[1]['data']
+        assert b'RedirectUrl>http://example.com/?a=1&amp;b=2</' in call[1]['data']
+
+    def test_the_requests_are_rendered_like_suds_does(self):
+        self.session.post.return_value = Mock(status_code=200, headers={}, content=REGISTER_RESPONSE)
+        values = {'merchant_id': 'merchant', 'token': 'a<b>"c\'d', 'order_number': '<42>', 'amount': 100,
+                  'currency_code': 'NOK', 'description': None, 'redirect_url': 'http://example.com/?a=1&b=2',
+                  'auto_auth': True}
+        with patch('netaxept.gateway.MERCHANTID', 'merchant'), patch('netaxept.gateway.TOKEN', values['token']):
+            self.backend.register('<42>', 100, 'NOK', None, 'http://example.com/?a=1&b=2', True)
+
+        client = _clone(self.backend._get_shared_client())
+        client.options.nosend = True
+        expected = client.service.Register('merchant', values['token'], _build_register_request(client, values))
+        assert self.session.post.call_args[1]['data'] == expected.envelope
+
+    def test_the_templates_are_rendered_once_per_shape(self):
+        self.session.post.return_value = Mock(status_code=200, headers={}, content=PROCESS_RESPONSE)
+        self.backend.process('abc', 'CAPTURE', 100)
+        self.backend.process('def', 'CAPTURE', 200)
+        self.backend.process('abc', 'ANNUL')
+        assert len(self.backend._templates) == 2
+        assert b'TransactionAmount' not in self.session.post.call_args[1]['data']
+
+    def test_faults_are_raised(self):
+        self.session.post.return_value = Mock(status_code=500, reason='Internal Server Error', headers={},
+                                              content=FAULT_RESPONSE)
+        with raises(suds.WebFault) as excinfo:
+            self.backend.process('abc', 'CAPTURE', 100)
+        assert excinfo.value.fault.faultstring == 'Unable to find transaction'
+
+    def test_unavailable_is_retried(self):
+        unavailable = Mock(status_code=503, reason='Service Unavailable', headers={}, content=b'')
+        self.session.post.return_value = unavailable
+        with raises(suds.transport.TransportError) as excinfo:
+            self.backend.process('abc', 'CAPTURE', 100)
+        assert gateway.is_retryable(excinfo.value, 'CAPTURE') and gateway.is_retryable(excinfo.value, 'REGISTER')
+
+        self.session.post.side_effect = [unavailable, Mock(status_code=200, headers={}, content=PROCESS_RESPONSE)]
+        with patch('netaxept.gateway._backend', self.backend), patch('netaxept.gateway.RETRY_BACKOFF', 0):
+            assert gateway.do_process('abc', 'CAPTURE', 100).ResponseCode == 'OK'
+
+    def test_process(self):
+        self.session.post.return_value = Mock(status_code=200, headers={}, content=PROCESS_RESPONSE)
+        response = self.backend.process('abc', 'CAPTURE', 100)
+        assert response.ResponseCode == 'OK'
+        operation = Operation()
+        _read_process_response(response, operation)
+        assert type(operation.response_code) is str
+        body = self.session.post.call_args[1]['data']
+        assert b'TransactionAmount>100</' in body
+        # The Process operation gets its own timeout.
+        assert self.session.post.call_args[1]['timeout'] == (5, 60)
+
+    def test_query(self):
+        self.session.post.return_value = Mock(status_code=200, headers={}, content=QUERY_RESPONSE)
+        status = _parse_query_response(self.backend.query('abc'))
+        assert status == TransactionStatus(
+            transaction_id='abc', order_number='42', amount=100, currency_code='NOK', authorized=True,
+            authorization_id='123456', captured_amount=60, credited_amount=0, annulled=False,
+            query_finished=datetime(2019, 5, 1, 12, 0))
+        assert b'TransactionId>abc</' in self.session.post.call_args[1]['data']
+
+
+class LiteBackendTest(TestCase):
+
+    def setUp(self):
+        self.session = Mock()
+        patchers = [
+            patch('netaxept.gateway.WSDL', WSDL),
+            patch('netaxept.gateway.OPERATION_TIMEOUTS', {'Process': (5, 60)}),
+            patch('netaxept.backends.soap.get_session', return_value=self.session),
+            patch('netaxept.backends.lite.get_session', return_value=self.session),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.backend = LiteBackend(location='https://example.com/Netaxept.svc')
+
+    def test_the_requests_are_the_requests_of_the_soap_backend(self):
+        calls = [
+            ('register', REGISTER_RESPONSE, ('<42>', 100, 'NOK', "A & 'B'", 'http://example.com/?a=1&b=2', True)),
+            ('register', REGISTER_RESPONSE, ('42', 100, 'NOK', None, 'http://example.com/', False)),
+            ('process', PROCESS_RESPONSE, ('abc', 'CAPTURE', 100)),
+            ('process', PROCESS_RESPONSE, ('abc', 'ANNUL')),
+            ('query', QUERY_RESPONSE, ('abc',)),
+        ]
+        soap_backend = SoapBackend()
+        for method, content, args in calls:
+            self.session.post.return_value = Mock(status_code=200, headers={}, content=content)
+            getattr(soap_backend, method)(*args)
+            expected = self.session.post.call_args[1]
+            getattr(self.backend, method)(*args)
+            actual = self.session.post.call_args[1]
+            assert canonicalize(actual['data'], rewrite_prefixes=True) == \
+                canonicalize(expected['data'], rewrite_prefixes=True)
+            assert actual['headers']['SOAPAction'] == expected['headers']['SOAPAction'].decode('ascii')
+            assert actual['timeout'] == expected['timeout']
+
+    def test_register(self):
+        self.session.post.return_value = Mock(status_code=200, content=REGISTER_RESPONSE)
+        response = self.backend.register('42', 100, 'NOK', None, 'http://example.com/', False)
+        assert response.TransactionId == 'abc'
+        assert self.session.post.call_args[0] == ('https://example.com/Netaxept.svc',)
+
+    def test_process(self):
+        self.session.post.return_value = Mock(status_code=200, content=PROCESS_RESPONSE)
+        operation = Operation()
+        _read_process_response(self.backend.process('abc', 'CAPTURE', 100), operation)
+        assert operation.response_code == 'OK'
+        assert self.session.post.call_args[1]['timeout'] == (5, 60)
+
+    def test_query(self):
+        self.session.post.return_value = Mock(status_code=200, content=QUERY_RESPONSE)
+        status = _parse_query_response(self.backend.query('abc'))
+        assert status == TransactionStatus(
+            transaction_id='abc', order_number='42', amount=100, currency_code='NOK', authorized=True,
+            authorization_id='123456', captured_amount=60, credited_amount=0, annulled=False,
+            query_finished=datetime(2019, 5, 1, 12, 0))
+
+    def test_refusals_raise_a_fault(self):
+        self.session.post.return_value = Mock(status_code=500, content=BBS_FAULT_RESPONSE)
+        with raises(suds.WebFault) as excinfo:
+            self.backend.process('abc', 'CAPTURE', 100)
+        payment = Payment()
+        with raises(suds.WebFault):
+            _handle_response_exception(excinfo.value, payment)
+        assert payment.response_code == '99'
+        assert payment.response_source == 'Netaxept'
+        assert payment.response_text == 'Auth Reg Comp Failure'
+        assert payment.response_message == 'Refused'
+
+    def test_other_faults(self):
+        self.session.post.return_value = Mock(status_code=500, content=FAULT_RESPONSE)
+        with raises(suds.WebFault) as excinfo:
+            self.backend.process('abc', 'CAPTURE', 100)
+        assert excinfo.value.fault.faultstring == 'Unable to find transaction'
+
+    def test_unavailable(self):
+        self.session.post.return_value = Mock(status_code=503, reason='Service Unavailable', content=b'')
+        with raises(suds.transport.TransportError) as excinfo:
+            self.backend.process('abc', 'CAPTURE', 100)
+        assert gateway.is_retryable(excinfo.value, 'CAPTURE')
+
+    def test_the_calls_of_a_merchant_use_its_account_and_its_session(self):
+        self.session.post.return_value = Mock(status_code=200, content=QUERY_RESPONSE)
+        merchant = gateway.Merchant('shop-b', 'b-id', 'b&token', WSDL, gateway.TERMINAL)
+        with patch('netaxept.backends.lite.get_session', return_value=self.session) as get_session:
+            LiteBackend(merchant=merchant).query('abc')
+        assert get_session.call_args[1]['name'] == 'shop-b'
+        data = self.session.post.call_args[1]['data']
+        assert b'>b-id</' in data and b'>b&amp;token</' in data
+
+
+class BackendTest(TestCase):
+
+    def setUp(self):
+        gateway.reset_backend()
+        self.addCleanup(gateway.reset_backend)
+
+    def test_the_backend_is_created_once(self):
+        assert gateway.get_backend() is gateway.get_backend()
+
+    def test_the_backend_comes_from_the_settings(self):
+        with patch('netaxept.gateway.BACKEND', 'netaxept.backends.fake.FakeBackend'), \
+                patch('netaxept.gateway.BACKEND_OPTIONS', {'latency': 0.5}):
+            backend = gateway.get_backend()
+        assert isinstance(backend, FakeBackend)
+        assert backend.latency == 0.5
+
+    def test_reset_creates_a_new_backend(self):
+        first = gateway.get_backend()
+        gateway.reset_backend()
+        assert gateway.get_backend() is not first
+
+    def test_warm_up(self):
+        backend = Mock()
+        with patch('netaxept.gateway._backend', backend):
+            gateway.warm_up()
+        backend.warm_up.assert_called_once_with()
+
+    def test_the_app_warms_up_the_backend_when_configured(self):
+        with patch('netaxept.gateway.warm_up') as warm_up:
+            apps.get_app_config('netaxept').ready()
+            assert not warm_up.called
+            with patch('netaxept.gateway.WARM_UP', True):
+                apps.get_app_config('netaxept').ready()
+            assert warm_up.called
+
+    def test_the_soap_stack_is_loaded_on_first_use(self):
+        script = ('import sys, django; django.setup(); import netaxept.actions, netaxept.admin, '
+                  'netaxept.views.example; print(sorted({"suds.client", "requests"} & set(sys.modules)))')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output(
+            [sys.executable, '-c', script], cwd=root,
+            env=dict(os.environ, PYTHONPATH=root, DJANGO_SETTINGS_MODULE='tests.settings'))
+        assert output.strip() == b'[]'
+
+
+def load_merchant(name):
+    if name == 'shop-c':
+        return {'MERCHANTID': 'c-id', 'TOKEN': 'c-token'}
+
+
+class MerchantTest(TestCase):
+
+    def setUp(self):
+        gateway.reset_backend()
+        self.addCleanup(gateway.reset_backend)
+        patchers = [
+            patch('netaxept.gateway.MERCHANTS', {
+                'shop-b': {'MERCHANTID': 'b-id', 'TOKEN': 'b-token', 'TERMINAL': 'https://terminal.example/b'}}),
+            patch('netaxept.gateway.MERCHANT_LOADER', 'tests.test_gateway.load_merchant'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_the_default_merchant_comes_from_the_settings(self):
+        with patch('netaxept.gateway.MERCHANTID', 'a-id'), patch('netaxept.gateway.TOKEN', 'a-token'):
+            merchant = gateway.get_merchant()
+        assert merchant == gateway.Merchant('', 'a-id', 'a-token', gateway.WSDL, gateway.TERMINAL)
+
+    def test_the_merchants_come_from_the_settings_or_the_loader(self):
+        assert gateway.get_merchant('shop-b') == gateway.Merchant(
+            'shop-b', 'b-id', 'b-token', gateway.WSDL, 'https://terminal.example/b')
+        assert gateway.get_merchant('shop-c').merchant_id == 'c-id'
+        with raises(gateway.UnknownMerchant):
+            gateway.get_merchant('shop-d')
+
+    def test_each_merchant_has_its_own_backend(self):
+        with patch('netaxept.gateway.BACKEND', 'netaxept.backends.fake.FakeBackend'):
+            backend = gateway.get_backend('shop-b')
+            assert gateway.get_backend('shop-b') is backend
+            assert gateway.get_backend('shop-c') is not backend
+            assert gateway.get_backend() is not backend
+        assert backend.merchant.merchant_id == 'b-id'
+
+    def test_the_calls_go_to_the_backend_of_the_merchant(self):
+        backend = Mock()
+        with patch.dict('netaxept.gateway._merchant_backends', {'shop-b': backend}):
+            gateway.do_process('abc', 'CAPTURE', 100, merchant='shop-b')
+        backend.process.assert_called_once_with(transaction_id='abc', operation='CAPTURE', amount=100)
+
+    def test_each_merchant_has_its_own_rate_limit(self):
+        assert gateway.get_rate_limiter() is gateway.rate_limiter
+        assert gateway.get_rate_limiter('shop-b') is gateway.get_rate_limiter('shop-b')
+        assert gateway.get_rate_limiter('shop-b').name != gateway.get_rate_limiter('shop-c').name
+
+    def test_the_soap_backend_of_a_merchant_uses_its_account(self):
+        session = Mock()
+        session.post.return_value = Mock(status_code=200, headers={}, content=QUERY_RESPONSE)
+        with patch('netaxept.gateway.WSDL', WSDL), \
+                patch('netaxept.backends.soap.get_session', return_value=session) as get_session:
+            SoapBackend(merchant=gateway.get_merchant('shop-b')).query('abc')
+        assert get_session.call_args[1]['name'] == 'shop-b'
+        data = session.post.call_args[1]['data']
+        assert b'>b-id</' in data and b'>b-token</' in data
+
+    def test_the_terminal_url_is_the_url_of_the_merchant(self):
+        url = gateway.get_payment_terminal_url('abc', 'shop-b')
+        assert url == 'https://terminal.example/b?merchantId=b-id&transactionId=abc'
+
+
+class RetryTest(TestCase):
+
+    def setUp(self):
+        self.backend = Mock()
+        patchers = [
+            patch('netaxept.gateway._backend', self.backend),
+            patch('netaxept.gateway.time.sleep'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_connection_errors_are_retried(self):
+        self.backend.process.side_effect = [requests.ConnectTimeout(), Mock(ResponseCode='OK')]
+        assert gateway.do_process('abc', 'CAPTURE', 100).ResponseCode == 'OK'
+        assert self.backend.process.call_count == 2
+
+    def test_operations_are_not_retried_when_netaxept_may_have_received_them(self):
+        self.backend.process.side_effect = requests.ReadTimeout()
+        with raises(requests.ReadTimeout):
+            gateway.do_process('abc', 'CAPTURE', 100)
+        assert self.backend.process.call_count == 1
+
+    def test_registrations_are_retried_after_any_network_error(self):
+        self.backend.register.side_effect = [requests.ReadTimeout(), Mock(TransactionId='abc')]
+        assert gateway.do_register('an-order', 100, 'NOK', None, 'http://example.com/', False).TransactionId == 'abc'
+
+    def test_refusals_are_not_retried(self):
+        self.backend.process.side_effect = bbs_exception('99', 'Refused')
+        with raises(suds.WebFault):
+            gateway.do_process('abc', 'CAPTURE', 100)
+        assert self.backend.process.call_count == 1
+
+    def test_the_attempts_are_limited(self):
+        self.backend.process.side_effect = requests.ConnectTimeout()
+        with patch('netaxept.gateway.RETRY_ATTEMPTS', 2), raises(requests.ConnectTimeout):
+            gateway.do_process('abc', 'CAPTURE', 100)
+        assert self.backend.process.call_count == 2
+
+
+class CircuitBreakerTest(TestCase):
+
+    def setUp(self):
+        self.backend = Mock()
+        self.breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30, cache_alias='default')
+        patchers = [
+            patch('netaxept.gateway._backend', self.backend),
+            patch('netaxept.gateway.breaker', self.breaker),
+            patch('netaxept.gateway.RETRY_ATTEMPTS', 1),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fail(self, count):
+        self.backend.process.side_effect = requests.ConnectionError()
+        for _ in range(count):
+            with raises(requests.ConnectionError):
+                gateway.do_process('abc', 'CAPTURE', 100)
+
+    def test_it_opens_after_repeated_failures(self):
+        self.fail(2)
+        assert self.breaker.state() == CircuitBreaker.OPEN
+        with raises(GatewayUnavailable):
+            gateway.do_process('abc', 'CAPTURE', 100)
+        assert self.backend.process.call_count == 2
+
+    def test_successful_calls_start_the_count_again(self):
+        for _ in range(3):
+            self.fail(1)
+            self.backend.process.side_effect = None
+            gateway.do_process('abc', 'CAPTURE', 100)
+        assert self.breaker.state() == CircuitBreaker.CLOSED
+        self.fail(2)
+        assert self.breaker.state() == CircuitBreaker.OPEN
+
+    def test_refusals_are_not_failures(self):
+        self.backend.process.side_effect = bbs_exception('99', 'Refused')
+        for _ in range(3):
+            with raises(suds.WebFault):
+                gateway.do_process('abc', 'CAPTURE', 100)
+        assert self.breaker.state() == CircuitBreaker.CLOSED
+
+    def test_a_single_call_probes_netaxept_once_the_timeout_elapsed(self):
+        self.fail(2)
+        with patch('netaxept.gateway.time.time', return_value=time.time() + 31):
+            assert self.breaker.state() == CircuitBreaker.HALF_OPEN
+            assert self.breaker.before_call()
+            with raises(GatewayUnavailable):
+                self.breaker.before_call()
+            self.breaker.record_success(probe=True)
+        assert self.breaker.state() == CircuitBreaker.CLOSED
+
+    def test_a_failed_probe_opens_it_again(self):
+        self.fail(2)
+        with patch('netaxept.gateway.time.time', return_value=time.time() + 31):
+            self.fail(1)
+            assert self.breaker.state() == CircuitBreaker.OPEN
+
+
+class Clock:
+    """
+    A clock that only moves when slept on.
+    """
+
+    def __init__(self):
+        self.now = 1000.25
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.now += delay
+
+
+class RateLimiterTest(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.limiter = SharedRateLimiter('test', rate=10, interactive_reserve=0.2,
+                                         max_wait={INTERACTIVE: 0, BATCH: 0}, cache_alias='default')
+        patchers = [
+            patch('netaxept.gateway.time.time', self.clock.time),
+            patch('netaxept.gateway.time.monotonic', self.clock.monotonic),
+            patch('netaxept.gateway.time.sleep', self.clock.sleep),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def acquire(self, priority, count):
+        for _ in range(count):
+            self.limiter.acquire(priority)
+
+    def test_interactive_calls_can_take_the_whole_rate(self):
+        self.acquire(INTERACTIVE, 10)
+        with raises(RateLimited):
+            self.limiter.acquire(INTERACTIVE)
+
+    def test_batch_calls_leave_the_reserve_to_the_interactive_calls(self):
+        self.acquire(BATCH, 8)
+        with raises(RateLimited):
+            self.limiter.acquire(BATCH)
+        self.acquire(INTERACTIVE, 2)
+        assert self.limiter.usage() == {INTERACTIVE: 2, BATCH: 8}
+        with raises(RateLimited):
+            self.limiter.acquire(INTERACTIVE)
+
+    def test_batch_calls_use_what_the_interactive_calls_left(self):
+        self.acquire(INTERACTIVE, 5)
+        self.acquire(BATCH, 3)
+        with raises(RateLimited):
+            self.limiter.acquire(BATCH)
+
+    def test_the_calls_wait_for_the_next_second(self):
+        self.limiter.max_wait = {INTERACTIVE: 1, BATCH: 1}
+        waits = []
+        signals.rate_limit_wait.connect(lambda sender, priority, duration, **kwargs: waits.append(priority),
+                                        weak=False, dispatch_uid='test')
+        self.addCleanup(signals.rate_limit_wait.disconnect, dispatch_uid='test')
+        self.acquire(BATCH, 8)
+        self.limiter.acquire(BATCH)
+        assert 1001 <= self.clock.now < 1001.1
+        assert self.limiter.usage() == {INTERACTIVE: 0, BATCH: 1}
+        assert waits == [BATCH]
+
+    def test_no_rate_no_limit(self):
+        self.limiter.rate = None
+        self.acquire(INTERACTIVE, 100)
+        assert self.limiter.usage() == {INTERACTIVE: 0, BATCH: 0}
+
+    def test_the_calls_are_limited_by_priority(self):
+        backend = Mock()
+        with patch('netaxept.gateway._backend', backend), patch('netaxept.gateway.rate_limiter', self.limiter):
+            gateway.do_register('42', 100, 'NOK', None, 'http://example.com/', False)
+            gateway.do_process('abc', 'CAPTURE', 100)
+            gateway.do_process('abc', 'AUTH')
+            assert self.limiter.usage() == {INTERACTIVE: 2, BATCH: 1}
+            self.acquire(BATCH, 5)
+            with raises(RateLimited):
+                gateway.do_process('abc', 'CREDIT', 100)
+        assert backend.process.call_count == 2
+
+
+class PaymentTerminalUrlTest(TestCase):
+
+    def test_it_builds_the_url_without_contacting_netaxept(self):
+        with patch('requests.Session.send') as send:
+            url = gateway.get_payment_terminal_url('abc 123/+')
+        send.assert_not_called()
+        expected = requests.Request(
+            'GET', gateway.TERMINAL,
+            params={'merchantId': gateway.MERCHANTID, 'transactionId': 'abc 123/+'}).prepare().url
+        assert url == expected
+
+    def test_it_keeps_an_existing_query(self):
+        with patch('netaxept.gateway.TERMINAL', 'https://terminal.example/default.aspx?lang=no'):
+            url = gateway.get_payment_terminal_url('abc')
+        assert url == 'https://terminal.example/default.aspx?lang=no&merchantId=&transactionId=abc'
@@ -0,0 +1,76 @@
+import suds
+from django.test import TestCase, RequestFactory
+from pytest import raises
+
+from netaxept import actions, metrics, signals
+from netaxept.views.metrics import metrics as metrics_view
+
+
+class SignalsTest(TestCase):
+
+    def setUp(self):
+        self.events = []
+        for signal in [signals.gateway_call, signals.db_write]:
+            signal.connect(self.receiver)
+            self.addCleanup(signal.disconnect, self.receiver)
+
+    def receiver(self, signal, sender, **kwargs):
+        self.events.append((signal, kwargs))
+
+    def test_gateway_calls_and_writes_are_reported(self):
+        payment = actions.register(order_number='an-order-number', amount=100, currency_code='NOK',
+                                   redirect_url='http://example.com/')
+        actions.auth(payment.id)
+
+        assert [(s, e['operation']) for s, e in self.events] == [
+            (signals.gateway_call, 'REGISTER'),
+            (signals.db_write, 'REGISTER'),
+            (signals.gateway_call, 'AUTH'),
+            (signals.db_write, 'AUTH'),
+        ]
+        assert all(e['duration'] >= 0 for _, e in self.events)
+        assert self.events[0][1]['response_code'] == 'OK'
+
+    def test_failed_gateway_calls_are_reported_with_their_response_code(self):
+        payment = actions.register(order_number='an-order-number', amount=100, currency_code='NOK',
+                                   redirect_url='http://example.com/')
+        self.events.clear()
+        with raises(suds.WebFault):
+            actions.capture(payment.id)  # Not authorized
+        assert self.events[0][1]['response_code'] == '99'
+
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        metrics.connect()
+        for histogram in metrics.HISTOGRAMS:
+            histogram.reset()
+        self.addCleanup(signals.gateway_call.disconnect, dispatch_uid='netaxept-metrics')
+        self.addCleanup(signals.db_write.disconnect, dispatch_uid='netaxept-metrics')
+        self.addCleanup(signals.wsdl_loaded.disconnect, dispatch_uid='netaxept-metrics')
+        self.addCleanup(signals.rate_limit_wait.disconnect, dispatch_uid='netaxept-metrics')
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('duration_seconds', 'A duration.', ['operation'], buckets=[0.1, 1])
+        histogram.observe(0.05, operation='AUTH')
+        histogram.observe(0.5, operation='AUTH')
+        assert histogram.render().splitlines() == [
+            '# HELP duration_seconds A duration.',
+            '# TYPE duration_seconds histogram',
+            'duration_seconds_bucket{operation="AUTH",le="0.1"} 1',
+            'duration_seconds_bucket{operation="AUTH",le="1"} 2',
+            'duration_seconds_bucket{operation="AUTH",le="+Inf"} 2',
+            'duration_seconds_sum{operation="AUTH"} 0.55',
+            'duration_seconds_count{operation="AUTH"} 2',
+        ]
+
+    def test_the_view_exposes_the_collected_durations(self):
+        actions.register(order_number='an-order-number', amount=100, currency_code='NOK',
+                         redirect_url='http://example.com/')
+        response = metrics_view(RequestFactory().get('/metrics'))
+        content = response.content.decode()
+        assert 'netaxept_gateway_call_duration_seconds_count{operation="REGISTER",response_code="OK"} 1' in content
+        assert 'netaxept_db_write_duration_seconds_count{operation="REGISTER"} 1' in content
+        assert 'netaxept_circuit_breaker_state{state="closed"} 1' in content
+        assert 'netaxept_circuit_breaker_state{state="open"} 0' in content
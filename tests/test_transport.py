@@ -0,0 +1,66 @@
+import os
+from copy import deepcopy
+from unittest.mock import Mock
+
+from django.test import SimpleTestCase
+from pytest import raises
+from suds.transport import Request, TransportError
+
+from netaxept.transport import RequestsTransport, close_session, get_session
+
+
+def soap_request(operation):
+    request = Request('https://netaxept.example/netaxept.svc', b'<envelope/>')
+    request.headers = {'SOAPAction': '"http://BBS.EPayment/INetaxept/{}"'.format(operation).encode('ascii')}
+    return request
+
+
+class RequestsTransportTest(SimpleTestCase):
+
+    def setUp(self):
+        self.session = Mock()
+        self.session.post.return_value = Mock(status_code=200, headers={}, content=b'<reply/>')
+        self.transport = RequestsTransport(self.session, timeout=(1, 2), operation_timeouts={'Process': (1, 60)})
+
+    def test_it_sends_thru_the_session_with_the_default_timeout(self):
+        reply = self.transport.send(soap_request('Register'))
+        assert reply.message == b'<reply/>'
+        self.session.post.assert_called_once()
+        assert self.session.post.call_args[1]['timeout'] == (1, 2)
+
+    def test_it_uses_the_timeout_of_the_operation(self):
+        self.transport.send(soap_request('Process'))
+        assert self.session.post.call_args[1]['timeout'] == (1, 60)
+
+    def test_it_hands_error_bodies_to_suds(self):
+        self.session.post.return_value = Mock(status_code=500, reason='Internal Server Error', content=b'<fault/>')
+        with raises(TransportError) as excinfo:
+            self.transport.send(soap_request('Process'))
+        assert excinfo.value.httpcode == 500
+        assert excinfo.value.fp.read() == b'<fault/>'
+
+    def test_copies_share_the_session(self):
+        copied = deepcopy(self.transport)
+        assert copied is not self.transport
+        assert copied.session is self.session
+        assert copied.operation_timeouts == self.transport.operation_timeouts
+
+    def test_it_opens_local_files(self):
+        path = os.path.join(os.path.dirname(__file__), 'wsdl', 'netaxept.wsdl')
+        with self.transport.open(Request('file://' + path)) as f:
+            assert b'<wsdl:definitions' in f.read()
+        self.session.get.assert_not_called()
+
+
+class SessionTest(SimpleTestCase):
+
+    def setUp(self):
+        close_session()
+        self.addCleanup(close_session)
+
+    def test_each_merchant_has_its_own_session(self):
+        session = get_session(pool_maxsize=2)
+        assert get_session(pool_maxsize=2) is session
+        assert get_session(pool_maxsize=2, name='shop-b') is not session
+        close_session()
+        assert get_session(pool_maxsize=2) is not session